@@ -0,0 +1,245 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# event_storm.py
+# Lasttest: översvämmar integrationen med state_changed-händelser (grid, batteri, status)
+# och mäter genomströmning, CPU-tid per händelse, fördröjning i event-loopen och hur
+# många PeakGuard.update som är igång samtidigt.
+#
+#     python benchmarks/event_storm.py --rate 5000 --duration 10 --scenario mixed
+#
+# Scenarier:
+#     quiet  - lasten ligger långt under gränsen (tyst filter)
+#     peak   - lasten ligger över gränsen (urladdningskommandon)
+#     mixed  - växlar mellan tyst, peak och solexport
+#
+# Med --backend körs molnanropen (/signal och rapporter) över HTTP mot tests/fake_backend.py
+# i stället för den stubbade sessionen, med valbar fördröjning och felfrekvens.
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+import fake_hass  # noqa: E402
+from fake_backend import FakeBackend  # noqa: E402
+
+fake_hass.install()
+
+from custom_components.battery_optimizer_light import async_setup_entry  # noqa: E402
+from custom_components.battery_optimizer_light.const import DOMAIN  # noqa: E402
+
+GRID = "sensor.grid_power"
+BATTERY = "sensor.battery_power"
+STATUS = "sensor.battery_status"
+SOC = "sensor.battery_soc"
+
+CONFIG = {
+    "api_url": "http://bench.invalid",
+    "api_key": "bench",
+    "soc_sensor": SOC,
+    "grid_sensor": GRID,
+    "battery_power_sensor": BATTERY,
+    "battery_status_sensor": STATUS,
+}
+
+LIMIT_W = 5000.0
+
+
+def _load_for(scenario, i, rng):
+    """Returnerar (grid W, batteri W) för händelse nummer i."""
+    if scenario == "quiet":
+        return 1500 + rng.uniform(-300, 300), 0.0
+    if scenario == "peak":
+        return LIMIT_W + 1500 + rng.uniform(-500, 500), rng.uniform(0, 2000)
+    phase = (i // 2000) % 3
+    if phase == 0:
+        return 1500 + rng.uniform(-300, 300), 0.0
+    if phase == 1:
+        return LIMIT_W + 1500 + rng.uniform(-500, 500), rng.uniform(0, 2000)
+    return -1500 + rng.uniform(-300, 300), 0.0
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+async def _lag_monitor(samples, stop, interval):
+    """Mäter hur sent event-loopen väcker en sovande uppgift (loop lag)."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+async def run(rate, duration, scenario, script_latency, seed, backend=None):
+    hass = fake_hass.FakeHass()
+    rng = random.Random(seed)
+    config = dict(CONFIG)
+    if backend is not None:
+        config["api_url"] = backend.url
+        config["api_key"] = backend.api_key
+        hass.http_session = aiohttp.ClientSession()
+
+    # Källsensorer och ett återställt gränsvärde (som efter en omstart)
+    hass.states.async_set(SOC, "50", {"unit_of_measurement": "%"})
+    hass.states.async_set(GRID, "1000", {"unit_of_measurement": "W"})
+    hass.states.async_set(BATTERY, "0", {"unit_of_measurement": "W"})
+    hass.states.async_set(STATUS, "OnGrid", {})
+    hass.restore_cache["sensor.optimizer_light_peak_limit"] = LIMIT_W / 1000.0
+
+    # Stubbat script-anrop med valbar fördröjning (som ett REST-anrop till batteriet)
+    commands = []
+
+    async def script_service(call):
+        commands.append(call.service)
+        if script_latency:
+            await asyncio.sleep(script_latency)
+
+    for script in ("sonnen_force_discharge", "sonnen_force_charge", "sonnen_set_auto_mode"):
+        hass.services.async_register("script", script, script_service)
+
+    entry = fake_hass.FakeConfigEntry(config)
+    await async_setup_entry(hass, entry)
+    await hass.async_block_till_done()
+
+    peak_guard = hass.data[DOMAIN][entry.entry_id].peak_guard
+
+    # Räkna hur många PeakGuard.update som pågår samtidigt
+    in_flight = 0
+    max_in_flight = 0
+    completed = 0
+    original_update = peak_guard.update
+
+    async def counted_update(*args, **kwargs):
+        nonlocal in_flight, max_in_flight, completed
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        try:
+            return await original_update(*args, **kwargs)
+        finally:
+            in_flight -= 1
+            completed += 1
+
+    peak_guard.update = counted_update
+
+    lag_samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_lag_monitor(lag_samples, stop, 0.005))
+
+    # Generera händelser i små omgångar var 10:e ms
+    tick = 0.01
+    per_tick = max(1, int(rate * tick))
+    total_ticks = int(duration / tick)
+    emitted = 0
+    statuses = ("OnGrid", "OnGrid", "OnGrid", "OnGrid", "Battery-Care")
+
+    events_before = hass.states.events_fired
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    for _ in range(total_ticks):
+        for _ in range(per_tick):
+            grid_w, bat_w = _load_for(scenario, emitted, rng)
+            kind = emitted % 10
+            if kind < 6:
+                hass.states.async_set(GRID, round(grid_w, 1), {"unit_of_measurement": "W"})
+            elif kind < 9:
+                hass.states.async_set(BATTERY, round(bat_w, 1), {"unit_of_measurement": "W"})
+            else:
+                hass.states.async_set(STATUS, statuses[(emitted // 10) % len(statuses)], {})
+            emitted += 1
+        next_tick += tick
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+    await hass.async_block_till_done()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    stop.set()
+    await monitor
+    if backend is not None:
+        await hass.http_session.close()
+
+    lag_ms = [s * 1000 for s in lag_samples]
+    events = hass.states.events_fired - events_before
+    return {
+        "scenario": scenario,
+        "state_writes": emitted,
+        "state_changed_events": events,
+        "evaluations_completed": completed,
+        "wall_s": wall,
+        "throughput_eps": completed / wall if wall else 0.0,
+        "cpu_us_per_event": cpu / events * 1e6 if events else 0.0,
+        "loop_lag_ms_p50": _percentile(lag_ms, 50),
+        "loop_lag_ms_p95": _percentile(lag_ms, 95),
+        "loop_lag_ms_p99": _percentile(lag_ms, 99),
+        "loop_lag_ms_max": max(lag_ms) if lag_ms else 0.0,
+        "loop_lag_ms_mean": statistics.fmean(lag_ms) if lag_ms else 0.0,
+        "max_concurrent_updates": max_in_flight,
+        "commands_sent": len(commands),
+        "cloud_requests": len(backend.requests) if backend is not None else len(hass.http_session.requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lasttest: översvämmar integrationen med state_changed-händelser och mäter genomströmning, "
+        "CPU-tid per händelse, fördröjning i event-loopen och samtidiga PeakGuard.update."
+    )
+    parser.add_argument("--rate", type=int, default=2000, help="Händelser per sekund")
+    parser.add_argument("--duration", type=float, default=5.0, help="Testets längd i sekunder")
+    parser.add_argument("--scenario", choices=("quiet", "peak", "mixed"), default="mixed")
+    parser.add_argument("--script-latency-ms", type=float, default=0.0, help="Fördröjning i stubbat script")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", action="store_true", help="Kör molnanropen mot en lokal fejkad backend")
+    parser.add_argument("--backend-latency-ms", type=float, default=0.0, help="Fördröjning i fejkad backend")
+    parser.add_argument("--backend-error-rate", type=float, default=0.0, help="Andel anrop som får 500")
+    args = parser.parse_args()
+
+    async def run_with_backend():
+        if not args.backend:
+            return await run(args.rate, args.duration, args.scenario, args.script_latency_ms / 1000.0, args.seed)
+        backend = FakeBackend(
+            api_key=CONFIG["api_key"],
+            latency=args.backend_latency_ms / 1000.0,
+            error_rate=args.backend_error_rate,
+            seed=args.seed,
+        )
+        async with backend:
+            return await run(
+                args.rate, args.duration, args.scenario, args.script_latency_ms / 1000.0, args.seed, backend
+            )
+
+    result = asyncio.run(run_with_backend())
+    width = max(len(k) for k in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value:.3f}" if isinstance(value, float) else f"{key:<{width}}  {value}")
+
+
+if __name__ == "__main__":
+    main()
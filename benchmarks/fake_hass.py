@@ -0,0 +1,539 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# fake_hass.py
+# En lättviktig (men fungerande) ersättning för de delar av Home Assistant som integrationen
+# använder: state-maskin med state_changed-lyssnare, tjänster, config entry och sensorplattform.
+# Till skillnad från MagicMock-mockarna i testerna kör allt "på riktigt" i event-loopen,
+# så att benchmarks mäter integrationens eget arbete och inte mock-overhead.
+#
+# Användning:
+#     import fake_hass
+#     fake_hass.install()          # Måste köras innan komponenten importeras
+#     hass = fake_hass.FakeHass()
+
+import asyncio
+import importlib
+import re
+import sys
+import time
+import types
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from enum import Enum
+import os
+
+STATE_UNKNOWN = "unknown"
+STATE_UNAVAILABLE = "unavailable"
+
+
+# --- CORE ---
+
+class CoreState(Enum):
+    not_running = "NOT_RUNNING"
+    starting = "STARTING"
+    running = "RUNNING"
+
+
+def callback(func):
+    return func
+
+
+@dataclass(slots=True)
+class State:
+    entity_id: str
+    state: str
+    attributes: dict
+    last_changed: datetime
+    last_updated: datetime
+
+
+@dataclass(slots=True)
+class Event:
+    event_type: str
+    data: dict
+    time_fired_timestamp: float
+
+
+class StateMachine:
+    """State-maskin som skickar state_changed till registrerade lyssnare."""
+
+    def __init__(self, hass):
+        self._hass = hass
+        self._states = {}
+        self._trackers = {}  # entity_id -> [action]
+        self.events_fired = 0
+
+    def get(self, entity_id):
+        return self._states.get(entity_id)
+
+    def async_all(self):
+        return list(self._states.values())
+
+    def async_set(self, entity_id, new_state, attributes=None, force_update=False):
+        new_state = str(new_state)
+        attributes = dict(attributes or {})
+        old = self._states.get(entity_id)
+        if old is not None and old.state == new_state and old.attributes == attributes and not force_update:
+            return
+        now = datetime.now(timezone.utc)
+        last_changed = old.last_changed if old is not None and old.state == new_state else now
+        state = State(entity_id, new_state, attributes, last_changed, now)
+        self._states[entity_id] = state
+        actions = self._trackers.get(entity_id)
+        if actions:
+            self.events_fired += 1
+            event = Event(
+                "state_changed",
+                {"entity_id": entity_id, "old_state": old, "new_state": state},
+                time.time(),
+            )
+            for action in list(actions):
+                self._hass.async_run_job(action, event)
+
+    def track(self, entity_ids, action):
+        for entity_id in entity_ids:
+            self._trackers.setdefault(entity_id, []).append(action)
+
+        def remove():
+            for entity_id in entity_ids:
+                if action in self._trackers.get(entity_id, []):
+                    self._trackers[entity_id].remove(action)
+
+        return remove
+
+
+@dataclass
+class ServiceCall:
+    domain: str
+    service: str
+    data: dict
+    return_response: bool = False
+
+
+class ServiceRegistry:
+    def __init__(self, hass):
+        self._hass = hass
+        self._services = {}
+        self.calls = []
+
+    def async_register(self, domain, service, handler, schema=None, supports_response=None):
+        self._services[(domain, service)] = handler
+
+    def has_service(self, domain, service):
+        return (domain, service) in self._services
+
+    async def async_call(self, domain, service, service_data=None, blocking=False, return_response=False):
+        self.calls.append((domain, service, dict(service_data or {})))
+        handler = self._services.get((domain, service))
+        if handler is None:
+            return None
+        result = handler(ServiceCall(domain, service, dict(service_data or {}), return_response))
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+
+class FakeConfigEntries:
+    def __init__(self, hass):
+        self._hass = hass
+
+    def async_update_entry(self, entry, data=None, options=None):
+        if data is not None:
+            entry.data = data
+        if options is not None:
+            entry.options = options
+
+    async def async_forward_entry_setups(self, entry, platforms):
+        for platform in platforms:
+            module = importlib.import_module(f"{entry.package}.{platform}")
+            entities = []
+
+            def add_entities(new, *_args, entities=entities):
+                entities.extend(new)
+
+            await module.async_setup_entry(self._hass, entry, add_entities)
+            for entity in entities:
+                await self._hass.async_add_entity(entity)
+
+    async def async_unload_platforms(self, entry, platforms):
+        return True
+
+    async def async_reload(self, entry_id):
+        return True
+
+
+class FakeConfigEntry:
+    def __init__(self, data, entry_id="bench", package="custom_components.battery_optimizer_light"):
+        self.entry_id = entry_id
+        self.data = data
+        self.options = {}
+        self.package = package
+        self._on_unload = []
+
+    def async_on_unload(self, func):
+        self._on_unload.append(func)
+
+    def add_update_listener(self, listener):
+        return lambda: None
+
+    def async_create_background_task(self, hass, target, name, eager_start=True):
+        return hass.async_create_task(target, name)
+
+    def async_unload(self):
+        for func in self._on_unload:
+            func()
+        self._on_unload.clear()
+
+
+class FakeHass:
+    """Minimal hass: state-maskin, tjänster, config entries och executor."""
+
+    def __init__(self):
+        self.data = {}
+        self.state = CoreState.running
+        self.states = StateMachine(self)
+        self.services = ServiceRegistry(self)
+        self.config_entries = FakeConfigEntries(self)
+        self.entities = {}
+        self.restore_cache = {}  # entity_id -> senaste native_value (för RestoreSensor)
+        self.http_session = FakeClientSession()
+        self.loop = asyncio.get_running_loop()
+        self._tasks = set()
+        self.config = types.SimpleNamespace(path=lambda *parts: os.path.join("/tmp", *parts), components=set())
+        self.events = []  # (event_type, data) från hass.bus.async_fire
+        self.views = []
+        self.http = types.SimpleNamespace(register_view=self.views.append)
+        self.bus = types.SimpleNamespace(async_fire=lambda event, data=None: self.events.append((event, data)))
+
+    def async_create_task(self, target, name=None, eager_start=True):
+        task = self.loop.create_task(target, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def async_create_background_task(self, target, name, eager_start=True):
+        return self.async_create_task(target, name)
+
+    def async_run_job(self, job, *args):
+        if asyncio.iscoroutinefunction(job):
+            return self.async_create_task(job(*args))
+        return job(*args)
+
+    async def async_add_executor_job(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def async_add_entity(self, entity):
+        entity.hass = self
+        entity.entity_id = f"sensor.{_slugify(entity.name)}"
+        self.entities[entity.entity_id] = entity
+        await entity.async_added_to_hass()
+        entity.async_write_ha_state()
+
+    async def async_block_till_done(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+def _slugify(text):
+    return re.sub(r"[^a-z0-9]+", "_", str(text).lower()).strip("_")
+
+
+# --- HTTP ---
+
+class FakeResponse:
+    def __init__(self, status, payload):
+        self.status = status
+        self._payload = payload
+
+    async def json(self):
+        return self._payload
+
+    async def text(self):
+        return str(self._payload)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeClientSession:
+    """Svarar direkt på alla POST (molnet är inte det vi mäter i lasttestet)."""
+
+    def __init__(self, signal_response=None, latency=0.0):
+        self.signal_response = signal_response or {
+            "action": "HOLD", "peak_power_kw": 5.0, "is_peak_shaving_active": True, "acked_events": []
+        }
+        self.latency = latency
+        self.requests = []
+
+    def post(self, url, json=None, timeout=None):
+        self.requests.append((url, json))
+        return _DelayedResponse(self, url, json)
+
+
+class _DelayedResponse:
+    def __init__(self, session, url, payload):
+        self._session = session
+        self._url = url
+        self._payload = payload
+
+    async def __aenter__(self):
+        if self._session.latency:
+            await asyncio.sleep(self._session.latency)
+        if self._url.endswith("/signal"):
+            return FakeResponse(200, self._session.signal_response)
+        acked = [e["id"] for e in (self._payload or {}).get("events", [])]
+        return FakeResponse(200, {"acked_events": acked})
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# --- ENTITETER ---
+
+class Entity:
+    hass = None
+    entity_id = None
+    _attr_name = None
+    _attr_icon = None
+    _attr_unique_id = None
+    _attr_should_poll = True
+    _attr_entity_category = None
+    _attr_device_class = None
+
+    @property
+    def name(self):
+        return self._attr_name
+
+    @property
+    def icon(self):
+        return self._attr_icon
+
+    @property
+    def unique_id(self):
+        return self._attr_unique_id
+
+    @property
+    def available(self):
+        return True
+
+    @property
+    def state(self):
+        return None
+
+    @property
+    def extra_state_attributes(self):
+        return getattr(self, "_attr_extra_state_attributes", None)
+
+    def async_on_remove(self, func):
+        self.__dict__.setdefault("_on_remove", []).append(func)
+
+    async def async_added_to_hass(self):
+        pass
+
+    def async_write_ha_state(self):
+        if self.hass is None:
+            return
+        if not self.available:
+            self.hass.states.async_set(self.entity_id, STATE_UNAVAILABLE, {})
+            return
+        attributes = dict(self.extra_state_attributes or {})
+        unit = getattr(self, "_attr_native_unit_of_measurement", None)
+        if unit:
+            attributes["unit_of_measurement"] = unit
+        value = self.state
+        self.hass.states.async_set(self.entity_id, STATE_UNKNOWN if value is None else value, attributes)
+
+
+class SensorEntity(Entity):
+    _attr_native_value = None
+    _attr_native_unit_of_measurement = None
+    _attr_state_class = None
+
+    @property
+    def native_value(self):
+        return self._attr_native_value
+
+    @property
+    def state(self):
+        return self.native_value
+
+
+class RestoreSensor(SensorEntity):
+    async def async_get_last_sensor_data(self):
+        if self.entity_id in self.hass.restore_cache:
+            return types.SimpleNamespace(native_value=self.hass.restore_cache[self.entity_id])
+        return None
+
+
+class UpdateFailed(Exception):
+    pass
+
+
+class DataUpdateCoordinator:
+    def __init__(self, hass, logger, name=None, update_interval=None, **kwargs):
+        self.hass = hass
+        self.name = name
+        self.update_interval = update_interval
+        self.data = None
+        self.last_update_success = True
+        self.last_exception = None
+        self._listeners = []
+
+    def async_add_listener(self, update_callback, context=None):
+        self._listeners.append(update_callback)
+        return lambda: self._listeners.remove(update_callback)
+
+    def async_update_listeners(self):
+        for update_callback in list(self._listeners):
+            update_callback()
+
+    async def async_refresh(self):
+        try:
+            self.data = await self._async_update_data()
+            self.last_update_success = True
+        except Exception as err:  # noqa: BLE001 - som HA: alla fel markerar uppdateringen som misslyckad
+            self.last_exception = err
+            self.last_update_success = False
+        self.async_update_listeners()
+
+    async def async_config_entry_first_refresh(self):
+        await self.async_refresh()
+
+
+class CoordinatorEntity(Entity):
+    def __init__(self, coordinator, context=None):
+        self.coordinator = coordinator
+
+    @property
+    def available(self):
+        return self.coordinator.last_update_success
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        self.async_on_remove(self.coordinator.async_add_listener(self._handle_coordinator_update))
+
+    def _handle_coordinator_update(self):
+        self.async_write_ha_state()
+
+
+class HomeAssistantView:
+    url = None
+    name = None
+    requires_auth = True
+
+
+class _Enum:
+    """Enkla konstanter för device/state class."""
+
+    def __getattr__(self, name):
+        return name.lower()
+
+
+# --- INSTALLATION I sys.modules ---
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Registrerar de falska homeassistant-modulerna. Måste köras innan komponenten importeras."""
+    ha = _module("homeassistant")
+    ha.__path__ = []
+    _module("homeassistant.core", HomeAssistant=FakeHass, ServiceCall=ServiceCall, CoreState=CoreState,
+            callback=callback, SupportsResponse=_Enum())
+    _module("homeassistant.const", STATE_UNKNOWN=STATE_UNKNOWN, STATE_UNAVAILABLE=STATE_UNAVAILABLE,
+            EntityCategory=_Enum())
+    _module("homeassistant.exceptions", HomeAssistantError=Exception)
+    _module("homeassistant.loader", async_get_integration=_async_get_integration)
+    helpers = _module("homeassistant.helpers")
+    helpers.__path__ = []
+    _module("homeassistant.helpers.event", async_track_state_change_event=_track_state_change_event,
+            async_track_utc_time_change=lambda hass, action, **kwargs: (lambda: None),
+            async_call_later=_call_later)
+    _module("homeassistant.helpers.aiohttp_client", async_get_clientsession=lambda hass: hass.http_session)
+    _module("homeassistant.helpers.entity", DeviceInfo=dict)
+    helpers.entity_registry = _module("homeassistant.helpers.entity_registry", async_get=_EntityRegistry)
+    helpers.issue_registry = _module(
+        "homeassistant.helpers.issue_registry", IssueSeverity=_Enum(),
+        async_create_issue=_async_create_issue, async_delete_issue=_async_delete_issue,
+    )
+    _module("homeassistant.helpers.update_coordinator", DataUpdateCoordinator=DataUpdateCoordinator,
+            UpdateFailed=UpdateFailed, CoordinatorEntity=CoordinatorEntity)
+    components = _module("homeassistant.components")
+    components.__path__ = []
+    _module("homeassistant.components.sensor", SensorEntity=SensorEntity, RestoreSensor=RestoreSensor,
+            SensorDeviceClass=_Enum(), SensorStateClass=_Enum())
+    _module("homeassistant.components.http", HomeAssistantView=HomeAssistantView)
+    _module("homeassistant.components.diagnostics", async_redact_data=lambda data, keys: data)
+    recorder = _module("homeassistant.components.recorder", get_instance=lambda hass: None)
+    recorder.__path__ = []
+    _module("homeassistant.components.recorder.models", StatisticData=dict, StatisticMetaData=dict)
+    _module("homeassistant.components.recorder.statistics",
+            async_add_external_statistics=lambda hass, metadata, statistics: None,
+            get_last_statistics=lambda *args: {})
+    util = _module("homeassistant.util")
+    util.__path__ = []
+    dt = _module("homeassistant.util.dt", utcnow=lambda: datetime.now(timezone.utc),
+                 now=lambda: datetime.now().astimezone())
+    util.dt = dt
+
+    # Gör komponenten importerbar från repo-roten
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+
+async def _async_get_integration(hass, domain):
+    return types.SimpleNamespace(version="benchmark")
+
+
+class _EntityRegistry:
+    """Slår upp entity_id från unique_id bland entiteterna i FakeHass."""
+
+    def __init__(self, hass):
+        self._hass = hass
+
+    def async_get_entity_id(self, domain, platform, unique_id):
+        for entity_id, entity in self._hass.entities.items():
+            if entity_id.startswith(f"{domain}.") and getattr(entity, "unique_id", None) == unique_id:
+                return entity_id
+        return None
+
+
+def _async_create_issue(hass, domain, issue_id, **kwargs):
+    hass.data.setdefault("issues", {})[(domain, issue_id)] = kwargs
+
+
+def _async_delete_issue(hass, domain, issue_id):
+    hass.data.get("issues", {}).pop((domain, issue_id), None)
+
+
+def _track_state_change_event(hass, entity_ids, action):
+    if isinstance(entity_ids, str):
+        entity_ids = [entity_ids]
+    return hass.states.track(list(entity_ids), action)
+
+
+def _call_later(hass, delay, action):
+    handle = hass.loop.call_later(delay, lambda: hass.async_run_job(action, None))
+    return handle.cancel
@@ -0,0 +1,262 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# startup.py
+# Uppstartstest: mäter tiden från async_setup_entry till första tillgängliga entitet,
+# första molnsignal, första PeakGuard-utvärdering och första batterikommando. Molnet är
+# tests/fake_backend.py (HTTP på 127.0.0.1) med valbar fördröjning och fel, så att
+# omförsöken i _async_update_data kommer med i mätningen.
+#
+#     python benchmarks/startup.py --runs 5 --scenario retry --backend-latency-ms 200
+#
+# Scenarier (fel som backend ger på de första /signal-anropen):
+#     ok       - inga fel
+#     retry    - 503 och avbruten anslutning, tredje försöket lyckas
+#     timeout  - första försöket hänger tills klientens timeout slår till
+#     down     - alla tre försöken misslyckas (första uppdateringen misslyckas)
+#
+# Lasten ligger över gränsen under hela testet, så PeakGuard ska ladda ur så fort den kan.
+# Med --no-restore saknas sparat gränsvärde (som vid en ny installation), och då måste
+# PeakGuard vänta på molnets gräns.
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+import fake_hass  # noqa: E402
+from fake_backend import FakeBackend  # noqa: E402
+
+fake_hass.install()
+
+from custom_components.battery_optimizer_light import PeakGuard, async_setup_entry  # noqa: E402
+from custom_components.battery_optimizer_light.const import DOMAIN  # noqa: E402
+
+GRID = "sensor.grid_power"
+BATTERY = "sensor.battery_power"
+SOC = "sensor.battery_soc"
+
+CONFIG = {
+    "api_key": "bench",
+    "soc_sensor": SOC,
+    "grid_sensor": GRID,
+    "battery_power_sensor": BATTERY,
+}
+
+LIMIT_KW = 5.0
+LOAD_W = 6500.0
+
+SCENARIOS = {
+    "ok": (),
+    "retry": (503, "disconnect"),
+    "timeout": ("timeout",),
+    "down": (503, 503, 503),
+}
+
+MILESTONES = (
+    "setup_returned",
+    "first_entity_available",
+    "first_signal",
+    "first_evaluation",
+    "first_command",
+)
+
+
+class Milestones:
+    """Sparar första tidpunkten (ms efter start) för varje milstolpe."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.times = {}
+
+    def mark(self, name):
+        if name not in self.times:
+            self.times[name] = (time.perf_counter() - self.start) * 1000
+
+    def done(self):
+        return "first_command" in self.times
+
+
+def _instrument_peak_guard(milestones):
+    """Markerar första utvärderingen där last och gräns jämförs (steget efter att indata har lästs)."""
+    original = PeakGuard._stage_quiet_filter
+
+    def quiet_filter(self, *args, **kwargs):
+        milestones.mark("first_evaluation")
+        return original(self, *args, **kwargs)
+
+    PeakGuard._stage_quiet_filter = quiet_filter
+    return lambda: setattr(PeakGuard, "_stage_quiet_filter", original)
+
+
+def _instrument_states(hass, milestones):
+    """Markerar första gången en av integrationens entiteter får ett giltigt värde."""
+    original = hass.states.async_set
+
+    def async_set(entity_id, new_state, attributes=None, force_update=False):
+        if entity_id in hass.entities and str(new_state) not in (
+            fake_hass.STATE_UNKNOWN, fake_hass.STATE_UNAVAILABLE
+        ):
+            milestones.mark("first_entity_available")
+        return original(entity_id, new_state, attributes, force_update)
+
+    hass.states.async_set = async_set
+
+
+def _set_grid(hass, rng):
+    hass.states.async_set(GRID, round(LOAD_W + rng.uniform(-200, 200), 1), {"unit_of_measurement": "W"})
+
+
+async def _sensor_feed(hass, interval, rng):
+    """Grid-sensorn rapporterar en ny mätning per intervall, med slumpad fas mot uppstarten."""
+    await asyncio.sleep(rng.uniform(0, interval))
+    while True:
+        _set_grid(hass, rng)
+        await asyncio.sleep(interval)
+
+
+async def run_once(args, faults, seed):
+    hass = fake_hass.FakeHass()
+    hass.http_session = aiohttp.ClientSession()
+    hass.state = fake_hass.CoreState.starting
+    rng = random.Random(seed)
+    milestones = Milestones()
+    restore_update = _instrument_peak_guard(milestones)
+    _instrument_states(hass, milestones)
+
+    hass.states.async_set(SOC, "50", {"unit_of_measurement": "%"})
+    hass.states.async_set(BATTERY, "0", {"unit_of_measurement": "W"})
+    _set_grid(hass, rng)
+    if not args.no_restore:
+        hass.restore_cache["sensor.optimizer_light_peak_limit"] = LIMIT_KW
+
+    async def script_service(call):
+        milestones.mark("first_command")
+        if args.script_latency_ms:
+            await asyncio.sleep(args.script_latency_ms / 1000.0)
+
+    for script in ("sonnen_force_discharge", "sonnen_force_charge", "sonnen_set_auto_mode"):
+        hass.services.async_register("script", script, script_service)
+
+    backend = FakeBackend(
+        timeline=[{"action": "HOLD", "peak_power_kw": LIMIT_KW, "is_peak_shaving_active": True}],
+        api_key=CONFIG["api_key"],
+        latency=args.backend_latency_ms / 1000.0,
+        hang_seconds=args.request_timeout_s + 1,
+        seed=seed,
+    )
+    await backend.start()
+    backend.fail_next(*faults)
+    feed = None
+    try:
+        entry = fake_hass.FakeConfigEntry({**CONFIG, "api_url": backend.url})
+        feed = asyncio.create_task(_sensor_feed(hass, args.sensor_interval_ms / 1000.0, rng))
+        milestones.start = time.perf_counter()
+        await async_setup_entry(hass, entry)
+        milestones.mark("setup_returned")
+
+        coordinator = hass.data[DOMAIN][entry.entry_id]
+        # Första uppdateringen körs som bakgrundsuppgift och har inte startat ännu
+        coordinator.request_timeout = args.request_timeout_s
+        coordinator.retry_delay = args.retry_delay_s
+
+        async def mark_first_signal():
+            while coordinator.data is None:
+                await asyncio.sleep(0.001)
+            milestones.mark("first_signal")
+
+        signal_waiter = asyncio.create_task(mark_first_signal())
+        await asyncio.sleep(args.ha_start_ms / 1000.0)
+        hass.state = fake_hass.CoreState.running
+
+        deadline = time.perf_counter() + args.timeout_s
+        while not (milestones.done() and "first_signal" in milestones.times) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.001)
+        signal_waiter.cancel()
+        stats = dict(coordinator.stats)
+    finally:
+        if feed is not None:
+            feed.cancel()
+        restore_update()
+        await hass.async_block_till_done()
+        await hass.http_session.close()
+        await backend.stop()
+
+    return {
+        **milestones.times,
+        "signal_requests": len(backend.requests_to("/signal")),
+        "retries": stats.get("retries", 0),
+    }
+
+
+def _summary(values):
+    if not values:
+        return "not reached"
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return f"median {statistics.median(values):9.1f}  p95 {p95:9.1f}  max {values[-1]:9.1f}  (n={len(values)})"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Uppstartstest: tid från async_setup_entry till första entitet, molnsignal,\n"
+            "PeakGuard-utvärdering och batterikommando.\n\n"
+            "Scenarier (fel som backend ger på de första /signal-anropen):\n"
+            "    ok       - inga fel\n"
+            "    retry    - 503 och avbruten anslutning, tredje försöket lyckas\n"
+            "    timeout  - första försöket hänger tills klientens timeout slår till\n"
+            "    down     - alla tre försöken misslyckas"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Antal uppstarter")
+    parser.add_argument("--scenario", choices=tuple(SCENARIOS), default="ok")
+    parser.add_argument("--faults", help="Egna fel för /signal, t.ex. 503,timeout,disconnect (ersätter scenariot)")
+    parser.add_argument("--backend-latency-ms", type=float, default=50.0, help="Fördröjning i fejkad backend")
+    parser.add_argument("--script-latency-ms", type=float, default=0.0, help="Fördröjning i stubbat script")
+    parser.add_argument("--sensor-interval-ms", type=float, default=1000.0, help="Hur ofta grid-sensorn rapporterar")
+    parser.add_argument("--ha-start-ms", type=float, default=0.0, help="Tid tills HA är igång (CoreState.running)")
+    parser.add_argument("--request-timeout-s", type=float, default=30.0, help="Coordinatorns timeout per anrop")
+    parser.add_argument("--retry-delay-s", type=float, default=5.0, help="Coordinatorns väntetid mellan omförsök")
+    parser.add_argument("--no-restore", action="store_true", help="Inget sparat gränsvärde (ny installation)")
+    parser.add_argument("--timeout-s", type=float, default=120.0, help="Max tid per uppstart")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.faults:
+        faults = tuple(int(f) if f.isdigit() else f for f in args.faults.split(","))
+    else:
+        faults = SCENARIOS[args.scenario]
+
+    results = [asyncio.run(run_once(args, faults, args.seed + i)) for i in range(args.runs)]
+
+    print(f"scenario {args.faults or args.scenario}, {args.runs} runs, times in ms from async_setup_entry")
+    width = max(len(m) for m in MILESTONES)
+    for milestone in MILESTONES:
+        print(f"{milestone:<{width}}  {_summary([r[milestone] for r in results if milestone in r])}")
+    print(f"{'signal_requests':<{width}}  {statistics.fmean(r['signal_requests'] for r in results):.1f} per run")
+    print(f"{'retries':<{width}}  {statistics.fmean(r['retries'] for r in results):.1f} per run")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,38 +15,92 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import time
+from collections import Counter, deque
 from datetime import timedelta
 import homeassistant.util.dt as dt_util
-from homeassistant.core import HomeAssistant, ServiceCall, CoreState # type: ignore
+from homeassistant.core import HomeAssistant, ServiceCall, CoreState, SupportsResponse, callback # type: ignore
 from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN # type: ignore
-from homeassistant.helpers.event import async_track_state_change_event # type: ignore
-from homeassistant.helpers.aiohttp_client import async_get_clientsession # type: ignore
+from homeassistant.helpers import entity_registry as er # type: ignore
+from homeassistant.helpers.event import async_track_state_change_event, async_track_utc_time_change # type: ignore
 from homeassistant.loader import async_get_integration # type: ignore
+from .changepoint import CusumDetector
 from .coordinator import BatteryOptimizerLightCoordinator
+from .dryrun import DRY_RUN_SCHEMA, DryRunInputs, async_dry_run
+from .energy import EnergyAccounting, METER_PEAK_SHAVED
+from .filters import DeadbandFilter
+from .hourly_stats import HourlyAccumulator, HourlyStatisticsWriter
+from .actuation import ActuationTracker
+from .actuator import ModbusActuator, ModbusTcpClient, ScriptActuator
+from .limit import PeakLimit, state_to_watts
+from .schedule import LimitSchedule
+from .models import Action, DEFAULT_MAX_DISCHARGE_KW
+from .phases import evaluate_phases, state_to_amps
+from .profiler import PROFILE_SCHEMA, async_profile
+from .prometheus import BatteryOptimizerMetricsView
+from .shadow import ShadowController, note_live_command, note_live_read
+from .metrics import LatencyHistogram
+from .watchdog import UpdateWatchdog, current_timing, queue_delay_since, STAGE_STATE_READS, STAGE_SCRIPT, STAGE_REPORT
 from .const import (
     DOMAIN,
     CONF_SOC_SENSOR,
     CONF_BATTERY_POWER_SENSOR,
     CONF_API_URL,
-    CONF_API_KEY,
     CONF_GRID_SENSOR,
     CONF_GRID_SENSOR_INVERT,
     CONF_BATTERY_STATUS_SENSOR,
     CONF_BATTERY_STATUS_KEYWORDS,
     CONF_VIRTUAL_LOAD_SENSOR,
+    CONF_LOAD_DEADBAND_W,
+    CONF_BATTERY_DEADBAND_W,
+    CONF_LIMIT_ENTITY,
+    CONF_LIMIT_FIXED_KW,
+    CONF_LIMIT_SCHEDULE,
+    CONF_MODBUS_HOST,
+    CONF_MODBUS_PORT,
+    CONF_MODBUS_REGISTERS,
+    CONF_MODBUS_UNIT_ID,
+    CONF_PV_POWER_SENSOR,
+    CONF_PV_FORECAST_SENSOR,
+    CONF_SOLAR_FORECAST_VERIFY_S,
+    CONF_SOLAR_CUSUM_THRESHOLD,
+    CONF_SHADOW_CONFIG,
+    CONF_MAINTENANCE_CUSUM_THRESHOLD,
+    CONF_PHASE_L1_SENSOR,
+    CONF_PHASE_L2_SENSOR,
+    CONF_PHASE_L3_SENSOR,
+    CONF_MAIN_FUSE_A,
+    CONF_INVERTER_PHASES,
     DEFAULT_BATTERY_STATUS_KEYWORDS,
+    DEFAULT_DEADBAND_W,
+    DEFAULT_MODBUS_PORT,
+    DEFAULT_MODBUS_UNIT_ID,
+    DEFAULT_SOLAR_FORECAST_VERIFY_S,
+    SOLAR_FORECAST_MIN_VERIFY_S,
+    DEFAULT_SOLAR_CUSUM_THRESHOLD,
+    DEFAULT_MAINTENANCE_CUSUM_THRESHOLD,
+    DEFAULT_MAIN_FUSE_A,
+    DEFAULT_INVERTER_PHASES,
     DEFAULT_API_URL,
+    DIAGNOSTICS_HISTORY_SIZE,
 )
 
 _LOGGER = logging.getLogger(__name__)
 
+# Nyckel i hass.data som visar att Prometheus-vyn är registrerad
+METRICS_VIEW_KEY = f"{DOMAIN}_metrics_view"
+
 # --- KONFIGURATION ---
-LIMIT_ENTITY = "sensor.optimizer_light_peak_limit"
+LIMIT_ENTITY = "sensor.optimizer_light_peak_limit"  # Standardnamn på egen gränssensor (om registret saknar den)
 
 # --- SOLAR OVERRIDE KONSTANTER ---
 SOLAR_TRIGGER_W = -400.0  # Gräns för att starta override (Export)
 SOLAR_RESET_W = -100.0    # Gräns för att stoppa override (Minskad export)
 BATTERY_DISCHARGE_THRESHOLD_W = 200.0 # Gräns för att anse att batteriet laddar ur
+SOLAR_VERIFY_S = 30  # Längsta väntan innan override (om CUSUM inte har bestämt sig tidigare)
+SOLAR_CUSUM_DRIFT_W = 100.0     # Exporten måste ligga minst så här mycket under triggergränsen
+SOLAR_CUSUM_MAX_STEP_W = 2000.0  # Tak per sekund, så att en enskild spik (sensor-lag) inte räcker
+MAINTENANCE_MAX_COOLDOWN_FACTOR = 3  # Fladdrande status kan ge upp till 3 x tröskeln i väntan
 
 async def async_setup_entry(hass: HomeAssistant, entry):
     """Set up from a config entry."""
@@ -70,21 +124,79 @@ async def async_setup_entry(hass: HomeAssistant, entry):
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][entry.entry_id] = coordinator
 
+    # Prometheus-endpoint (en för alla config entries, vyer kan inte avregistreras i HA)
+    if not hass.data.get(METRICS_VIEW_KEY):
+        hass.http.register_view(BatteryOptimizerMetricsView(hass))
+        hass.data[METRICS_VIEW_KEY] = True
+
     # Initiera PeakGuard
-    peak_guard = PeakGuard(hass, config, coordinator)
+    peak_guard = PeakGuard(hass, config, coordinator, entry.entry_id)
     coordinator.peak_guard = peak_guard
 
-    # Kör första uppdateringen NU, när PeakGuard är kopplad.
-    await coordinator.async_config_entry_first_refresh()
+    # Registrera sensorerna direkt (med återställda värden) istället för att vänta på molnet.
+    # Då finns gränsvärdet tillgängligt för PeakGuard redan innan första svaret har kommit.
+    await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
+
+    # Gränsvärdet: egen gränssensor slås upp i entitetsregistret (klarar att den byter namn)
+    if not config.get(CONF_LIMIT_ENTITY):
+        peak_guard.limit.entity_id = er.async_get(hass).async_get_entity_id(
+            "sensor", DOMAIN, f"{coordinator.api_key}_light_peak_limit"
+        ) or LIMIT_ENTITY
+    stop_limit_tracking = peak_guard.limit.async_track()
+    if stop_limit_tracking:
+        entry.async_on_unload(stop_limit_tracking)
+    _LOGGER.info(f"PeakGuard limit source: {peak_guard.limit.source}")
 
     # Hämta virtuell last-sensor från config (kan vara None)
     virtual_load_entity = config.get(CONF_VIRTUAL_LOAD_SENSOR)
 
+    # Dödband: last- och batterisensorer släpps bara igenom vid tillräckligt stor ändring
+    load_entity = virtual_load_entity or config.get(CONF_GRID_SENSOR)
+    deadbands = {load_entity: config.get(CONF_LOAD_DEADBAND_W, DEFAULT_DEADBAND_W)}
+    if not virtual_load_entity:
+        deadbands[config.get(CONF_BATTERY_POWER_SENSOR)] = config.get(CONF_BATTERY_DEADBAND_W, DEFAULT_DEADBAND_W)
+    peak_guard.event_filter = DeadbandFilter(
+        deadbands, peak_guard.deadband_thresholds, peak_guard.deadband_generation
+    )
+
+    # Skuggregulator: avvikande inställningar utvärderas bredvid, utan att skicka kommandon
+    shadow_config = config.get(CONF_SHADOW_CONFIG)
+    if shadow_config:
+        if isinstance(shadow_config, dict):
+            peak_guard.shadow = ShadowController(peak_guard, shadow_config)
+            _LOGGER.info(f"PeakGuard shadow controller enabled with {shadow_config}")
+        else:
+            _LOGGER.warning(f"Ignoring shadow controller settings (expected a mapping): {shadow_config!r}")
+
+    # Batterikommandon direkt via Modbus TCP i stället för HA-scripten
+    if config.get(CONF_MODBUS_HOST):
+        registers = config.get(CONF_MODBUS_REGISTERS)
+        if registers is not None and not isinstance(registers, dict):
+            _LOGGER.warning(f"Ignoring Modbus register map (expected a mapping): {registers!r}")
+            registers = None
+        client = ModbusTcpClient(
+            config[CONF_MODBUS_HOST],
+            config.get(CONF_MODBUS_PORT, DEFAULT_MODBUS_PORT),
+            config.get(CONF_MODBUS_UNIT_ID, DEFAULT_MODBUS_UNIT_ID),
+        )
+        peak_guard.actuator = ModbusActuator(client, registers)
+        entry.async_on_unload(peak_guard.actuator.async_close)
+        _LOGGER.info(f"PeakGuard sends battery commands via Modbus TCP to {client.host}:{client.port}")
+
+    # Kvittens för batterikommandon (bevakar batteriets effektsensor)
+    stop_actuation_tracking = peak_guard.actuation.async_track()
+    if stop_actuation_tracking is not None:
+        entry.async_on_unload(stop_actuation_tracking)
+
     # --- BAKGRUNDSBEVAKNING ---
     async def on_load_change(event):
         """Körs tyst i bakgrunden varje gång lasten ändras."""
-        if hass.state == CoreState.running:
-            await peak_guard.update(virtual_load_entity, LIMIT_ENTITY)
+        if hass.state != CoreState.running:
+            return
+        if peak_guard.event_filter.accept(event.data.get("entity_id"), event.data.get("new_state")):
+            await peak_guard.update(
+                virtual_load_entity, fired_at=getattr(event, "time_fired_timestamp", None)
+            )
 
     # Samla alla sensorer vi ska lyssna på
     entities_to_track = []
@@ -108,6 +220,14 @@ async def async_setup_entry(hass: HomeAssistant, entry):
         entities_to_track.append(status_entity)
         _LOGGER.info(f"PeakGuard monitoring battery status: {status_entity}")
 
+    # 3. Fas-sensorer (säkringsskydd per fas)
+    if peak_guard.phase_sensors:
+        entities_to_track.extend(peak_guard.phase_sensors.values())
+        _LOGGER.info(
+            f"PeakGuard monitoring phases {peak_guard.phase_sensors} (fuse {peak_guard.main_fuse_a:.0f} A, "
+            f"inverter on {', '.join(peak_guard.inverter_phases)})"
+        )
+
     # Starta bevakning
     if entities_to_track:
         entry.async_on_unload(
@@ -116,24 +236,54 @@ async def async_setup_entry(hass: HomeAssistant, entry):
 
     async def handle_run_peak_guard(call: ServiceCall):
         v_load = call.data.get("virtual_load_entity", virtual_load_entity)
-        limit = call.data.get("limit_entity", LIMIT_ENTITY)
+        limit = call.data.get("limit_entity")
         await peak_guard.update(v_load, limit)
 
     hass.services.async_register(DOMAIN, "run_peak_guard", handle_run_peak_guard)
 
-    await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
+    async def handle_dry_run(call: ServiceCall):
+        return await async_dry_run(peak_guard, DryRunInputs.from_service_data(call.data))
+
+    hass.services.async_register(
+        DOMAIN, "dry_run", handle_dry_run, schema=DRY_RUN_SCHEMA, supports_response=SupportsResponse.ONLY
+    )
+
+    async def handle_profile(call: ServiceCall):
+        return await async_profile(
+            hass,
+            coordinator,
+            peak_guard,
+            call.data["duration"],
+            call.data["top"],
+        )
+
+    hass.services.async_register(
+        DOMAIN, "profile", handle_profile, schema=PROFILE_SCHEMA, supports_response=SupportsResponse.ONLY
+    )
+
+    # Timstatistik: skriv avslutade timmar strax efter varje heltimme
+    entry.async_on_unload(
+        async_track_utc_time_change(hass, peak_guard.statistics_writer.async_hourly, minute=0, second=5)
+    )
+
     entry.async_on_unload(entry.add_update_listener(update_listener))
 
+    # Första uppdateringen mot molnet körs i bakgrunden så att uppstarten inte blockeras av nätverket
+    entry.async_create_background_task(
+        hass, coordinator.async_refresh(), f"{DOMAIN}_first_refresh"
+    )
+
     return True
 
 class PeakGuard:
     """Hanterar logiken för effektvakten."""
 
-    def __init__(self, hass: HomeAssistant, config, coordinator):
+    def __init__(self, hass: HomeAssistant, config, coordinator, entry_id=None):
         self.hass = hass
         self.config = config
         self.coordinator = coordinator
         self._has_reported = False
+        self._phase_only_peak = False  # Toppen utlöstes bara av en fas (totalen under gränsen)
         self._hold_command_sent = False  # Flagga för att undvika upprepade kommandon
         self._capacity_exceeded_logged = False  # Flagga för att logga överlast en gång
         self._is_solar_override = False  # Flagga för sol-override
@@ -142,6 +292,73 @@ class PeakGuard:
         self._maintenance_reason = None  # Orsak till underhållsläge
         self._maintenance_cooldown_start = None # Tidsstämpel för när underhållssignalen försvann
         self._last_sent_command = None  # Håller koll på senaste kommandot för att undvika spam
+        self._last_cloud_action = None  # Molnets läge vid förra beslutet (byte avbryter väntan på kvittens)
+        self._listeners = []  # Callbacks som körs när PeakGuards tillstånd ändras (t.ex. sensorer)
+        self._last_status_value = None  # Senast tolkade status (för att slippa tolka om nyckelorden)
+        self._float_cache = {}  # entity_id -> (state, rå sträng, tolkat värde)
+        self.solar_fast_engagements = 0  # Antal override som aktiverades med kortad verifiering
+
+        # Säkringsskydd per fas (tomt = bara total effekt bevakas)
+        self.phase_sensors = {
+            phase: config.get(key)
+            for phase, key in (("L1", CONF_PHASE_L1_SENSOR), ("L2", CONF_PHASE_L2_SENSOR), ("L3", CONF_PHASE_L3_SENSOR))
+            if config.get(key)
+        }
+        self.main_fuse_a = float(config.get(CONF_MAIN_FUSE_A) or DEFAULT_MAIN_FUSE_A)
+        self.inverter_phases = list(config.get(CONF_INVERTER_PHASES) or DEFAULT_INVERTER_PHASES)
+        self.last_phases = None  # Senaste genomgången av faserna (diagnostik)
+
+        # Lokal energiräkning (urladdning under toppar, kapad topp, solel under solar override)
+        self.energy = EnergyAccounting()
+        self._peak_need_w = 0.0  # Last över gränsen just nu (W)
+        self._peak_discharge_w = 0.0  # Senast beordrad urladdning (om batterisensor saknas)
+
+        # Timstatistik (skrivs till HA:s långtidsstatistik en gång i timmen)
+        self._last_load_w = None
+        self.hourly = HourlyAccumulator()
+        self.statistics_writer = HourlyStatisticsWriter(
+            hass, self.hourly, lambda: self.energy.total_kwh(METER_PEAK_SHAVED), entry_id
+        )
+        self._phase_uncovered_logged = False
+
+        # Lägesbytesdetektering (ersätter de fasta 30 s/60 s som första val)
+        self.solar_detector = CusumDetector(
+            config.get(CONF_SOLAR_CUSUM_THRESHOLD, DEFAULT_SOLAR_CUSUM_THRESHOLD),
+            drift=SOLAR_CUSUM_DRIFT_W,
+            max_step=SOLAR_CUSUM_MAX_STEP_W,
+        )
+        maintenance_threshold = config.get(CONF_MAINTENANCE_CUSUM_THRESHOLD, DEFAULT_MAINTENANCE_CUSUM_THRESHOLD)
+        # Varje gång signalen kommer tillbaka under nedräkningen dras en hel tröskel av.
+        # Golvet gör att upprepat fladder ger längre väntan (högst 3 x tröskeln).
+        self.maintenance_detector = CusumDetector(
+            maintenance_threshold,
+            floor=-(MAINTENANCE_MAX_COOLDOWN_FACTOR - 1) * float(maintenance_threshold),
+        )
+        # Räknare för var i stegen utvärderingarna avslutas
+        self.pipeline_stats = dict.fromkeys((
+            "evaluations", "backend_disabled", "status_unavailable", "status_cached",
+            "maintenance", "inputs_unavailable", "quiet", "decision",
+        ), 0)
+
+        # --- DIAGNOSTIK (begränsade buffertar i minnet) ---
+        self.update_latency = LatencyHistogram()
+        self.command_history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self.command_counts = Counter()  # (script, "ok"/"error") -> antal
+        self.decision_trace = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)  # Lägesbyten och vad som avgjorde dem
+        self.watchdog = UpdateWatchdog(hass)
+        self.event_filter = None  # Sätts i async_setup_entry (dödbandsfilter för händelser)
+        self.shadow = None  # Skuggregulator (ShadowController), sätts i async_setup_entry om den är konfigurerad
+        self.actuator = ScriptActuator(hass)  # Byts mot ModbusActuator i async_setup_entry om den är konfigurerad
+        # Kvittens: följer batteriet kommandona, och hur snabbt?
+        self.actuation = ActuationTracker(
+            hass, config.get(CONF_BATTERY_POWER_SENSOR), self._call_script, self._async_notify_listeners
+        )
+        self.limit = PeakLimit(hass, config.get(CONF_LIMIT_ENTITY) or LIMIT_ENTITY, config.get(CONF_LIMIT_FIXED_KW))
+        if config.get(CONF_LIMIT_SCHEDULE):
+            try:
+                self.limit.schedule = LimitSchedule.from_config(config[CONF_LIMIT_SCHEDULE])
+            except ValueError as e:
+                _LOGGER.warning(f"Ignoring peak limit schedule: {e}")
 
     @property
     def is_active(self):
@@ -159,6 +376,29 @@ class PeakGuard:
     def maintenance_reason(self):
         return self._maintenance_reason
 
+    @property
+    def actuation_latency_s(self):
+        """Uppmätt tid från kommando till att batteriet svarar (None innan första mätningen)."""
+        return self.actuation.latency_s
+
+    @callback
+    def async_add_listener(self, update_callback):
+        """Registrerar en callback som körs när PeakGuards tillstånd ändras."""
+        self._listeners.append(update_callback)
+
+        @callback
+        def remove_listener():
+            if update_callback in self._listeners:
+                self._listeners.remove(update_callback)
+
+        return remove_listener
+
+    @callback
+    def _async_notify_listeners(self):
+        """Meddelar lyssnare (sensorer) att tillståndet har ändrats."""
+        for update_callback in list(self._listeners):
+            update_callback()
+
     def _set_reported_state(self, state: bool):
         if self._has_reported != state:
             self._has_reported = state
@@ -168,447 +408,758 @@ class PeakGuard:
             else:
                 # Återställ flaggor när toppen är över
                 self._capacity_exceeded_logged = False
-            self.coordinator.async_update_listeners()
-
-    async def update(self, virtual_load_id, limit_id):
+                self._peak_need_w = 0.0
+                self._peak_discharge_w = 0.0
+                # Urladdningen för toppen skickas inte längre och ska inte skickas om
+                self.actuation.cancel()
+            self._async_notify_listeners()
+
+    def _get_state(self, entity_id):
+        """Läser ett state, räknar tiden till utvärderingens state-läsningar och spelar in det åt skuggan."""
+        timing = current_timing()
+        if timing is None:
+            state = self.hass.states.get(entity_id)
+        else:
+            started = time.perf_counter()
+            try:
+                state = self.hass.states.get(entity_id)
+            finally:
+                timing.add(STAGE_STATE_READS, time.perf_counter() - started)
+        note_live_read(entity_id, state)
+        return state
+
+    async def update(self, virtual_load_id, limit_id=None, fired_at=None):
+        """Utvärderar lasten. fired_at är händelsens tidsstämpel (för att mäta kötiden).
+
+        limit_id behövs bara för att läsa gränsen från en annan entitet än den konfigurerade
+        (t.ex. via tjänsten run_peak_guard). Annars används det cachade gränsvärdet.
+
+        Utvärderingen körs i steg där de billigaste kommer först. Varje steg kan avsluta
+        utvärderingen, och de flesta händelser (tyst läge) stoppas i det tysta filtret
+        innan SoC läses och själva besluten fattas.
+        """
+        started = time.perf_counter()
+        timing, token = self.watchdog.start(queue_delay_since(fired_at))
+        self.pipeline_stats["evaluations"] += 1
+        snapshot = None
         try:
-            # 0. Kontrollera om Peak Shaving är aktivt
-            is_active = True
-            if self.coordinator.data:
-                is_active = self.coordinator.data.get("is_peak_shaving_active", True)
-                pg_status = self.coordinator.data.get("peakguard_status")
-                if pg_status and pg_status != "Active":
-                    is_active = False
-
-            # Om PeakGuard är inaktiverat från backend, avbryt all lokal styrning.
-            if not is_active:
-                # Stäng av eventuell pågående peak-hantering
-                if self.is_active:
-                    _LOGGER.info("PeakGuard is disabled by backend. Clearing active peak.")
-                    self._set_reported_state(False)
-                # Stäng av eventuell pågående solar override
-                if self.is_solar_override:
-                    _LOGGER.info("🌑 PeakGuard is disabled by backend. Deactivating Solar Override.")
-                    self._is_solar_override = False
-                    self.coordinator.async_update_listeners()
-                return
-
-            # 0.1 Kontrollera Batteristatus (Maintenance/Full Charge)
-            status_entity = self.config.get(CONF_BATTERY_STATUS_SENSOR)
-            if status_entity:
-                status_state = self.hass.states.get(status_entity)
-
-                # SÄKERHET: Om sensorn inte är redo (t.ex. vid uppstart), avvakta med beslut.
-                if not status_state or status_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-                    _LOGGER.debug(f"Status sensor {status_entity} is unavailable/unknown. Skipping update.")
-                    return
-
-                # Hämta nyckelord från config (eller använd default)
-                keywords_str = self.config.get(CONF_BATTERY_STATUS_KEYWORDS)
-                # Fallback om konfigurationen är tom eller saknas
-                if not keywords_str or not str(keywords_str).strip():
-                    keywords_str = DEFAULT_BATTERY_STATUS_KEYWORDS
-
-                keywords = [k.strip().lower() for k in keywords_str.split(",") if k.strip()]
-
-                val_display = str(status_state.state)
-
-                # Ignorera tomma värden för att undvika fladder
-                if not val_display or not val_display.strip():
-                    return
-
-                val_lower = val_display.lower()
-
-                # Debug-loggning för att spåra matchningen
-                _LOGGER.debug(f"Maintenance check: Status='{val_lower}' Keywords={keywords}")
-
-                if any(k in val_lower for k in keywords):
-                    self._maintenance_cooldown_start = None # Återställ cooldown om vi ser signalen igen
-                    if not self._in_maintenance:
-                        _LOGGER.info(f"🔋 Maintenance mode detected ({val_display}). Pausing control.")
-                        self._in_maintenance = True
-                        self.coordinator.async_update_listeners()
-
-                    self._maintenance_reason = val_display
-
-                    if self.is_active:
-                        self._set_reported_state(False)
-                    return
-                elif self._in_maintenance:
-                    # Signalen är borta, men vi väntar lite (debounce) för att undvika fladder
-                    if self._maintenance_cooldown_start is None:
-                        self._maintenance_cooldown_start = dt_util.utcnow()
-                        _LOGGER.debug(f"Maintenance signal lost (Status: {val_display}). Starting 60s cooldown.")
-                        return
-
-                    if dt_util.utcnow() - self._maintenance_cooldown_start < timedelta(seconds=60):
-                        return
-
-                    _LOGGER.info(f"🔋 Maintenance mode ended. Status is '{val_display}'. Resuming control.")
-                    self._in_maintenance = False
-                    self._maintenance_reason = None
-                    self._maintenance_cooldown_start = None
-                    self.coordinator.async_update_listeners()
-
-            # 1. Hämta Gränsvärdet
-            limit_state = self.hass.states.get(limit_id)
-            if not limit_state or limit_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-                return
-
-            raw_limit = float(limit_state.state)
-            limit_w = raw_limit * 1000 if raw_limit < 100 else raw_limit
-
-            # Skydd: Om gränsvärdet är orimligt lågt (t.ex. 0), avbryt.
-            if limit_w < 100:
-                _LOGGER.warning(f"Peak limit is too low ({limit_w} W). Ignoring to prevent false triggering.")
-                return
-
-            # 2. Hämta Lasten
-            current_load = 0.0
-            if virtual_load_id:
-                # Använd manuellt vald sensor
-                load_state = self.hass.states.get(virtual_load_id)
-                if not load_state or load_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-                    return
-                current_load = float(load_state.state)
+            if self.shadow is not None:
+                with self.shadow.record(virtual_load_id, limit_id) as snapshot:
+                    await self._evaluate(virtual_load_id, limit_id)
             else:
-                # Beräkna automatiskt: Grid + Batteri
-                grid_id = self.config.get(CONF_GRID_SENSOR)
-                bat_id = self.config.get(CONF_BATTERY_POWER_SENSOR)
-
-                grid_state = self.hass.states.get(grid_id)
-                bat_state = self.hass.states.get(bat_id)
-
-                grid_val = (
-                    float(grid_state.state)
-                    if grid_state and grid_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]
-                    else 0.0
+                await self._evaluate(virtual_load_id, limit_id)
+        except Exception as e:
+            _LOGGER.error(f"Error in PeakGuard update: {e}", exc_info=True)
+        finally:
+            self._account_energy()
+            if self._last_load_w is not None:
+                self.hourly.sample(
+                    self._last_load_w, self._has_reported, self.energy.total_kwh(METER_PEAK_SHAVED), dt_util.utcnow()
                 )
-                bat_val = (
-                    float(bat_state.state)
-                    if bat_state and bat_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]
-                    else 0.0
+            self.update_latency.observe(time.perf_counter() - started)
+            self.watchdog.finish(timing, token)
+        if snapshot is not None:
+            # Skuggan efter det riktiga beslutet, med samma indata och utanför tidmätningen
+            await self.shadow.async_evaluate(snapshot)
+
+    async def _evaluate(self, virtual_load_id, limit_id=None):
+        """Steg 1-5. Returnerar namnet på steget där utvärderingen avslutades.
+
+        Används både av update() och av tjänsten dry_run (på en kopia utan sidoeffekter).
+        """
+        # Steg 1: Är Peak Shaving aktivt från molnet?
+        if not self._stage_backend_enabled():
+            self.pipeline_stats["backend_disabled"] += 1
+            return "backend"
+
+        # Steg 2: Batteristatus (Maintenance). Tolkas bara om status-sensorn har ändrats.
+        if not self._stage_status():
+            return "status"
+
+        # Steg 3: Gränsvärde och last (tolkade värden cachas per state)
+        inputs = self._stage_inputs(virtual_load_id, limit_id)
+        if inputs is None:
+            return "inputs"
+        limit_w, current_load, phases = inputs
+
+        data = self.coordinator.data
+        cloud_action = data.action if data is not None else Action.HOLD
+        if cloud_action is not self._last_cloud_action:
+            self._last_cloud_action = cloud_action
+            if not self._has_reported:
+                # Ett väntande kommando hör till molnets förra läge (t.ex. stopp vid HOLD) och ska inte skickas om
+                self.actuation.cancel()
+
+        # Steg 4: Tyst filter
+        if self._stage_quiet_filter(limit_w, current_load, cloud_action, phases):
+            self.pipeline_stats["quiet"] += 1
+            return "quiet"
+
+        # Steg 5: Besluten
+        self.pipeline_stats["decision"] += 1
+        await self._stage_decide(current_load, limit_w, cloud_action, phases)
+        return "decision"
+
+    def _account_energy(self):
+        """Uppdaterar energimätarna med effekten just nu. Billigt i tyst läge (inga läsningar)."""
+        discharge_w = shaved_w = solar_w = 0.0
+        if self._has_reported or self._is_solar_override:
+            bat_w = None
+            try:
+                bat_w = self._read_float(self.config.get(CONF_BATTERY_POWER_SENSOR))
+            except ValueError:
+                pass
+            if self._has_reported:
+                # Batteriets faktiska urladdning (eller beordrad effekt om batterisensor saknas)
+                discharge_w = max(0.0, bat_w) if bat_w is not None else self._peak_discharge_w
+                # Den del av toppen som inte gick till nätet
+                shaved_w = min(self._peak_need_w, discharge_w)
+            elif bat_w is not None:
+                # Solar override: laddning (negativ effekt) är solel som annars hade exporterats
+                solar_w = max(0.0, -bat_w)
+        self.energy.sample(discharge_w, shaved_w, solar_w)
+
+    def _read_float(self, entity_id):
+        """Läser ett numeriskt state (None om det saknas eller är unknown/unavailable).
+
+        Tolkningen cachas per entitet och återanvänds så länge state-objektet är detsamma.
+        Ogiltiga värden ger ValueError, precis som float().
+        """
+        state = self._get_state(entity_id)
+        if state is None:
+            return None
+        raw = state.state
+        cached = self._float_cache.get(entity_id)
+        if cached is not None and cached[0] is state and cached[1] == raw:
+            return cached[2]
+        value = None if raw in (STATE_UNKNOWN, STATE_UNAVAILABLE) else float(raw)
+        self._float_cache[entity_id] = (state, raw, value)
+        return value
+
+    def _stage_backend_enabled(self):
+        """Steg 1: Returnerar False om PeakGuard är avstängt från backend (och stänger av lokal styrning)."""
+        data = self.coordinator.data
+        if data is None or data.peak_guard_enabled:
+            return True
+
+        # Om PeakGuard är inaktiverat från backend, avbryt all lokal styrning.
+        # Stäng av eventuell pågående peak-hantering
+        if self.is_active:
+            _LOGGER.info("PeakGuard is disabled by backend. Clearing active peak.")
+            self._set_reported_state(False)
+        # Stäng av eventuell pågående solar override
+        if self.is_solar_override:
+            _LOGGER.info("🌑 PeakGuard is disabled by backend. Deactivating Solar Override.")
+            self._is_solar_override = False
+            self._async_notify_listeners()
+        return False
+
+    def _stage_status(self):
+        """Steg 2: Kontrollerar batteristatus (Maintenance/Full Charge). Returnerar False om vi ska avbryta."""
+        status_entity = self.config.get(CONF_BATTERY_STATUS_SENSOR)
+        if not status_entity:
+            return True
+
+        status_state = self._get_state(status_entity)
+
+        # SÄKERHET: Om sensorn inte är redo (t.ex. vid uppstart), avvakta med beslut.
+        if not status_state or status_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
+            _LOGGER.debug(f"Status sensor {status_entity} is unavailable/unknown. Skipping update.")
+            self.pipeline_stats["status_unavailable"] += 1
+            return False
+
+        val_display = str(status_state.state)
+
+        # Ignorera tomma värden för att undvika fladder
+        if not val_display or not val_display.strip():
+            self.pipeline_stats["status_unavailable"] += 1
+            return False
+
+        # Samma status som förra gången och ingen nedräkning pågår: utfallet är detsamma,
+        # så nyckelorden behöver inte tolkas igen.
+        if val_display == self._last_status_value and self._maintenance_cooldown_start is None:
+            self.pipeline_stats["status_cached"] += 1
+            if self._in_maintenance:
+                self.pipeline_stats["maintenance"] += 1
+                return False
+            return True
+        self._last_status_value = val_display
+
+        # Hämta nyckelord från config (eller använd default)
+        keywords_str = self.config.get(CONF_BATTERY_STATUS_KEYWORDS)
+        # Fallback om konfigurationen är tom eller saknas
+        if not keywords_str or not str(keywords_str).strip():
+            keywords_str = DEFAULT_BATTERY_STATUS_KEYWORDS
+
+        keywords = [k.strip().lower() for k in keywords_str.split(",") if k.strip()]
+
+        val_lower = val_display.lower()
+
+        # Debug-loggning för att spåra matchningen
+        _LOGGER.debug(f"Maintenance check: Status='{val_lower}' Keywords={keywords}")
+
+        if any(k in val_lower for k in keywords):
+            if self._maintenance_cooldown_start is not None:
+                # Signalen kom tillbaka under nedräkningen (fladder): motbevis i stället för nollställning
+                self.maintenance_detector.penalize(self.maintenance_detector.threshold)
+                self._trace("maintenance_flap", "cusum", self.maintenance_detector)
+            self._maintenance_cooldown_start = None # Återställ cooldown om vi ser signalen igen
+            if not self._in_maintenance or self._maintenance_reason != val_display:
+                if not self._in_maintenance:
+                    _LOGGER.info(f"🔋 Maintenance mode detected ({val_display}). Pausing control.")
+                    self.maintenance_detector.reset()
+                self._in_maintenance = True
+                self._maintenance_reason = val_display
+                self._async_notify_listeners()
+
+            if self.is_active:
+                self._set_reported_state(False)
+            self.pipeline_stats["maintenance"] += 1
+            return False
+        elif self._in_maintenance:
+            # Signalen är borta, men vi väntar tills bevisen räcker (CUSUM) för att undvika fladder
+            now = dt_util.utcnow()
+            if self._maintenance_cooldown_start is None:
+                self._maintenance_cooldown_start = now
+                _LOGGER.debug(
+                    f"Maintenance signal lost (Status: {val_display}). Waiting for "
+                    f"{self.maintenance_detector.threshold - self.maintenance_detector.score:.0f}s of normal status."
                 )
+            # En sekund med normal status = en sekund bevis
+            if not self.maintenance_detector.update(1.0, now):
+                self.pipeline_stats["maintenance"] += 1
+                return False
+
+            _LOGGER.info(f"🔋 Maintenance mode ended. Status is '{val_display}'. Resuming control.")
+            self._trace(
+                "maintenance_end", "cusum", self.maintenance_detector,
+                elapsed_s=(now - self._maintenance_cooldown_start).total_seconds(),
+            )
+            self.maintenance_detector.reset()
+            self._in_maintenance = False
+            self._maintenance_reason = None
+            self._maintenance_cooldown_start = None
+            self._async_notify_listeners()
+        return True
+
+    def _stage_inputs(self, virtual_load_id, limit_id):
+        """Steg 3: Returnerar (gräns W, last W, faser), eller None om värdena inte går att använda.
+
+        Faserna är None om inga fas-sensorer är konfigurerade (eller om ingen har ett värde).
+        """
+        # 1. Hämta Gränsvärdet (cachat, uppdateras när källan ändras)
+        if limit_id and limit_id != self.limit.entity_id:
+            limit_w = state_to_watts(self._get_state(limit_id))
+        else:
+            limit_w = self.limit.value_w()
+        if limit_w is None:
+            self.pipeline_stats["inputs_unavailable"] += 1
+            return None
+
+        # Skydd: Om gränsvärdet är orimligt lågt (t.ex. 0), avbryt.
+        if limit_w < 100:
+            _LOGGER.warning(f"Peak limit is too low ({limit_w} W). Ignoring to prevent false triggering.")
+            self.pipeline_stats["inputs_unavailable"] += 1
+            return None
+
+        # 2. Hämta Lasten
+        if virtual_load_id:
+            # Använd manuellt vald sensor
+            current_load = self._read_float(virtual_load_id)
+            if current_load is None:
+                self.pipeline_stats["inputs_unavailable"] += 1
+                return None
+        else:
+            # Beräkna automatiskt: Grid + Batteri
+            grid_val = self._read_float(self.config.get(CONF_GRID_SENSOR)) or 0.0
+            bat_val = self._read_float(self.config.get(CONF_BATTERY_POWER_SENSOR)) or 0.0
+
+            if self.config.get(CONF_GRID_SENSOR_INVERT, False):
+                grid_val = -grid_val
+
+            current_load = grid_val + bat_val
+
+        self._last_load_w = current_load
+        return limit_w, current_load, self._read_phases()
+
+    def _read_phases(self):
+        """Läser fas-sensorerna och räknar fram marginalen mot huvudsäkringen (en genomgång)."""
+        if not self.phase_sensors:
+            return None
+        currents = {}
+        for phase, entity_id in self.phase_sensors.items():
+            try:
+                current = state_to_amps(self._get_state(entity_id))
+            except ValueError:
+                current = None
+            if current is not None:
+                currents[phase] = current
+        if not currents:
+            return None
+        battery_w = 0.0
+        try:
+            battery_w = self._read_float(self.config.get(CONF_BATTERY_POWER_SENSOR)) or 0.0
+        except ValueError:
+            pass
+        self.last_phases = evaluate_phases(currents, self.main_fuse_a, self.inverter_phases, battery_w)
+        return self.last_phases
+
+    def deadband_generation(self):
+        """Det som dödbandsfiltrets gränser bygger på: gränskällan, schemat och molnets senaste data.
+
+        När något av dem ändras (t.ex. en lägre gräns medan lasten står still) börjar filtret om.
+        """
+        self.limit.value_w()  # Uppdaterar schemat (och källan när den inte bevakas)
+        schedule = self.limit.schedule
+        return (
+            self.limit.refresh_count,
+            schedule.transitions if schedule is not None else 0,
+            self.coordinator.data,
+        )
 
-                if self.config.get(CONF_GRID_SENSOR_INVERT, False):
-                    grid_val = -grid_val
+    def deadband_thresholds(self, entity_id):
+        """Beslutsgränser för dödbandsfiltret, uttryckta i entitetens egna värden (W).
+
+        Returnerar None (alla händelser utvärderas) under en topp, vid solar override, när en
+        timer väntar (solar-verifiering eller underhålls-cooldown) och när molnet vill ladda.
+        """
+        if (
+            self._has_reported
+            or self._is_solar_override
+            or self._solar_override_trigger_start is not None
+            or self.solar_detector.pending
+            or self._maintenance_cooldown_start is not None
+        ):
+            return None
+        if self.coordinator.data is not None and self.coordinator.data.action is Action.CHARGE:
+            return None
 
-                current_load = grid_val + bat_val
+        try:
+            limit_w = self.limit.value_w()
+            if limit_w is None:
+                return None
+            # Gränserna för lasten: topp, väckning (tyst filter), hysteres, export och solar override
+            load_thresholds = (limit_w, limit_w * 0.90, limit_w - 1000, -200.0, SOLAR_TRIGGER_W, SOLAR_RESET_W)
 
-            # --- TYST FILTER ---
-            wake_up_threshold = limit_w * 0.90
+            virtual_load_id = self.config.get(CONF_VIRTUAL_LOAD_SENSOR)
+            if virtual_load_id:
+                return load_thresholds if entity_id == virtual_load_id else None
+
+            # Last = grid (ev. inverterad) + batteri
+            sign = -1.0 if self.config.get(CONF_GRID_SENSOR_INVERT, False) else 1.0
+            if entity_id == self.config.get(CONF_GRID_SENSOR):
+                bat_val = self._read_float(self.config.get(CONF_BATTERY_POWER_SENSOR)) or 0.0
+                # Import över 100 W blockerar solar override
+                return [sign * (t - bat_val) for t in load_thresholds] + [sign * 100.0]
+            if entity_id == self.config.get(CONF_BATTERY_POWER_SENSOR):
+                grid_val = sign * (self._read_float(self.config.get(CONF_GRID_SENSOR)) or 0.0)
+                # Batteriet rör sig (±100 W) och laddar ur (solar override)
+                return [t - grid_val for t in load_thresholds] + [
+                    100.0, -100.0, BATTERY_DISCHARGE_THRESHOLD_W
+                ]
+        except ValueError:
+            return None
+        return None
+
+    def _battery_is_moving(self):
+        """Kontrollera om batteriet rör på sig (för att kunna tvinga stopp vid HOLD)."""
+        bat_entity = self.config.get(CONF_BATTERY_POWER_SENSOR)
+        if not bat_entity:
+            return False
+        try:
+            bat_power = self._read_float(bat_entity)
+        except ValueError:
+            return False
+        return bat_power is not None and abs(bat_power) > 100
+
+    async def _check_uncovered_phases(self, phases, current_load, limit_w):
+        """Varnar (en gång) om en överlastad fas inte matas av växelriktaren. Batteriet kan inte hjälpa."""
+        if phases is None or not phases.uncovered:
+            self._phase_uncovered_logged = False
+            return
+        if self._phase_uncovered_logged:
+            return
+        self._phase_uncovered_logged = True
+        _LOGGER.warning(
+            f"Phase overload on {', '.join(phases.uncovered)} "
+            f"({', '.join(f'{phases.virtual_a[p]:.1f} A' for p in phases.uncovered)} > {phases.fuse_a:.0f} A). "
+            f"The battery inverter feeds {', '.join(self.inverter_phases)} and cannot relieve it."
+        )
+        await self._report_peak_failure(current_load, limit_w)
+
+    def _trace(self, event, decided_by, detector, **details):
+        """Sparar ett lägesbyte i beslutsspåret (diagnostik)."""
+        entry = {"time": dt_util.utcnow().isoformat(), "event": event, "decided_by": decided_by}
+        entry.update(detector.as_dict())
+        entry.update({k: round(v, 1) if isinstance(v, float) else v for k, v in details.items()})
+        self.decision_trace.append(entry)
+
+    def _solar_verify_seconds(self, current_load):
+        """Verifieringstid (s) för solar override.
+
+        Kortas av när både solcellernas effekt och prognosen räcker till hela exporten, dvs.
+        exporten kan förklaras av solen (och inte t.ex. av sensor-lag från batteriet). Även
+        då måste exporten hålla i sig en stund (minst SOLAR_FORECAST_MIN_VERIFY_S).
+        Annars gäller 30 s som tidigare.
+        """
+        pv_entity = self.config.get(CONF_PV_POWER_SENSOR)
+        forecast_entity = self.config.get(CONF_PV_FORECAST_SENSOR)
+        if not pv_entity or not forecast_entity:
+            return SOLAR_VERIFY_S
+        try:
+            pv_w = state_to_watts(self._get_state(pv_entity))
+            forecast_w = state_to_watts(self._get_state(forecast_entity))
+        except ValueError:
+            return SOLAR_VERIFY_S
+        if pv_w is None or forecast_w is None:
+            return SOLAR_VERIFY_S
+
+        # Exporten (lasten är negativ vid export) ska rymmas i både solelen och prognosen
+        export_w = -current_load
+        if pv_w >= export_w and forecast_w >= export_w:
+            verify_s = float(self.config.get(CONF_SOLAR_FORECAST_VERIFY_S, DEFAULT_SOLAR_FORECAST_VERIFY_S))
+            return min(max(verify_s, SOLAR_FORECAST_MIN_VERIFY_S), SOLAR_VERIFY_S)
+        return SOLAR_VERIFY_S
+
+    def _stage_quiet_filter(self, limit_w, current_load, cloud_action, phases=None):
+        """Steg 4: TYST FILTER. Returnerar True om inget behöver göras.
+
+        Avbryt bara om:
+        1. Ingen peak är aktiv.
+        2. Ingen Solar Override är aktiv (vi måste kunna stänga av den).
+        3. Lasten är under varningsgränsen (90 % av gränsen).
+        4. Vi INTE exporterar (för då måste vi kolla Solar Override).
+        5. Vi INTE laddar (för då måste vi kolla säkringen).
+        6. Ingen fas ligger över 90 % av huvudsäkringen.
+        7. Vi INTE behöver tvinga stopp (HOLD + Battery Moving).
+        Batteriets effekt läses sist, och bara när molnet säger HOLD.
+        """
+        if self._has_reported or self._is_solar_override or self.solar_detector.pending:
+            return False
+        if current_load >= limit_w * 0.90 or current_load <= -200 or cloud_action is Action.CHARGE:
+            return False
+        if phases is not None and phases.utilization >= 0.90:
+            return False
+        return not (cloud_action is Action.HOLD and self._battery_is_moving())
+
+    async def _stage_decide(self, current_load, limit_w, cloud_action, phases=None):
+        """Steg 5: Hysteres, urladdning, solar override och molnstrategi.
+
+        Med fas-sensorer styrs urladdning och laddning av det som är mest begränsande:
+        den totala gränsen eller den mest belastade fasen som växelriktaren matar.
+        """
+        # Hämta SoC
+        soc = self._read_float(self.config.get(CONF_SOC_SENSOR)) or 0
+
+        # Gränser
+        safe_limit = limit_w - 1000
+        # Fasernas behov i W för växelriktaren (> 0 = en fas ligger över säkringen)
+        phase_excess_w = phases.excess_w if phases is not None else float("-inf")
+        await self._check_uncovered_phases(phases, current_load, limit_w)
+
+        # --- NY LOGIK MED HYSTERES ---
+
+        # 1. Bestäm tillstånd (På / Av)
+        if not self._has_reported and (current_load > limit_w or phase_excess_w > 0) and soc > 0:
+            # Bara en överskriden effektgräns rapporteras som topp. En överlastad fas har en egen händelse.
+            self._phase_only_peak = current_load <= limit_w
+            self._set_reported_state(True)
+            if not self._phase_only_peak:
+                _LOGGER.info(f"🚨 PEAK DETECTED! Load: {current_load} W > Limit: {limit_w} W. Engaging battery.")
+                await self._report_peak(current_load, limit_w)
+            else:
+                _LOGGER.info(
+                    f"🚨 PHASE OVERLOAD! {phases.worst_phase}: {phases.virtual_a[phases.worst_phase]:.1f} A > "
+                    f"Fuse: {phases.fuse_a:.0f} A. Engaging battery."
+                )
+                await self._report_phase_overload(current_load, limit_w)
 
-            # Hämta moln-action tidigt för att se om vi behöver övervaka laddning
-            cloud_action = "HOLD"
-            if self.coordinator.data and "action" in self.coordinator.data:
-                cloud_action = str(self.coordinator.data.get("action")).upper()
+        elif self._has_reported and current_load <= safe_limit and phase_excess_w <= -1000:
+            _LOGGER.info(f"✅ PEAK CLEARED. Load: {current_load} W. Returning to strategy.")
+            self._set_reported_state(False)
+            if self._phase_only_peak:
+                await self._report_phase_overload_clear(current_load, limit_w)
+            else:
+                await self._report_peak_clear(current_load, limit_w)
 
-            # Kontrollera om batteriet rör på sig (för att kunna tvinga stopp vid HOLD)
-            bat_is_moving = False
+        # 2. Agera baserat på tillstånd
+        if self._has_reported and soc > 0:
+            # TILLSTÅND PÅ: Justera urladdning
+            data = self.coordinator.data
+            max_inverter = data.max_discharge_w if data is not None else DEFAULT_MAX_DISCHARGE_KW * 1000.0
+
+            # Den mest begränsande av total gräns och värsta fasen bestämmer
+            need = max(current_load - limit_w, phase_excess_w)
+
+            # Detektera om vi inte klarar att hålla gränsen
+            if need > max_inverter:
+                if not self._capacity_exceeded_logged:
+                    _LOGGER.warning(
+                        f"PeakGuard capacity exceeded! Need: {need} W > Max: {max_inverter} W. "
+                        f"Limit {limit_w} W cannot be held."
+                    )
+                    self._capacity_exceeded_logged = True
+                    await self._report_peak_failure(current_load, limit_w)
+
+            power_to_discharge = min(max(0, need), max_inverter)
+            self._peak_need_w = max(0.0, need)
+            self._peak_discharge_w = float(power_to_discharge)
+
+            if power_to_discharge > 100:  # Skicka bara kommando om det finns ett verkligt behov
+                await self._call_script("sonnen_force_discharge", {"power": int(power_to_discharge)})
+                self._last_sent_command = "PEAK"
+
+        else:
+            # TILLSTÅND AV: Återgå till molnstrategi
+            # cloud_action är redan hämtad ovan
+
+            # --- SOLAR OVERRIDE ---
+            current_bat_power = 0.0
             bat_entity = self.config.get(CONF_BATTERY_POWER_SENSOR)
             if bat_entity:
-                b_state = self.hass.states.get(bat_entity)
+                b_state = self._get_state(bat_entity)
                 if b_state and b_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
                     try:
-                        if abs(float(b_state.state)) > 100:
-                            bat_is_moving = True
+                        current_bat_power = float(b_state.state)
                     except ValueError:
                         pass
 
-            # Avbryt bara om:
-            # 1. Ingen peak är aktiv.
-            # 2. Ingen Solar Override är aktiv (vi måste kunna stänga av den).
-            # 3. Lasten är under varningsgränsen.
-            # 4. Vi INTE exporterar (för då måste vi kolla Solar Override).
-            # 5. Vi INTE laddar (för då måste vi kolla säkringen).
-            # 6. Vi INTE behöver tvinga stopp (HOLD + Battery Moving).
-            if (
-                not self._has_reported
-                and not self._is_solar_override
-                and current_load < wake_up_threshold
-                and current_load > -200
-                and cloud_action != "CHARGE"
-                and not (cloud_action == "HOLD" and bat_is_moving)
-            ):
-                return
-
-            # 3. Hämta SoC
-            soc_entity = self.config.get(CONF_SOC_SENSOR)
-            soc_state = self.hass.states.get(soc_entity)
-            soc = (
-                float(soc_state.state)
-                if soc_state and soc_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]
-                else 0
-            )
-
-            # 4. Gränser
-            safe_limit = limit_w - 1000
-
-            # --- NY LOGIK MED HYSTERES ---
-
-            # Steg 1: Bestäm tillstånd (På / Av)
-            if is_active and not self._has_reported and current_load > limit_w and soc > 0:
-                _LOGGER.info(f"🚨 PEAK DETECTED! Load: {current_load} W > Limit: {limit_w} W. Engaging battery.")
-                self._set_reported_state(True)
-                await self._report_peak(current_load, limit_w)
+            # --- EXTRA SÄKERHETSKONTROLL (Natt/Buffer Fill & Sensor Lag) ---
+            is_importing = False
+            grid_id = self.config.get(CONF_GRID_SENSOR)
+            if grid_id:
+                g_state = self._get_state(grid_id)
+                if g_state and g_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
+                    try:
+                        g_val = float(g_state.state)
+                        if self.config.get(CONF_GRID_SENSOR_INVERT, False):
+                            g_val = -g_val
 
-            elif self._has_reported and current_load <= safe_limit:
-                _LOGGER.info(f"✅ PEAK CLEARED. Load: {current_load} W. Returning to strategy.")
-                self._set_reported_state(False)
-                await self._report_peak_clear(current_load, limit_w)
+                        # Om importen är större än 100W är vi garanterat inte i ett rent solel-scenario.
+                        if g_val > 100:
+                            is_importing = True
+                    except ValueError:
+                        pass
 
-            # Steg 2: Agera baserat på tillstånd
-            if self._has_reported and soc > 0:
-                # TILLSTÅND PÅ: Justera urladdning
-                max_inverter = 3300.0
-                if self.coordinator.data and "max_discharge_kw" in self.coordinator.data:
-                    val = self.coordinator.data.get("max_discharge_kw")
-                    if val is not None:
-                        max_inverter = float(val) * 1000.0
-
-                need = current_load - limit_w
-
-                # Detektera om vi inte klarar att hålla gränsen
-                if need > max_inverter:
-                    if not self._capacity_exceeded_logged:
-                        _LOGGER.warning(
-                            f"PeakGuard capacity exceeded! Need: {need} W > Max: {max_inverter} W. "
-                            f"Limit {limit_w} W cannot be held."
+            # Beräkna önskat läge baserat på last (oberoende av moln-status)
+            wants_override = self._is_solar_override
+            detection = None  # (orsak, verifieringstid, kortad) när bevisen räcker för att aktivera
+
+            if current_bat_power > BATTERY_DISCHARGE_THRESHOLD_W:
+                # Om batteriet laddar ur (>200W) är det batteriet som skapar exporten, inte solen.
+                wants_override = False
+                self._solar_override_trigger_start = None
+                self.solar_detector.reset()
+            elif current_load < SOLAR_TRIGGER_W and not is_importing:
+                if not self._is_solar_override:
+                    # Samla bevis för att exporten håller i sig (filtrerar bort sensor-lag). Ett tydligt
+                    # överskott räcker snabbt, annars gäller högst 30 sekunder. Om solcellerna och
+                    # prognosen bekräftar överskottet räcker en kortare tid.
+                    now = dt_util.utcnow()
+                    verify_s = self._solar_verify_seconds(current_load)
+                    if self._solar_override_trigger_start is None:
+                        self._solar_override_trigger_start = now
+                        _LOGGER.debug(
+                            f"☀️ Potential Solar Override detected (Load: {current_load} W). "
+                            f"Waiting up to {verify_s}s to verify."
                         )
-                        self._capacity_exceeded_logged = True
-                        await self._report_peak_failure(current_load, limit_w)
-
-                power_to_discharge = min(max(0, need), max_inverter)
-
-                if power_to_discharge > 100:  # Skicka bara kommando om det finns ett verkligt behov
-                    await self._call_script("sonnen_force_discharge", {"power": int(power_to_discharge)})
-                    self._last_sent_command = "PEAK"
-
-            else:
-                # TILLSTÅND AV: Återgå till molnstrategi
-                # cloud_action är redan hämtad ovan
-
-                # --- SOLAR OVERRIDE ---
-                current_bat_power = 0.0
-                bat_entity = self.config.get(CONF_BATTERY_POWER_SENSOR)
-                if bat_entity:
-                    b_state = self.hass.states.get(bat_entity)
-                    if b_state and b_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-                        try:
-                            current_bat_power = float(b_state.state)
-                        except ValueError:
-                            pass
-
-                # --- EXTRA SÄKERHETSKONTROLL (Natt/Buffer Fill & Sensor Lag) ---
-                is_importing = False
-                grid_id = self.config.get(CONF_GRID_SENSOR)
-                if grid_id:
-                    g_state = self.hass.states.get(grid_id)
-                    if g_state and g_state.state not in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-                        try:
-                            g_val = float(g_state.state)
-                            if self.config.get(CONF_GRID_SENSOR_INVERT, False):
-                                g_val = -g_val
-
-                            # Om importen är större än 100W är vi garanterat inte i ett rent solel-scenario.
-                            if g_val > 100:
-                                is_importing = True
-                        except ValueError:
-                            pass
-
-                # Beräkna önskat läge baserat på last (oberoende av moln-status)
-                wants_override = self._is_solar_override
-
-                if current_bat_power > BATTERY_DISCHARGE_THRESHOLD_W:
-                    # Om batteriet laddar ur (>200W) är det batteriet som skapar exporten, inte solen.
-                    wants_override = False
-                    self._solar_override_trigger_start = None
-                elif current_load < SOLAR_TRIGGER_W and not is_importing:
-                    if not self._is_solar_override:
-                        # Starta timer för att kräva att värdet hålls i 30 sekunder (filtrerar bort sensor-lag)
-                        if self._solar_override_trigger_start is None:
-                            self._solar_override_trigger_start = dt_util.utcnow()
-                            _LOGGER.debug(
-                                f"☀️ Potential Solar Override detected (Load: {current_load} W). "
-                                "Waiting 30s to verify."
-                            )
-                        elif dt_util.utcnow() - self._solar_override_trigger_start >= timedelta(seconds=30):
-                            wants_override = True
-                    else:
+                    detected = self.solar_detector.update(SOLAR_TRIGGER_W - current_load, now)
+                    elapsed = now - self._solar_override_trigger_start
+                    if detected or elapsed >= timedelta(seconds=verify_s):
                         wants_override = True
-                elif current_load > SOLAR_RESET_W or is_importing:
-                    wants_override = False
-                    self._solar_override_trigger_start = None
+                        reason = "cusum" if detected else ("forecast" if verify_s < SOLAR_VERIFY_S else "timer")
+                        detection = (reason, elapsed, verify_s < SOLAR_VERIFY_S)
                 else:
-                    # Inom hysteres-zonen (-400 till -100)
-                    if not self._is_solar_override:
-                        # Återställ timer om vi studsar upp över trigg-gränsen innan 30 sekunder har gått
-                        self._solar_override_trigger_start = None
+                    wants_override = True
+            elif current_load > SOLAR_RESET_W or is_importing:
+                wants_override = False
+                self._solar_override_trigger_start = None
+                self.solar_detector.reset()
+            else:
+                # Inom hysteres-zonen (-400 till -100)
+                if not self._is_solar_override:
+                    # Återställ timern om vi studsar upp över trigg-gränsen innan 30 sekunder har gått.
+                    # Bevisen nollställs inte, men minskar så länge exporten är för liten.
+                    self._solar_override_trigger_start = None
+                    self.solar_detector.update(SOLAR_TRIGGER_W - current_load, dt_util.utcnow())
 
-                new_override = False
+            new_override = False
 
-                if cloud_action == "HOLD":
+            if cloud_action is Action.HOLD:
+                new_override = wants_override
+            elif cloud_action is Action.IDLE:
+                # Om vi redan är i override, stanna kvar där för att undvika
+                # att backend pendlar mellan HOLD och IDLE när flaggan skickas.
+                if self._is_solar_override:
                     new_override = wants_override
-                elif cloud_action == "IDLE":
-                    # Om vi redan är i override, stanna kvar där för att undvika
-                    # att backend pendlar mellan HOLD och IDLE när flaggan skickas.
-                    if self._is_solar_override:
-                        new_override = wants_override
-                else:
-                    # CHARGE / DISCHARGE
-                    new_override = False
+            else:
+                # CHARGE / DISCHARGE
+                new_override = False
+
+            if new_override:
+                cloud_action = Action.IDLE  # Tvinga Auto-läge lokalt
+
+            if self._is_solar_override != new_override:
+                self._is_solar_override = new_override
+                self._async_notify_listeners()  # Uppdatera sensorer
 
                 if new_override:
-                    cloud_action = "IDLE"  # Tvinga Auto-läge lokalt
-
-                if self._is_solar_override != new_override:
-                    self._is_solar_override = new_override
-                    self.coordinator.async_update_listeners()  # Uppdatera sensorer
-
-                    if new_override:
-                        _LOGGER.info(f"☀️ Solar Override Activated. Load: {current_load} W. Enabling Auto Mode.")
-                        await self._report_solar_override(current_load, limit_w)
-                    else:
-                        _LOGGER.info(f"🌑 Solar Override Deactivated. Load: {current_load} W. Resuming Cloud Control.")
-                        await self._report_solar_override_clear(current_load, limit_w)
-
-                if cloud_action != "HOLD":
-                    self._hold_command_sent = False  # Återställ om molnet vill något annat
-
-                if cloud_action == "CHARGE":
-                    # Kontrollera att laddning inte överskrider gränsvärdet
-                    target_kw = 0.0
-                    if self.coordinator.data and "target_power_kw" in self.coordinator.data:
-                        target_kw = float(self.coordinator.data.get("target_power_kw", 0.0))
-
-                    target_w = target_kw * 1000.0
-                    # Marginal på 200W för att vara säker
-                    available_w = limit_w - current_load - 200.0
-
-                    if target_w > available_w:
-                        throttled_w = max(0, int(available_w))
-                        # Avrunda till närmaste 50W för att minska fladder
-                        throttled_w = int(throttled_w / 50) * 50
-
-                        _LOGGER.warning(
-                            f"⚠️ CHARGE THROTTLED! Cloud: {target_w} W. Available: {available_w:.0f} W. "
-                            f"Limit: {limit_w} W. Setting: {throttled_w} W."
+                    # Räkna och spåra bara när override faktiskt aktiveras. Under IDLE/CHARGE/DISCHARGE
+                    # ligger bevisen kvar tills molnet tillåter HOLD.
+                    if detection is not None:
+                        reason, elapsed, fast = detection
+                        if fast:
+                            self.solar_fast_engagements += 1
+                        self._trace(
+                            "solar_override_detected", reason, self.solar_detector,
+                            elapsed_s=elapsed.total_seconds(), load_w=current_load,
                         )
-                        await self._call_script("sonnen_force_charge", {"power": throttled_w})
-                        self._last_sent_command = "CHARGE"
-
-                elif cloud_action == "DISCHARGE":
-                    pass # Låt molnet bestämma
-
-                elif cloud_action == "HOLD":
-                    bat_entity = self.config.get(CONF_BATTERY_POWER_SENSOR)
-                    bat_state = self.hass.states.get(bat_entity)
-                    bat_power = 0
-                    if bat_state and bat_state.state not in [
-                        STATE_UNKNOWN,
-                        STATE_UNAVAILABLE,
-                    ]:
-                        bat_power = float(bat_state.state)
-
-                    if abs(bat_power) > 100:
-                        if not self._hold_command_sent:
-                            _LOGGER.debug("HOLD requested, but battery is active. Sending stop command.")
-                            await self._call_script("sonnen_force_charge", {"power": 0})
-                            self._hold_command_sent = True
-                            self._last_sent_command = "HOLD"
-                    else:
-                        # Batteriet är redan stilla, så nollställ flaggan.
-                        if self._hold_command_sent:
-                            _LOGGER.debug("Battery is now idle, resetting hold_command_sent flag.")
-                        self._hold_command_sent = False
-
-                elif cloud_action == "IDLE":
-                    if self._last_sent_command != "IDLE":
-                        await self._call_script("sonnen_set_auto_mode", {})
-                        self._last_sent_command = "IDLE"
-
+                        self.solar_detector.reset()
+                    _LOGGER.info(f"☀️ Solar Override Activated. Load: {current_load} W. Enabling Auto Mode.")
+                    await self._report_solar_override(current_load, limit_w)
                 else:
-                    pass  # Okänt läge -> Gör inget
-        except Exception as e:
-            _LOGGER.error(f"Error in PeakGuard update: {e}", exc_info=True)
+                    _LOGGER.info(f"🌑 Solar Override Deactivated. Load: {current_load} W. Resuming Cloud Control.")
+                    await self._report_solar_override_clear(current_load, limit_w)
+
+            if cloud_action is not Action.HOLD:
+                self._hold_command_sent = False  # Återställ om molnet vill något annat
+
+            if cloud_action is Action.CHARGE:
+                # Kontrollera att laddning inte överskrider gränsvärdet
+                data = self.coordinator.data
+                target_w = data.target_power_w if data is not None else 0.0
+                # Marginal på 200W för att vara säker. Med fas-sensorer gäller även den mest belastade fasen.
+                available_w = min(limit_w - current_load, -phase_excess_w) - 200.0
+
+                if target_w > available_w:
+                    throttled_w = max(0, int(available_w))
+                    # Avrunda till närmaste 50W för att minska fladder
+                    throttled_w = int(throttled_w / 50) * 50
+
+                    _LOGGER.warning(
+                        f"⚠️ CHARGE THROTTLED! Cloud: {target_w} W. Available: {available_w:.0f} W. "
+                        f"Limit: {limit_w} W. Setting: {throttled_w} W."
+                    )
+                    await self._call_script("sonnen_force_charge", {"power": throttled_w})
+                    self._last_sent_command = "CHARGE"
+
+            elif cloud_action is Action.DISCHARGE:
+                pass # Låt molnet bestämma
+
+            elif cloud_action is Action.HOLD:
+                bat_entity = self.config.get(CONF_BATTERY_POWER_SENSOR)
+                bat_state = self._get_state(bat_entity)
+                bat_power = 0
+                if bat_state and bat_state.state not in [
+                    STATE_UNKNOWN,
+                    STATE_UNAVAILABLE,
+                ]:
+                    bat_power = float(bat_state.state)
+
+                if abs(bat_power) > 100:
+                    if not self._hold_command_sent:
+                        _LOGGER.debug("HOLD requested, but battery is active. Sending stop command.")
+                        await self._call_script("sonnen_force_charge", {"power": 0})
+                        self._hold_command_sent = True
+                        self._last_sent_command = "HOLD"
+                else:
+                    # Batteriet är redan stilla, så nollställ flaggan.
+                    if self._hold_command_sent:
+                        _LOGGER.debug("Battery is now idle, resetting hold_command_sent flag.")
+                    self._hold_command_sent = False
+
+            elif cloud_action is Action.IDLE:
+                if self._last_sent_command != "IDLE":
+                    await self._call_script("sonnen_set_auto_mode", {})
+                    self._last_sent_command = "IDLE"
+
+            else:
+                pass  # Okänt läge -> Gör inget
 
     async def _report_peak(self, grid_w, limit_w):
-        try:
-            api_url = f"{self.config[CONF_API_URL].rstrip('/')}/report_peak"
-            payload = {
-                "api_key": self.config[CONF_API_KEY],
-                "grid_power_kw": round(grid_w / 1000.0, 2),
-                "limit_kw": round(limit_w / 1000.0, 2)
-            }
-            session = async_get_clientsession(self.hass)
-            async with session.post(api_url, json=payload, timeout=10) as resp:
-                if resp.status == 200:
-                    _LOGGER.debug(f"Cloud report sent: PeakGuard Triggered: {payload['grid_power_kw']} kW")
-        except Exception as e:
-            _LOGGER.error(f"Failed to report peak: {e}")
+        await self._send_report("report_peak", "PeakGuard Triggered", grid_w, limit_w)
 
     async def _report_peak_clear(self, grid_w, limit_w):
-        try:
-            api_url = f"{self.config[CONF_API_URL].rstrip('/')}/report_peak_clear"
-            payload = {
-                "api_key": self.config[CONF_API_KEY],
-                "grid_power_kw": round(grid_w / 1000.0, 2),
-                "limit_kw": round(limit_w / 1000.0, 2)
-            }
-            session = async_get_clientsession(self.hass)
-            async with session.post(api_url, json=payload, timeout=10) as resp:
-                if resp.status == 200:
-                    _LOGGER.debug(f"Cloud report sent: PeakGuard Cleared: {payload['grid_power_kw']} kW")
-        except Exception as e:
-            _LOGGER.error(f"Failed to report peak clear: {e}")
+        await self._send_report("report_peak_clear", "PeakGuard Cleared", grid_w, limit_w)
 
     async def _report_peak_failure(self, grid_w, limit_w):
-        try:
-            api_url = f"{self.config[CONF_API_URL].rstrip('/')}/report_peak_failure"
-            payload = {
-                "api_key": self.config[CONF_API_KEY],
-                "grid_power_kw": round(grid_w / 1000.0, 2),
-                "limit_kw": round(limit_w / 1000.0, 2)
-            }
-            session = async_get_clientsession(self.hass)
-            async with session.post(api_url, json=payload, timeout=10) as resp:
-                if resp.status == 200:
-                    _LOGGER.debug(f"Cloud report sent: PeakGuard Failure: {payload['grid_power_kw']} kW")
-        except Exception as e:
-            _LOGGER.error(f"Failed to report peak failure: {e}")
+        await self._send_report("report_peak_failure", "PeakGuard Failure", grid_w, limit_w)
+
+    async def _report_phase_overload(self, grid_w, limit_w):
+        await self._send_report("report_phase_overload", "Phase Overload", grid_w, limit_w)
+
+    async def _report_phase_overload_clear(self, grid_w, limit_w):
+        await self._send_report("report_phase_overload_clear", "Phase Overload Cleared", grid_w, limit_w)
 
     async def _report_solar_override(self, grid_w, limit_w):
-        try:
-            api_url = f"{self.config[CONF_API_URL].rstrip('/')}/report_solar_override"
-            payload = {
-                "api_key": self.config[CONF_API_KEY],
-                "grid_power_kw": round(grid_w / 1000.0, 2),
-                "limit_kw": round(limit_w / 1000.0, 2)
-            }
-            session = async_get_clientsession(self.hass)
-            async with session.post(api_url, json=payload, timeout=10) as resp:
-                if resp.status == 200:
-                    _LOGGER.debug(f"Cloud report sent: Solar Override: {payload['grid_power_kw']} kW")
-        except Exception as e:
-            _LOGGER.error(f"Failed to report solar override: {e}")
+        await self._send_report("report_solar_override", "Solar Override", grid_w, limit_w)
 
     async def _report_solar_override_clear(self, grid_w, limit_w):
+        await self._send_report("report_solar_override_clear", "Solar Override Cleared", grid_w, limit_w)
+
+    async def _send_report(self, endpoint, description, grid_w, limit_w):
+        """Lägger händelsen i kön som skickas med nästa /signal (eller direkt om det brådskar)."""
+        reports = self.coordinator.reports
+        started = time.perf_counter()
+        _LOGGER.debug(f"Cloud report queued: {description}: {round(grid_w / 1000.0, 2)} kW")
         try:
-            api_url = f"{self.config[CONF_API_URL].rstrip('/')}/report_solar_override_clear"
-            payload = {
-                "api_key": self.config[CONF_API_KEY],
-                "grid_power_kw": round(grid_w / 1000.0, 2),
-                "limit_kw": round(limit_w / 1000.0, 2)
-            }
-            session = async_get_clientsession(self.hass)
-            async with session.post(api_url, json=payload, timeout=10) as resp:
-                if resp.status == 200:
-                    _LOGGER.debug(f"Cloud report sent: Solar Override Cleared: {payload['grid_power_kw']} kW")
-        except Exception as e:
-            _LOGGER.error(f"Failed to report solar override clear: {e}")
+            if reports.enqueue(endpoint, grid_w, limit_w):
+                await reports.async_flush()
+        finally:
+            timing = current_timing()
+            if timing is not None:
+                timing.add(STAGE_REPORT, time.perf_counter() - started)
 
     async def _call_script(self, script_name, data):
-        await self.hass.services.async_call("script", script_name, service_data=data)
+        started = time.perf_counter()
+        error = None
+        try:
+            await self.actuator.async_send(script_name, data)
+            note_live_command(script_name, data)
+            self.actuation.expect(script_name, data)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            timing = current_timing()
+            if timing is not None:
+                timing.add(STAGE_SCRIPT, time.perf_counter() - started)
+            self.command_counts[(script_name, "error" if error else "ok")] += 1
+            self.command_history.append({
+                "time": dt_util.utcnow().isoformat(),
+                "script": script_name,
+                "data": data,
+                "error": error,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            })
+
+    def diagnostics(self):
+        """Returnerar PeakGuards diagnostikdata."""
+        return {
+            "is_active": self._has_reported,
+            "is_solar_override": self._is_solar_override,
+            "in_maintenance": self._in_maintenance,
+            "maintenance_reason": self._maintenance_reason,
+            "last_sent_command": self._last_sent_command,
+            "update_latency": self.update_latency.as_dict(),
+            "command_history": list(self.command_history),
+            "watchdog": self.watchdog.diagnostics(),
+            "pipeline": dict(self.pipeline_stats),
+            "event_filter": self.event_filter.diagnostics() if self.event_filter else None,
+            "limit": self.limit.diagnostics(),
+            "solar_fast_engagements": self.solar_fast_engagements,
+            "detectors": {
+                "solar": self.solar_detector.as_dict(),
+                "maintenance": self.maintenance_detector.as_dict(),
+            },
+            "decision_trace": list(self.decision_trace),
+            "phases": self.last_phases.as_dict() if self.last_phases else None,
+            "energy_kwh": self.energy.diagnostics(),
+            "hourly_statistics": self.statistics_writer.diagnostics(),
+            "shadow": self.shadow.diagnostics() if self.shadow is not None else None,
+            "actuator": self.actuator.diagnostics(),
+            "actuation": self.actuation.diagnostics(),
+        }
 
 
 async def update_listener(hass, entry):
@@ -0,0 +1,267 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# actuation.py
+# Kvittens för batterikommandon: följer batteriet verkligen det PeakGuard begär?
+# Efter varje ur- eller laddkommando bevakas batteriets effektsensor tills effekten ligger
+# inom toleransen från den begärda. Tiden dit (kommando -> svar) och uppnådd effekt mot
+# begärd sparas i histogram. Svarar batteriet inte inom tidsgränsen skickas kommandot en
+# gång till, och därefter eskaleras det (varning i loggen och en händelse på HA:s buss).
+#
+# Den uppmätta svarstiden visas i en egen sensor och i diagnostiken, så att t.ex. hysteres
+# och tidsgränser kan ställas in efter hur snabbt just det här batteriet reagerar.
+
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+import homeassistant.util.dt as dt_util
+from homeassistant.core import callback # type: ignore
+from homeassistant.helpers.event import async_call_later, async_track_state_change_event # type: ignore
+from .const import DIAGNOSTICS_HISTORY_SIZE
+from .limit import state_to_watts
+from .metrics import LatencyHistogram, RatioHistogram
+
+_LOGGER = logging.getLogger(__name__)
+
+# Händelse på HA:s buss när batteriet inte följer ett kommando (för automationer och notiser)
+EVENT_ACTUATION_FAILED = "battery_optimizer_light_actuation_failed"
+
+# Hur länge batteriet får på sig att nå den begärda effekten (per försök)
+ACK_DEADLINE_S = 20.0
+# Antal omsändningar innan det eskaleras
+ACK_MAX_RETRIES = 1
+# Tolerans: det största av ett fast värde och en andel av den begärda effekten
+ACK_TOLERANCE_W = 150.0
+ACK_TOLERANCE_RATIO = 0.10
+# Utjämning av svarstiden (andel av senaste mätningen)
+LATENCY_SMOOTHING = 0.2
+
+# Svarstider i sekunder (ett batteri via moln/REST kan behöva flera sekunder)
+ACK_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# Kommandon med en begärd effekt och effektens tecken (urladdning positiv, som batterisensorn)
+TRACKED_COMMANDS = {"sonnen_force_discharge": 1.0, "sonnen_force_charge": -1.0}
+
+
+@dataclass(slots=True)
+class _Expectation:
+    command: str
+    data: dict
+    requested_w: float
+    sent_at: float
+    attempts: int = 1
+    last_w: float | None = None
+
+
+class ActuationTracker:
+    """Väntar in batteriets svar på PeakGuards kommandon.
+
+    resend(command, data): skickar om ett kommando (PeakGuard._call_script).
+    on_change(): anropas när svarstiden eller läget ändras (sensorerna uppdateras).
+    """
+
+    def __init__(self, hass, battery_entity, resend, on_change=None, clock=time.monotonic):
+        self.hass = hass
+        self.battery_entity = battery_entity
+        self._resend = resend
+        self._on_change = on_change
+        self._clock = clock
+        self.pending = None
+        self._cancel_deadline = None
+        self.latency = LatencyHistogram(ACK_LATENCY_BUCKETS)
+        self.achieved = RatioHistogram()
+        self.latency_s = None  # Utjämnad svarstid (None tills första kvittensen)
+        self.history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self._resending = False
+        self.stats = dict.fromkeys(
+            ("commands", "acknowledged", "retries", "escalations", "superseded", "cancelled"), 0
+        )
+
+    @callback
+    def async_track(self):
+        """Startar bevakning av batteriets effektsensor. Returnerar en funktion som stoppar den."""
+        if not self.battery_entity:
+            return None
+        unsub = async_track_state_change_event(self.hass, [self.battery_entity], self._handle_state_change)
+
+        @callback
+        def stop():
+            self._stop_deadline()
+            unsub()
+
+        return stop
+
+    @callback
+    def _handle_state_change(self, event):
+        try:
+            value_w = state_to_watts(event.data.get("new_state"))
+        except ValueError:
+            return
+        if value_w is not None:
+            self.observe(value_w)
+
+    # --- Kommandon ---
+
+    @callback
+    def expect(self, command, data):
+        """Anropas när ett kommando har skickats. Startar (eller förnyar) väntan på svaret."""
+        sign = TRACKED_COMMANDS.get(command)
+        pending = self.pending
+        initial = False
+        if pending is not None and pending.command == command:
+            if self._resending and pending.data == data:
+                pending.attempts += 1  # Omsändning efter tidsgränsen
+            else:
+                # Samma kommando med ny effekt (t.ex. varje utvärdering under en topp): tiden,
+                # försöken och tidsgränsen räknas fortfarande från det första kommandot
+                pending.data = dict(data)
+                pending.requested_w = sign * float(data.get("power", 0) or 0)
+        else:
+            if pending is not None:
+                self.stats["superseded"] += 1
+            self._stop_deadline()
+            self.pending = None
+            if sign is None:
+                return  # T.ex. autoläge: ingen bestämd effekt att vänta på
+            self.stats["commands"] += 1
+            requested_w = sign * float(data.get("power", 0) or 0)
+            self.pending = _Expectation(command, dict(data), requested_w, self._clock())
+            initial = True
+
+        if self._cancel_deadline is None:
+            self._cancel_deadline = async_call_later(self.hass, ACK_DEADLINE_S, self._async_deadline)
+        # Batteriet kan redan ligga på rätt effekt
+        try:
+            value_w = state_to_watts(self.hass.states.get(self.battery_entity)) if self.battery_entity else None
+        except ValueError:
+            value_w = None
+        if value_w is not None:
+            self.observe(value_w, initial=initial)
+
+    @callback
+    def cancel(self):
+        """PeakGuard skickar inte längre kommandot (toppen är över eller molnet vill något annat)."""
+        pending = self.pending
+        if pending is None:
+            return
+        self._stop_deadline()
+        self.pending = None
+        self.stats["cancelled"] += 1
+        self._record(pending, "cancelled", self._clock() - pending.sent_at)
+
+    @callback
+    def observe(self, value_w, initial=False):
+        """Ny mätning av batteriets effekt (W, urladdning positiv)."""
+        pending = self.pending
+        if pending is None:
+            return
+        pending.last_w = value_w
+        tolerance = max(ACK_TOLERANCE_W, abs(pending.requested_w) * ACK_TOLERANCE_RATIO)
+        if abs(value_w - pending.requested_w) > tolerance:
+            return
+        self._stop_deadline()
+        self.pending = None
+        elapsed = self._clock() - pending.sent_at
+        self.stats["acknowledged"] += 1
+        if not initial:
+            # Ett batteri som redan låg rätt säger inget om svarstiden
+            self.latency.observe(elapsed)
+            if self.latency_s is None:
+                self.latency_s = elapsed
+            else:
+                self.latency_s += LATENCY_SMOOTHING * (elapsed - self.latency_s)
+        self._record(pending, "acknowledged", elapsed)
+        if self._on_change is not None:
+            self._on_change()
+
+    async def _async_deadline(self, _now=None):
+        """Tidsgränsen gick ut utan svar: skicka om, eller eskalera efter sista försöket."""
+        self._cancel_deadline = None
+        pending = self.pending
+        if pending is None:
+            return
+        if pending.attempts <= ACK_MAX_RETRIES:
+            self.stats["retries"] += 1
+            _LOGGER.info(
+                f"Battery did not follow {pending.command} ({pending.requested_w:.0f} W, now {pending.last_w} W) "
+                f"within {ACK_DEADLINE_S:.0f} s. Sending it again."
+            )
+            self._resending = True
+            try:
+                await self._resend(pending.command, pending.data)
+                return
+            except Exception as e:
+                _LOGGER.warning(f"Could not resend {pending.command}: {e}")
+            finally:
+                self._resending = False
+            if self.pending is pending:
+                pending.attempts += 1  # Räknas som ett misslyckat försök
+                await self._async_deadline()
+            return
+
+        self.pending = None
+        self.stats["escalations"] += 1
+        elapsed = self._clock() - pending.sent_at
+        self._record(pending, "failed", elapsed)
+        _LOGGER.warning(
+            f"Battery did not follow {pending.command}: requested {pending.requested_w:.0f} W, "
+            f"measured {pending.last_w} W after {elapsed:.0f} s and {pending.attempts} attempts."
+        )
+        self.hass.bus.async_fire(EVENT_ACTUATION_FAILED, {
+            "command": pending.command,
+            "requested_w": pending.requested_w,
+            "measured_w": pending.last_w,
+            "attempts": pending.attempts,
+            "elapsed_s": round(elapsed, 1),
+        })
+        if self._on_change is not None:
+            self._on_change()
+
+    def _record(self, pending, result, elapsed):
+        if result != "cancelled" and pending.last_w is not None and pending.requested_w:
+            self.achieved.observe(pending.last_w / pending.requested_w)
+        self.history.append({
+            "time": dt_util.utcnow().isoformat(),
+            "command": pending.command,
+            "requested_w": pending.requested_w,
+            "measured_w": pending.last_w,
+            "result": result,
+            "attempts": pending.attempts,
+            "elapsed_s": round(elapsed, 3),
+        })
+
+    def _stop_deadline(self):
+        if self._cancel_deadline is not None:
+            self._cancel_deadline()
+            self._cancel_deadline = None
+
+    def diagnostics(self):
+        pending = self.pending
+        return {
+            "latency_s": round(self.latency_s, 3) if self.latency_s is not None else None,
+            "latency": self.latency.as_dict(),
+            "achieved_ratio": self.achieved.as_dict(),
+            "stats": dict(self.stats),
+            "pending": {
+                "command": pending.command,
+                "requested_w": pending.requested_w,
+                "measured_w": pending.last_w,
+                "attempts": pending.attempts,
+                "waited_s": round(self._clock() - pending.sent_at, 1),
+            } if pending is not None else None,
+            "history": list(self.history),
+        }
@@ -0,0 +1,266 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# actuator.py
+# Hur PeakGuards batterikommandon når växelriktaren.
+# Kommandona heter som scripten (sonnen_force_discharge, sonnen_force_charge, sonnen_set_auto_mode)
+# så att historik, skuggregulator och torrkörning ser likadana ut oavsett backend.
+#
+#     ScriptActuator  - anropar HA-scripten (som tidigare, Sonnen)
+#     ModbusActuator  - skriver läge och effekt direkt till växelriktaren via Modbus TCP
+#
+# Modbus-klienten håller en uppkoppling öppen och skickar anropen utan att vänta på svaren
+# (pipelining, svaren paras ihop med transaktions-id). Läge, effekt och återläsning går
+# därför iväg i ett svep i stället för tre rundor.
+
+import asyncio
+import logging
+import struct
+
+_LOGGER = logging.getLogger(__name__)
+
+# Kommando -> läge i registerkartan
+COMMAND_MODES = {
+    "sonnen_force_discharge": "discharge",
+    "sonnen_force_charge": "charge",
+    "sonnen_set_auto_mode": "auto",
+}
+
+# Registerkarta (holding registers, 0-baserade adresser). Måste anpassas efter växelriktaren.
+#     mode: register för driftläge, modes: värdet för respektive läge
+#     setpoint: register för effekten, scale_w: W per registerenhet
+#     signed: effekten skrivs med tecken (laddning negativ) i stället för bara storlek
+#     readback: register med batteriets faktiska effekt (valfritt, med tecken, laddning negativ)
+DEFAULT_MODBUS_REGISTERS = {
+    "mode": 0,
+    "setpoint": 1,
+    "readback": 2,
+    "modes": {"auto": 0, "charge": 1, "discharge": 2},
+    "scale_w": 1,
+    "signed": False,
+}
+
+MODBUS_TIMEOUT_S = 3.0
+
+# Modbus funktionskoder
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+MODBUS_EXCEPTIONS = {
+    1: "illegal function",
+    2: "illegal data address",
+    3: "illegal data value",
+    4: "server device failure",
+    6: "server device busy",
+}
+
+
+class ModbusError(Exception):
+    """Växelriktaren svarade med ett Modbus-undantag."""
+
+    def __init__(self, function, code):
+        super().__init__(f"Modbus function {function:#04x} failed: {MODBUS_EXCEPTIONS.get(code, code)}")
+        self.function = function
+        self.code = code
+
+
+class ScriptActuator:
+    """Skickar kommandona som HA-scripts (standard)."""
+
+    name = "script"
+
+    def __init__(self, hass):
+        self.hass = hass
+
+    async def async_send(self, command, data):
+        await self.hass.services.async_call("script", command, service_data=data)
+
+    async def async_close(self):
+        return None
+
+    def diagnostics(self):
+        return {"backend": self.name}
+
+
+class ModbusTcpClient:
+    """Minimal asynkron Modbus TCP-klient med en bestående uppkoppling och pipelining."""
+
+    def __init__(self, host, port=502, unit_id=1, timeout=MODBUS_TIMEOUT_S):
+        self.host = host
+        self.port = int(port)
+        self.unit_id = int(unit_id)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = asyncio.Lock()
+        self._pending = {}  # Transaktions-id -> future
+        self._transaction = 0
+        self.stats = dict.fromkeys(("requests", "responses", "errors", "timeouts", "connects", "max_in_flight"), 0)
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def _ensure_connected(self):
+        if self.connected:
+            return
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout
+            )
+            self.stats["connects"] += 1
+            self._read_task = asyncio.get_running_loop().create_task(self._read_loop(self._reader))
+
+    async def _read_loop(self, reader):
+        """Läser svar och lämnar dem till rätt anrop (i vilken ordning de än kommer)."""
+        error = ConnectionError("Modbus connection closed")
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, _protocol, length, _unit = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                future = self._pending.pop(transaction, None)
+                if future is None or future.done():
+                    continue  # Svar på ett anrop som redan har gett upp
+                self.stats["responses"] += 1
+                if pdu[0] & 0x80:
+                    future.set_exception(ModbusError(pdu[0] & 0x7F, pdu[1]))
+                else:
+                    future.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = ConnectionError(f"Modbus connection lost: {e}")
+        finally:
+            self._drop_connection(error)
+
+    def _drop_connection(self, error):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, function, payload):
+        """Skickar ett anrop och väntar på svaret (PDU). Flera anrop kan vara ute samtidigt."""
+        await self._ensure_connected()
+        # Läsloopen kan stänga uppkopplingen medan vi väntar, så writer hålls lokalt
+        writer = self._writer
+        if writer is None:
+            self.stats["errors"] += 1
+            raise ConnectionError("Modbus connection closed")
+        self._transaction = (self._transaction + 1) & 0xFFFF
+        transaction = self._transaction
+        future = asyncio.get_running_loop().create_future()
+        self._pending[transaction] = future
+        self.stats["requests"] += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], len(self._pending))
+        try:
+            writer.write(struct.pack(">HHHBB", transaction, 0, len(payload) + 2, self.unit_id, function) + payload)
+            await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self._pending.pop(transaction, None)
+
+    async def read_holding_registers(self, address, count=1):
+        pdu = await self.request(READ_HOLDING_REGISTERS, struct.pack(">HH", address, count))
+        return list(struct.unpack(f">{count}H", pdu[2:2 + 2 * count]))
+
+    async def write_register(self, address, value):
+        await self.request(WRITE_SINGLE_REGISTER, struct.pack(">HH", address, value & 0xFFFF))
+
+    async def write_registers(self, address, values):
+        data = struct.pack(f">{len(values)}H", *(v & 0xFFFF for v in values))
+        await self.request(WRITE_MULTIPLE_REGISTERS, struct.pack(">HHB", address, len(values), len(data)) + data)
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+            self._read_task = None
+        self._drop_connection(ConnectionError("Modbus client closed"))
+
+
+class ModbusActuator:
+    """Skriver batterikommandon direkt till växelriktarens register via Modbus TCP."""
+
+    name = "modbus"
+
+    def __init__(self, client, registers=None):
+        self.client = client
+        self.registers = {**DEFAULT_MODBUS_REGISTERS, **(registers or {})}
+        self.registers["modes"] = {**DEFAULT_MODBUS_REGISTERS["modes"], **self.registers["modes"]}
+        self.scale_w = float(self.registers["scale_w"]) or 1.0
+        self.last_readback_w = None
+
+    def encode(self, command, data):
+        """Returnerar (lägesvärde, effektvärde) för ett kommando."""
+        mode = COMMAND_MODES.get(command)
+        if mode is None:
+            raise ValueError(f"Unknown battery command for Modbus: {command}")
+        raw = round(float(data.get("power", 0) or 0) / self.scale_w)
+        if self.registers["signed"] and mode == "charge":
+            raw = -raw
+        limit = 0x7FFF if self.registers["signed"] else 0xFFFF
+        if abs(raw) > limit:
+            raise ValueError(f"Power {data.get('power')} W does not fit in the setpoint register")
+        return int(self.registers["modes"][mode]), raw
+
+    async def async_send(self, command, data):
+        mode_value, setpoint = self.encode(command, data)
+        registers = self.registers
+        requests = [
+            self.client.write_register(registers["setpoint"], setpoint),
+            self.client.write_register(registers["mode"], mode_value),
+        ]
+        if registers.get("readback") is not None:
+            requests.append(self.client.read_holding_registers(registers["readback"], 1))
+        # Alla anrop skickas direkt efter varandra, svaren kommer i samma ordning
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if registers.get("readback") is not None:
+            raw = results[-1][0]
+            self.last_readback_w = (raw - 0x10000 if raw & 0x8000 else raw) * self.scale_w
+            _LOGGER.debug(f"Modbus {command} {data}: battery readback {self.last_readback_w} W")
+
+    async def async_close(self):
+        await self.client.close()
+
+    def diagnostics(self):
+        return {
+            "backend": self.name,
+            "host": f"{self.client.host}:{self.client.port}",
+            "unit_id": self.client.unit_id,
+            "connected": self.client.connected,
+            "registers": self.registers,
+            "last_readback_w": self.last_readback_w,
+            "stats": dict(self.client.stats),
+        }
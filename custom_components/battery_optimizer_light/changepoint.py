@@ -0,0 +1,83 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# changepoint.py
+# Stegvis lägesbytesdetektering (CUSUM) för PeakGuard.
+# I stället för att vänta en fast tid samlas "bevis" för att ett nytt läge har börjat
+# (t.ex. export från solceller, eller att underhållsläget är slut). Ett tydligt byte
+# upptäcks snabbt, medan ett brusigt eller fladdrande värde tar längre tid.
+
+
+class CusumDetector:
+    """Ensidig, tidsviktad CUSUM. O(1) per prov.
+
+    Varje prov är en avvikelse (positiv = talar för det nya läget). Värdet antas gälla fram
+    till nästa prov, så bevisen räknas per sekund och inte per händelse (täta och glesa
+    mätare behandlas lika). Bidraget per sekund begränsas av max_step, så att en enskild
+    spik (t.ex. sensor-lag) inte räcker, och ett prov gäller högst max_gap sekunder.
+    """
+
+    def __init__(self, threshold, drift=0.0, max_step=None, floor=0.0, max_gap=10.0):
+        self.threshold = float(threshold)  # Bevis som krävs (enhet·s)
+        self.drift = drift                 # Avdrag per sekund (kräver en viss marginal)
+        self.max_step = max_step           # Tak för bidraget per sekund
+        self.floor = floor                 # Lägsta värde (< 0 ger minne av tidigare fladder)
+        self.max_gap = max_gap
+        self.score = 0.0
+        self.samples = 0
+        self._last_value = None
+        self._last_time = None
+
+    @property
+    def triggered(self):
+        return self.score >= self.threshold
+
+    @property
+    def pending(self):
+        """True om det finns bevis (eller ett prov) som talar för ett nytt läge."""
+        return self.score > 0 or (self._last_value is not None and self._last_value > self.drift)
+
+    def update(self, deviation, now):
+        """Lägger till ett prov (now = datetime). Returnerar True när bevisen räcker."""
+        if self._last_time is not None:
+            dt = min(max(0.0, (now - self._last_time).total_seconds()), self.max_gap)
+            step = self._last_value
+            if self.max_step is not None:
+                step = min(step, self.max_step)
+            self.score = max(self.floor, self.score + (step - self.drift) * dt)
+        self._last_value = deviation
+        self._last_time = now
+        self.samples += 1
+        return self.triggered
+
+    def penalize(self, amount):
+        """Motbevis (t.ex. att en signal kom tillbaka). Tiden fram till nästa prov räknas inte."""
+        self.score = max(self.floor, self.score - amount)
+        self._last_value = None
+        self._last_time = None
+
+    def reset(self):
+        self.score = 0.0
+        self.samples = 0
+        self._last_value = None
+        self._last_time = None
+
+    def as_dict(self):
+        return {
+            "score": round(self.score, 1),
+            "threshold": self.threshold,
+            "samples": self.samples,
+        }
@@ -18,6 +18,11 @@ import voluptuous as vol  # type: ignore
 from homeassistant import config_entries # type: ignore
 from homeassistant.core import callback  # type: ignore
 from homeassistant.helpers.selector import (
+    ObjectSelector,
+    SelectSelector,
+    SelectSelectorConfig,
+    NumberSelector,
+    NumberSelectorConfig,
     EntitySelector,
     EntitySelectorConfig,
     TextSelector,
@@ -36,7 +41,40 @@ from .const import (
     CONF_BATTERY_STATUS_KEYWORDS,
     CONF_VIRTUAL_LOAD_SENSOR,
     CONF_CONSUMPTION_FORECAST_SENSOR,
+    CONF_PRICE_SENSOR,
+    CONF_BATTERY_CAPACITY_KWH,
+    CONF_FALLBACK_AFTER_MINUTES,
+    CONF_LOAD_DEADBAND_W,
+    CONF_BATTERY_DEADBAND_W,
+    CONF_LIMIT_ENTITY,
+    CONF_LIMIT_FIXED_KW,
+    CONF_PV_POWER_SENSOR,
+    CONF_PV_FORECAST_SENSOR,
+    CONF_SOLAR_FORECAST_VERIFY_S,
+    CONF_SOLAR_CUSUM_THRESHOLD,
+    CONF_MAINTENANCE_CUSUM_THRESHOLD,
+    CONF_PHASE_L1_SENSOR,
+    CONF_PHASE_L2_SENSOR,
+    CONF_PHASE_L3_SENSOR,
+    CONF_MAIN_FUSE_A,
+    CONF_INVERTER_PHASES,
+    CONF_SHADOW_CONFIG,
+    CONF_LIMIT_SCHEDULE,
+    CONF_MODBUS_HOST,
+    CONF_MODBUS_PORT,
+    CONF_MODBUS_UNIT_ID,
+    CONF_MODBUS_REGISTERS,
     DEFAULT_BATTERY_STATUS_KEYWORDS,
+    DEFAULT_FALLBACK_AFTER_MINUTES,
+    DEFAULT_DEADBAND_W,
+    DEFAULT_SOLAR_FORECAST_VERIFY_S,
+    SOLAR_FORECAST_MIN_VERIFY_S,
+    DEFAULT_SOLAR_CUSUM_THRESHOLD,
+    DEFAULT_MAINTENANCE_CUSUM_THRESHOLD,
+    DEFAULT_MAIN_FUSE_A,
+    DEFAULT_INVERTER_PHASES,
+    DEFAULT_MODBUS_PORT,
+    DEFAULT_MODBUS_UNIT_ID,
 )
 
 class BatteryOptimizerLightConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
@@ -73,6 +111,69 @@ class BatteryOptimizerLightConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             vol.Optional(CONF_CONSUMPTION_FORECAST_SENSOR): EntitySelector(
                 EntitySelectorConfig(domain="sensor")
             ),
+            vol.Optional(CONF_PRICE_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor")
+            ),
+            vol.Optional(CONF_BATTERY_CAPACITY_KWH): NumberSelector(
+                NumberSelectorConfig(min=0, max=200, step=0.1, unit_of_measurement="kWh", mode="box")
+            ),
+            vol.Optional(CONF_FALLBACK_AFTER_MINUTES, default=DEFAULT_FALLBACK_AFTER_MINUTES): NumberSelector(
+                NumberSelectorConfig(min=5, max=720, step=5, unit_of_measurement="min", mode="box")
+            ),
+            vol.Optional(CONF_LOAD_DEADBAND_W, default=DEFAULT_DEADBAND_W): NumberSelector(
+                NumberSelectorConfig(min=0, max=1000, step=5, unit_of_measurement="W", mode="box")
+            ),
+            vol.Optional(CONF_BATTERY_DEADBAND_W, default=DEFAULT_DEADBAND_W): NumberSelector(
+                NumberSelectorConfig(min=0, max=1000, step=5, unit_of_measurement="W", mode="box")
+            ),
+            vol.Optional(CONF_LIMIT_ENTITY): EntitySelector(
+                EntitySelectorConfig(domain=["sensor", "input_number"])
+            ),
+            vol.Optional(CONF_LIMIT_FIXED_KW): NumberSelector(
+                NumberSelectorConfig(min=0, max=100, step=0.1, unit_of_measurement="kW", mode="box")
+            ),
+            vol.Optional(CONF_PV_POWER_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class="power")
+            ),
+            vol.Optional(CONF_PV_FORECAST_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor")
+            ),
+            vol.Optional(CONF_SOLAR_FORECAST_VERIFY_S, default=DEFAULT_SOLAR_FORECAST_VERIFY_S): NumberSelector(
+                NumberSelectorConfig(
+                    min=SOLAR_FORECAST_MIN_VERIFY_S, max=30, step=1, unit_of_measurement="s", mode="box"
+                )
+            ),
+            vol.Optional(CONF_SOLAR_CUSUM_THRESHOLD, default=DEFAULT_SOLAR_CUSUM_THRESHOLD): NumberSelector(
+                NumberSelectorConfig(min=0, max=60000, step=100, unit_of_measurement="W·s", mode="box")
+            ),
+            vol.Optional(CONF_MAINTENANCE_CUSUM_THRESHOLD, default=DEFAULT_MAINTENANCE_CUSUM_THRESHOLD): NumberSelector(
+                NumberSelectorConfig(min=0, max=300, step=1, unit_of_measurement="s", mode="box")
+            ),
+            vol.Optional(CONF_PHASE_L1_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_PHASE_L2_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_PHASE_L3_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_MAIN_FUSE_A, default=DEFAULT_MAIN_FUSE_A): NumberSelector(
+                NumberSelectorConfig(min=6, max=63, step=1, unit_of_measurement="A", mode="box")
+            ),
+            vol.Optional(CONF_INVERTER_PHASES, default=DEFAULT_INVERTER_PHASES): SelectSelector(
+                SelectSelectorConfig(options=["L1", "L2", "L3"], multiple=True)
+            ),
+            vol.Optional(CONF_SHADOW_CONFIG): ObjectSelector(),
+            vol.Optional(CONF_LIMIT_SCHEDULE): ObjectSelector(),
+            vol.Optional(CONF_MODBUS_HOST): TextSelector(),
+            vol.Optional(CONF_MODBUS_PORT, default=DEFAULT_MODBUS_PORT): NumberSelector(
+                NumberSelectorConfig(min=1, max=65535, step=1, mode="box")
+            ),
+            vol.Optional(CONF_MODBUS_UNIT_ID, default=DEFAULT_MODBUS_UNIT_ID): NumberSelector(
+                NumberSelectorConfig(min=0, max=255, step=1, mode="box")
+            ),
+            vol.Optional(CONF_MODBUS_REGISTERS): ObjectSelector(),
         })
 
         return self.async_show_form(step_id="user", data_schema=schema)
@@ -130,6 +231,69 @@ class BatteryOptimizerLightOptionsFlow(config_entries.OptionsFlow):
             vol.Optional(CONF_CONSUMPTION_FORECAST_SENSOR): EntitySelector(
                 EntitySelectorConfig(domain="sensor")
             ),
+            vol.Optional(CONF_PRICE_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor")
+            ),
+            vol.Optional(CONF_BATTERY_CAPACITY_KWH): NumberSelector(
+                NumberSelectorConfig(min=0, max=200, step=0.1, unit_of_measurement="kWh", mode="box")
+            ),
+            vol.Optional(CONF_FALLBACK_AFTER_MINUTES): NumberSelector(
+                NumberSelectorConfig(min=5, max=720, step=5, unit_of_measurement="min", mode="box")
+            ),
+            vol.Optional(CONF_LOAD_DEADBAND_W): NumberSelector(
+                NumberSelectorConfig(min=0, max=1000, step=5, unit_of_measurement="W", mode="box")
+            ),
+            vol.Optional(CONF_BATTERY_DEADBAND_W): NumberSelector(
+                NumberSelectorConfig(min=0, max=1000, step=5, unit_of_measurement="W", mode="box")
+            ),
+            vol.Optional(CONF_LIMIT_ENTITY): EntitySelector(
+                EntitySelectorConfig(domain=["sensor", "input_number"])
+            ),
+            vol.Optional(CONF_LIMIT_FIXED_KW): NumberSelector(
+                NumberSelectorConfig(min=0, max=100, step=0.1, unit_of_measurement="kW", mode="box")
+            ),
+            vol.Optional(CONF_PV_POWER_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class="power")
+            ),
+            vol.Optional(CONF_PV_FORECAST_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor")
+            ),
+            vol.Optional(CONF_SOLAR_FORECAST_VERIFY_S): NumberSelector(
+                NumberSelectorConfig(
+                    min=SOLAR_FORECAST_MIN_VERIFY_S, max=30, step=1, unit_of_measurement="s", mode="box"
+                )
+            ),
+            vol.Optional(CONF_SOLAR_CUSUM_THRESHOLD): NumberSelector(
+                NumberSelectorConfig(min=0, max=60000, step=100, unit_of_measurement="W·s", mode="box")
+            ),
+            vol.Optional(CONF_MAINTENANCE_CUSUM_THRESHOLD): NumberSelector(
+                NumberSelectorConfig(min=0, max=300, step=1, unit_of_measurement="s", mode="box")
+            ),
+            vol.Optional(CONF_PHASE_L1_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_PHASE_L2_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_PHASE_L3_SENSOR): EntitySelector(
+                EntitySelectorConfig(domain="sensor", device_class=["current", "power"])
+            ),
+            vol.Optional(CONF_MAIN_FUSE_A): NumberSelector(
+                NumberSelectorConfig(min=6, max=63, step=1, unit_of_measurement="A", mode="box")
+            ),
+            vol.Optional(CONF_INVERTER_PHASES): SelectSelector(
+                SelectSelectorConfig(options=["L1", "L2", "L3"], multiple=True)
+            ),
+            vol.Optional(CONF_SHADOW_CONFIG): ObjectSelector(),
+            vol.Optional(CONF_LIMIT_SCHEDULE): ObjectSelector(),
+            vol.Optional(CONF_MODBUS_HOST): TextSelector(),
+            vol.Optional(CONF_MODBUS_PORT): NumberSelector(
+                NumberSelectorConfig(min=1, max=65535, step=1, mode="box")
+            ),
+            vol.Optional(CONF_MODBUS_UNIT_ID): NumberSelector(
+                NumberSelectorConfig(min=0, max=255, step=1, mode="box")
+            ),
+            vol.Optional(CONF_MODBUS_REGISTERS): ObjectSelector(),
         })
 
         # Förbered förifyllda värden (hanterar "sticky default"-problemet)
@@ -144,6 +308,33 @@ class BatteryOptimizerLightOptionsFlow(config_entries.OptionsFlow):
             CONF_BATTERY_STATUS_KEYWORDS: data.get(CONF_BATTERY_STATUS_KEYWORDS, DEFAULT_BATTERY_STATUS_KEYWORDS),
             CONF_VIRTUAL_LOAD_SENSOR: data.get(CONF_VIRTUAL_LOAD_SENSOR),
             CONF_CONSUMPTION_FORECAST_SENSOR: data.get(CONF_CONSUMPTION_FORECAST_SENSOR),
+            CONF_PRICE_SENSOR: data.get(CONF_PRICE_SENSOR),
+            CONF_BATTERY_CAPACITY_KWH: data.get(CONF_BATTERY_CAPACITY_KWH),
+            CONF_FALLBACK_AFTER_MINUTES: data.get(CONF_FALLBACK_AFTER_MINUTES, DEFAULT_FALLBACK_AFTER_MINUTES),
+            CONF_LOAD_DEADBAND_W: data.get(CONF_LOAD_DEADBAND_W, DEFAULT_DEADBAND_W),
+            CONF_BATTERY_DEADBAND_W: data.get(CONF_BATTERY_DEADBAND_W, DEFAULT_DEADBAND_W),
+            CONF_LIMIT_ENTITY: data.get(CONF_LIMIT_ENTITY),
+            CONF_LIMIT_FIXED_KW: data.get(CONF_LIMIT_FIXED_KW),
+            CONF_PV_POWER_SENSOR: data.get(CONF_PV_POWER_SENSOR),
+            CONF_PV_FORECAST_SENSOR: data.get(CONF_PV_FORECAST_SENSOR),
+            CONF_SOLAR_FORECAST_VERIFY_S: max(
+                data.get(CONF_SOLAR_FORECAST_VERIFY_S, DEFAULT_SOLAR_FORECAST_VERIFY_S), SOLAR_FORECAST_MIN_VERIFY_S
+            ),
+            CONF_SOLAR_CUSUM_THRESHOLD: data.get(CONF_SOLAR_CUSUM_THRESHOLD, DEFAULT_SOLAR_CUSUM_THRESHOLD),
+            CONF_MAINTENANCE_CUSUM_THRESHOLD: data.get(
+                CONF_MAINTENANCE_CUSUM_THRESHOLD, DEFAULT_MAINTENANCE_CUSUM_THRESHOLD
+            ),
+            CONF_PHASE_L1_SENSOR: data.get(CONF_PHASE_L1_SENSOR),
+            CONF_PHASE_L2_SENSOR: data.get(CONF_PHASE_L2_SENSOR),
+            CONF_PHASE_L3_SENSOR: data.get(CONF_PHASE_L3_SENSOR),
+            CONF_MAIN_FUSE_A: data.get(CONF_MAIN_FUSE_A, DEFAULT_MAIN_FUSE_A),
+            CONF_INVERTER_PHASES: data.get(CONF_INVERTER_PHASES, DEFAULT_INVERTER_PHASES),
+            CONF_SHADOW_CONFIG: data.get(CONF_SHADOW_CONFIG),
+            CONF_LIMIT_SCHEDULE: data.get(CONF_LIMIT_SCHEDULE),
+            CONF_MODBUS_HOST: data.get(CONF_MODBUS_HOST),
+            CONF_MODBUS_PORT: data.get(CONF_MODBUS_PORT, DEFAULT_MODBUS_PORT),
+            CONF_MODBUS_UNIT_ID: data.get(CONF_MODBUS_UNIT_ID, DEFAULT_MODBUS_UNIT_ID),
+            CONF_MODBUS_REGISTERS: data.get(CONF_MODBUS_REGISTERS),
         }
         schema = self.add_suggested_values_to_schema(schema, suggested_values)
 
@@ -30,6 +30,62 @@ CONF_BATTERY_STATUS_SENSOR = "battery_status_sensor" # Sensor för driftstatus (
 CONF_BATTERY_STATUS_KEYWORDS = "battery_status_keywords" # Nyckelord för underhållsläge
 CONF_VIRTUAL_LOAD_SENSOR = "virtual_load_sensor" # Virtuell last (Husets netto utan batteri)
 CONF_CONSUMPTION_FORECAST_SENSOR = "consumption_forecast_sensor" # Prognos för morgondagens förbrukning (kWh)
+CONF_LIMIT_ENTITY = "limit_entity" # Källa för effektgränsen (sensor/input_number). Tom = egen gränssensor
+CONF_LIMIT_FIXED_KW = "limit_fixed_kw" # Fast effektgräns (kW). Går före CONF_LIMIT_ENTITY
+# Lokalt schema för gränsen (valfritt): lista med fönster (months, weekdays, start, end, limit_kw).
+# Utanför alla fönster gäller ingen gräns, se schedule.py
+CONF_LIMIT_SCHEDULE = "limit_schedule"
+
+# Solprognos för solar override (valfritt). När både solcellernas effekt och prognosen räcker
+# till exporten kortas verifieringen (30 s) av till CONF_SOLAR_FORECAST_VERIFY_S (minst 5 s)
+CONF_PV_POWER_SENSOR = "pv_power_sensor" # Solcellernas nuvarande effekt (W eller kW)
+CONF_PV_FORECAST_SENSOR = "pv_forecast_sensor" # Prognos för effekten just nu (t.ex. Forecast.Solar/Solcast)
+CONF_SOLAR_FORECAST_VERIFY_S = "solar_forecast_verify_s" # Verifieringstid (s) när överskott är väntat
+
+# Säkringsskydd per fas (valfritt). Sensorerna kan visa ström (A) eller effekt (W/kW)
+CONF_PHASE_L1_SENSOR = "phase_l1_sensor"
+CONF_PHASE_L2_SENSOR = "phase_l2_sensor"
+CONF_PHASE_L3_SENSOR = "phase_l3_sensor"
+CONF_MAIN_FUSE_A = "main_fuse_a" # Huvudsäkringens storlek (A)
+CONF_INVERTER_PHASES = "inverter_phases" # Faser som batteriets växelriktare matar (t.ex. ["L1"])
+
+# Lägesbytesdetektering (CUSUM). Tröskeln är hur mycket bevis som krävs innan ett nytt läge
+# accepteras: exporten under triggergränsen (W·s) respektive sekunder med normal status
+CONF_SOLAR_CUSUM_THRESHOLD = "solar_cusum_threshold"
+CONF_MAINTENANCE_CUSUM_THRESHOLD = "maintenance_cusum_threshold"
+
+# Skuggregulator (valfritt): inställningar som avviker från de riktiga, t.ex. {"limit_fixed_kw": 4.5}.
+# Skuggan utvärderar samma händelser men skickar aldrig några kommandon
+CONF_SHADOW_CONFIG = "shadow_config"
+
+# Batterikommandon direkt via Modbus TCP (valfritt, i stället för HA-scripten). Registerkartan
+# anges som {mode, setpoint, readback, modes, scale_w, signed}, se actuator.py
+CONF_MODBUS_HOST = "modbus_host"
+CONF_MODBUS_PORT = "modbus_port"
+CONF_MODBUS_UNIT_ID = "modbus_unit_id"
+CONF_MODBUS_REGISTERS = "modbus_registers"
+
+# Lokal reservplanering (när molnet inte svarar)
+CONF_PRICE_SENSOR = "price_sensor" # Spotpris-sensor med raw_today/raw_tomorrow (Nordpool)
+CONF_BATTERY_CAPACITY_KWH = "battery_capacity_kwh" # Batteriets användbara kapacitet (kWh)
+CONF_FALLBACK_AFTER_MINUTES = "fallback_after_minutes" # Hur gammal molnsignalen får bli innan lokal plan tar över
+
+# Dödband för inkommande händelser (W). Mindre ändringar ignoreras (utom nära beslutsgränserna)
+CONF_LOAD_DEADBAND_W = "load_deadband_w" # Gäller grid-sensorn (eller virtuell last)
+CONF_BATTERY_DEADBAND_W = "battery_deadband_w" # Gäller batteriets effektsensor
 
 DEFAULT_API_URL = "https://battery-light-production.up.railway.app"
+DEFAULT_FALLBACK_AFTER_MINUTES = 30
+DEFAULT_SOLAR_FORECAST_VERIFY_S = 10  # Exporten ska hålla i sig så här länge även när överskottet är väntat
+SOLAR_FORECAST_MIN_VERIFY_S = 5  # Kortaste tillåtna verifiering (ett enskilt värde räcker aldrig)
+DEFAULT_SOLAR_CUSUM_THRESHOLD = 6000  # T.ex. 3 s vid stor export, 12 s vid 1 kW export
+DEFAULT_MAINTENANCE_CUSUM_THRESHOLD = 20  # Sekunder vid ett rent byte (längre om statusen fladdrar)
+DEFAULT_MAIN_FUSE_A = 16
+DEFAULT_INVERTER_PHASES = ["L1", "L2", "L3"]  # Trefasig växelriktare
+DEFAULT_MODBUS_PORT = 502
+DEFAULT_MODBUS_UNIT_ID = 1
+DEFAULT_DEADBAND_W = 0  # 0 = släpp bara igenom ändrade värden
 DEFAULT_BATTERY_STATUS_KEYWORDS = "battery_care, puls_orange, calibration, firmware_update, solid_red, warning_internet"
+
+# Diagnostik
+DIAGNOSTICS_HISTORY_SIZE = 25  # Antal sparade /signal-svar, kommandon och rapporter
@@ -16,10 +16,24 @@
 
 import logging
 import asyncio
+import time
+from collections import deque
 from datetime import timedelta
 import aiohttp
+import homeassistant.util.dt as dt_util
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed  # type: ignore
 from homeassistant.helpers.aiohttp_client import async_get_clientsession # type: ignore
+from .const import (
+    CONF_PRICE_SENSOR,
+    CONF_BATTERY_CAPACITY_KWH,
+    CONF_FALLBACK_AFTER_MINUTES,
+    DEFAULT_FALLBACK_AFTER_MINUTES,
+    DIAGNOSTICS_HISTORY_SIZE,
+)
+from .metrics import LatencyHistogram
+from .models import SignalData, InvalidSignal, DEFAULT_MAX_DISCHARGE_KW
+from .planner import parse_price_slots, plan_schedule
+from .reports import ReportQueue
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -36,6 +50,9 @@ class BatteryOptimizerLightCoordinator(DataUpdateCoordinator):
         self.api_url = f"{config['api_url'].rstrip('/')}/signal"
         self.api_key = config['api_key']
         self.version = version
+        # Timeout och väntetid mellan omförsök (sekunder). Kan sänkas i tester mot en lokal backend.
+        self.request_timeout = 30
+        self.retry_delay = 5
 
         # --- DEV OVERRIDE (Avkommentera vid lokal utveckling) ---
         # self.api_url = "https://battery-light-development.up.railway.app/signal"
@@ -47,6 +64,63 @@ class BatteryOptimizerLightCoordinator(DataUpdateCoordinator):
         self.soc_entity = config['soc_sensor']
         self.consumption_forecast_entity = config.get("consumption_forecast_sensor")
 
+        # --- LOKAL RESERVPLAN ---
+        self.price_entity = config.get(CONF_PRICE_SENSOR)
+        self.battery_capacity_kwh = config.get(CONF_BATTERY_CAPACITY_KWH)
+        self.fallback_after = timedelta(
+            minutes=float(config.get(CONF_FALLBACK_AFTER_MINUTES) or DEFAULT_FALLBACK_AFTER_MINUTES)
+        )
+        self._started = dt_util.utcnow()  # Signalens ålder räknas från uppstart tills första svaret
+        self.last_cloud_data = None
+        self.local_plan = None
+
+        # --- DIAGNOSTIK (begränsade buffertar i minnet) ---
+        self.signal_history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self.signal_latency = LatencyHistogram()
+        self.stats = {
+            "requests": 0, "successes": 0, "retries": 0, "failures": 0, "auth_failures": 0, "invalid_responses": 0,
+        }
+
+        # Händelser från PeakGuard som skickas med i /signal
+        self.reports = ReportQueue(hass, config)
+
+    def _record_signal(self, started, attempt, status=None, response=None, error=None):
+        """Sparar ett /signal-anrop i historiken (för diagnostik)."""
+        latency = time.perf_counter() - started
+        self.signal_latency.observe(latency)
+        self.signal_history.append({
+            "time": dt_util.utcnow().isoformat(),
+            "attempt": attempt + 1,
+            "latency_ms": round(latency * 1000, 1),
+            "status": status,
+            "response": response,
+            "error": error,
+        })
+
+    def diagnostics(self):
+        """Returnerar coordinatorns diagnostikdata."""
+        return {
+            "api_url": self.api_url,
+            "last_update_success": self.last_update_success,
+            "stats": dict(self.stats),
+            "signal_latency": self.signal_latency.as_dict(),
+            "signal_history": list(self.signal_history),
+            "reports": self.reports.diagnostics(),
+            "last_cloud_success": (
+                self.last_cloud_data.received_at.isoformat() if self.last_cloud_data is not None else None
+            ),
+            "data": self.data.as_dict() if self.data is not None else None,
+            "local_plan": (
+                {
+                    "action": self.local_plan.action,
+                    "target_power_kw": self.local_plan.target_power_kw,
+                    "slots": [(start.isoformat(), action) for start, action in self.local_plan.slots],
+                }
+                if self.local_plan
+                else None
+            ),
+        }
+
     async def _async_update_data(self):
         """Körs var 5:e minut."""
         # 1. Hämta SOC
@@ -85,30 +159,119 @@ class BatteryOptimizerLightCoordinator(DataUpdateCoordinator):
             "soc": soc,
             "is_solar_override": is_solar_override,
             "consumption_forecast_kwh": consumption_forecast,
-            "ha_version": self.version
+            "ha_version": self.version,
+            # Väntande PeakGuard-händelser. Backend kvitterar dem i "acked_events".
+            "events": self.reports.signal_payload(),
         }
 
         _LOGGER.debug(f"Light-Request: {payload}")
 
+        try:
+            data = await self._async_fetch_signal(payload)
+        except UpdateFailed:
+            # Molnet svarar inte. Om signalen är för gammal tar den lokala planen över.
+            fallback = await self._async_local_fallback(soc)
+            if fallback is None:
+                raise
+            return fallback
+
+        if self.local_plan is not None:
+            _LOGGER.info("☁️ Cloud signal restored. Local fallback plan deactivated.")
+            self.local_plan = None
+        self.last_cloud_data = data
+        return data
+
+    def signal_age(self):
+        """Hur gammal senaste molnsignalen är (från uppstart om inget svar har kommit)."""
+        last = self.last_cloud_data
+        age = last.age() if last is not None else None
+        return age if age is not None else dt_util.utcnow() - self._started
+
+    async def _async_local_fallback(self, soc):
+        """Räknar fram en lokal plan från spotpriser när molnsignalen är för gammal."""
+        if not self.price_entity or not self.battery_capacity_kwh:
+            return None
+
+        age = self.signal_age()
+        if age < self.fallback_after:
+            return None
+
+        price_state = self.hass.states.get(self.price_entity)
+        if not price_state:
+            _LOGGER.warning(f"Local fallback: price sensor {self.price_entity} not found.")
+            return None
+
+        slots = parse_price_slots(price_state.attributes, dt_util.now())
+        if not slots:
+            _LOGGER.warning(f"Local fallback: no upcoming prices in {self.price_entity}.")
+            return None
+
+        last = self.last_cloud_data or SignalData(source="local")
+        max_power_kw = last.max_discharge_kw or DEFAULT_MAX_DISCHARGE_KW
+        min_soc = last.min_soc_buffer
+
+        # Planeringen körs i en executor-tråd så att event-loopen aldrig blockeras
+        plan = await self.hass.async_add_executor_job(
+            plan_schedule, slots, soc, float(self.battery_capacity_kwh), max_power_kw, min_soc
+        )
+        if self.local_plan is None:
+            _LOGGER.warning(
+                "⚠️ Cloud signal is %d min old. Switching to local fallback plan (%s).",
+                age.total_seconds() // 60,
+                plan.action,
+            )
+        self.local_plan = plan
+
+        # Behåll övriga fält (peak-gräns m.m.) från senaste molnsvaret
+        return last.with_plan(
+            plan.action,
+            plan.target_power_kw,
+            f"Local fallback plan (cloud unreachable for {int(age.total_seconds() // 60)} min)",
+        )
+
+    async def _async_fetch_signal(self, payload):
+        """Skickar /signal med omförsök och returnerar det tolkade svaret (SignalData)."""
         # Retry-mekanism (3 försök)
         session = async_get_clientsession(self.hass)
         for attempt in range(3):
+            self.stats["requests"] += 1
+            started = time.perf_counter()
             try:
                 async with session.post(
-                    self.api_url, json=payload, timeout=aiohttp.ClientTimeout(total=30)
+                    self.api_url, json=payload, timeout=aiohttp.ClientTimeout(total=self.request_timeout)
                 ) as response:
                     if response.status == 401:
                         text = await response.text()
+                        self._record_signal(started, attempt, status=401, error=text)
+                        self.stats["auth_failures"] += 1
                         raise UpdateFailed(f"Authentication failed: {text}")
 
                     if response.status != 200:
                         text = await response.text()
+                        self._record_signal(started, attempt, status=response.status, error=text)
                         raise UpdateFailed(f"Server {response.status}: {text}")
 
-                    return await response.json()
+                    data = await response.json()
+                    if self.reports.handle_signal_response(data):
+                        # Backend kvitterade inte händelserna, skicka dem separat utan att blockera
+                        self.hass.async_create_background_task(
+                            self.reports.async_flush(), "battery_optimizer_light_report_flush"
+                        )
+                    # Tolka svaret en gång här, så att felaktiga svar stoppas innan sensorer och PeakGuard
+                    try:
+                        signal = SignalData.from_response(data)
+                    except InvalidSignal as err:
+                        self._record_signal(started, attempt, status=200, response=data, error=str(err))
+                        self.stats["invalid_responses"] += 1
+                        raise UpdateFailed(f"Invalid response: {err}") from err
+                    self._record_signal(started, attempt, status=200, response=data)
+                    self.stats["successes"] += 1
+                    return signal
 
             except Exception as err:
-                if isinstance(err, UpdateFailed) and "Authentication failed" in str(err):
+                if isinstance(err, UpdateFailed) and (
+                    "Authentication failed" in str(err) or "Invalid response" in str(err)
+                ):
                     raise
 
                 # Get a more descriptive error message
@@ -117,15 +280,22 @@ class BatteryOptimizerLightCoordinator(DataUpdateCoordinator):
                     # Fallback for exceptions with empty string representation
                     error_detail = repr(err) # Use repr for more technical detail if str is empty
 
+                if not isinstance(err, UpdateFailed):
+                    # HTTP-fel är redan loggade ovan, här loggas nätverksfel (timeout m.m.)
+                    self._record_signal(started, attempt, error=f"{type(err).__name__}: {error_detail}")
+
                 if attempt < 2:
+                    self.stats["retries"] += 1
                     _LOGGER.warning(
-                        "Connection attempt %d failed with %s: %s. Retrying in 5s...",
+                        "Connection attempt %d failed with %s: %s. Retrying in %ss...",
                         attempt + 1,
                         type(err).__name__,
                         error_detail,
+                        self.retry_delay,
                     )
-                    await asyncio.sleep(5)
+                    await asyncio.sleep(self.retry_delay)
                 else:
+                    self.stats["failures"] += 1
                     _LOGGER.exception("Light-Error after 3 attempts")
                     raise UpdateFailed(
                         f"Connection error after 3 attempts: {type(err).__name__}: {error_detail}"
@@ -0,0 +1,37 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# diagnostics.py
+# Allt läses från buffertar i minnet, så nedladdningen går direkt.
+
+from homeassistant.components.diagnostics import async_redact_data # type: ignore
+from .const import DOMAIN, CONF_API_KEY
+
+TO_REDACT = {CONF_API_KEY}
+
+async def async_get_config_entry_diagnostics(hass, entry):
+    """Returnerar diagnostik för en config entry."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    peak_guard = getattr(coordinator, "peak_guard", None)
+
+    return async_redact_data(
+        {
+            "config": dict(entry.data),
+            "coordinator": coordinator.diagnostics(),
+            "peak_guard": peak_guard.diagnostics() if peak_guard else None,
+        },
+        TO_REDACT,
+    )
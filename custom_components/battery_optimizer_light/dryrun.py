@@ -0,0 +1,281 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# dryrun.py
+# Tjänsten battery_optimizer_light.dry_run: "vad skulle hända?".
+# Samma beslutskod som PeakGuard.update körs på en kopia av PeakGuards tillstånd, med
+# valfria värden för last, gräns, SoC, molnets läge och batteriets effekt. Kommandon och
+# rapporter sparas i svaret i stället för att skickas, sensorerna meddelas inte och
+# loggraderna (på den nivå som är påslagen) hamnar i svaret i stället för i HA:s logg.
+
+import copy
+import logging
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from types import SimpleNamespace
+import voluptuous as vol  # type: ignore
+from .const import (
+    CONF_BATTERY_POWER_SENSOR,
+    CONF_GRID_SENSOR,
+    CONF_GRID_SENSOR_INVERT,
+    CONF_SOC_SENSOR,
+    CONF_VIRTUAL_LOAD_SENSOR,
+    DIAGNOSTICS_HISTORY_SIZE,
+)
+from .actuation import ActuationTracker
+from .limit import PeakLimit
+from .models import Action, SignalData
+
+# Stegen i PeakGuard._evaluate (metodnamn -> namn i svaret)
+STAGES = {
+    "_stage_backend_enabled": "backend",
+    "_stage_status": "status",
+    "_stage_inputs": "inputs",
+    "_stage_quiet_filter": "quiet_filter",
+    "_stage_decide": "decide",
+}
+
+# Entitet som används för lasten när den anges i anropet
+DRY_RUN_LOAD_ENTITY = "dry_run.load"
+
+# Tjänstens fält (samma som i services.yaml)
+DRY_RUN_SCHEMA = vol.Schema({
+    vol.Optional("load_w"): vol.Coerce(float),
+    vol.Optional("limit_w"): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional("soc"): vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+    vol.Optional("battery_power_w"): vol.Coerce(float),
+    vol.Optional("cloud_action"): vol.All(vol.Upper, vol.In([a.value for a in Action if a != Action.UNKNOWN])),
+})
+
+# Loggrader från en pågående torrkörning (None = ingen torrkörning i aktuell task)
+_dry_run_log = ContextVar("battery_optimizer_light_dry_run_log", default=None)
+
+
+class _DryRunLogFilter(logging.Filter):
+    """Fångar PeakGuards loggrader under en torrkörning så att de inte syns i HA:s logg."""
+
+    def filter(self, record):
+        log = _dry_run_log.get()
+        if log is None:
+            return True
+        log.append(f"{record.levelname}: {record.getMessage()}")
+        return False
+
+
+_log_filter = _DryRunLogFilter()
+logging.getLogger(__package__).addFilter(_log_filter)
+
+
+@contextmanager
+def capture_logs(target):
+    """PeakGuards loggrader i aktuell task läggs i target (lista/deque) i stället för i HA:s logg."""
+    token = _dry_run_log.set(target)
+    try:
+        yield target
+    finally:
+        _dry_run_log.reset(token)
+
+
+@dataclass(slots=True)
+class _OverrideState:
+    """Ersätter ett state-objekt med ett angivet värde."""
+
+    state: str
+    attributes: dict = field(default_factory=lambda: {"unit_of_measurement": "W"})
+
+
+@dataclass(frozen=True, slots=True)
+class DryRunInputs:
+    """Värden som ersätter sensorerna i torrkörningen (None = läs sensorn som vanligt)."""
+
+    load_w: float | None = None
+    limit_w: float | None = None
+    soc: float | None = None
+    battery_power_w: float | None = None
+    cloud_action: str | None = None
+
+    @classmethod
+    def from_service_data(cls, data):
+        def number(key):
+            value = data.get(key)
+            return float(value) if value is not None else None
+
+        action = data.get("cloud_action")
+        return cls(
+            load_w=number("load_w"),
+            limit_w=number("limit_w"),
+            soc=number("soc"),
+            battery_power_w=number("battery_power_w"),
+            cloud_action=str(action) if action else None,
+        )
+
+
+def _snapshot(guard):
+    return {
+        "peak_active": guard.is_active,
+        "solar_override": guard.is_solar_override,
+        "maintenance": guard.in_maintenance,
+        "last_command": guard._last_sent_command,
+    }
+
+
+def _finite(value_w):
+    """Gränsvärdet i svaret (None utan gräns, t.ex. utanför schemats fönster)."""
+    return round(value_w, 1) if value_w is not None and math.isfinite(value_w) else None
+
+
+def _simulation(peak_guard, inputs, commands, reports, stage_times):
+    """Skapar en kopia av PeakGuard vars beslut inte får några sidoeffekter."""
+    sim = copy.copy(peak_guard)
+    config = peak_guard.config
+
+    # Allt som beslutskoden ändrar på plats får egna kopior
+    sim.solar_detector = copy.deepcopy(peak_guard.solar_detector)
+    sim.maintenance_detector = copy.deepcopy(peak_guard.maintenance_detector)
+    sim.pipeline_stats = dict(peak_guard.pipeline_stats)
+    sim.decision_trace = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+    sim.command_history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+    sim._float_cache = {}
+    sim._listeners = []
+
+    # Ersatta sensorvärden
+    overrides = {}
+    if inputs.soc is not None:
+        overrides[config.get(CONF_SOC_SENSOR)] = _OverrideState(str(inputs.soc), {"unit_of_measurement": "%"})
+    if inputs.battery_power_w is not None:
+        overrides[config.get(CONF_BATTERY_POWER_SENSOR)] = _OverrideState(str(inputs.battery_power_w))
+    virtual_load_id = config.get(CONF_VIRTUAL_LOAD_SENSOR)
+    if inputs.load_w is not None:
+        if virtual_load_id:
+            overrides[virtual_load_id] = _OverrideState(str(inputs.load_w))
+        elif config.get(CONF_GRID_SENSOR):
+            # Lasten är grid + batteri, så grid sätts så att summan blir den angivna lasten
+            bat_w = inputs.battery_power_w
+            if bat_w is None:
+                try:
+                    bat_w = peak_guard._read_float(config.get(CONF_BATTERY_POWER_SENSOR)) or 0.0
+                except ValueError:
+                    bat_w = 0.0
+            grid_w = inputs.load_w - bat_w
+            if config.get(CONF_GRID_SENSOR_INVERT, False):
+                grid_w = -grid_w
+            overrides[config.get(CONF_GRID_SENSOR)] = _OverrideState(str(grid_w))
+        else:
+            virtual_load_id = DRY_RUN_LOAD_ENTITY
+            overrides[virtual_load_id] = _OverrideState(str(inputs.load_w))
+    overrides.pop(None, None)
+
+    def get_state(entity_id):
+        if entity_id in overrides:
+            return overrides[entity_id]
+        return peak_guard.hass.states.get(entity_id)
+
+    sim._get_state = get_state
+    if inputs.limit_w is not None:
+        sim.limit = PeakLimit(peak_guard.hass, fixed_kw=inputs.limit_w / 1000.0)
+    if inputs.cloud_action is not None:
+        data = peak_guard.coordinator.data or SignalData(source="dry_run")
+        sim.coordinator = SimpleNamespace(
+            data=replace(data, action=Action.parse(inputs.cloud_action)),
+            reports=peak_guard.coordinator.reports,
+        )
+
+    # Sidoeffekter sparas i svaret i stället för att utföras
+    async def call_script(script_name, data):
+        commands.append({"script": script_name, "data": dict(data)})
+
+    async def send_report(endpoint, description, grid_w, limit_w):
+        reports.append({"event": endpoint, "grid_w": round(grid_w, 1), "limit_w": _finite(limit_w)})
+
+    sim._call_script = call_script
+    sim._send_report = send_report
+    sim.actuation = ActuationTracker(peak_guard.hass, None, call_script)  # Den riktiga kvittensen rörs inte
+
+    # Tid per steg
+    for method, name in STAGES.items():
+        sim.__dict__[method] = _timed(getattr(sim, method), name, stage_times)
+    return sim, virtual_load_id
+
+
+def _timed(func, name, stage_times):
+    if name == "decide":
+        async def timed_async(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stage_times[name] = round((time.perf_counter() - started) * 1000, 3)
+        return timed_async
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[name] = round((time.perf_counter() - started) * 1000, 3)
+    return timed
+
+
+async def async_dry_run(peak_guard, inputs=None):
+    """Kör en utvärdering utan sidoeffekter och returnerar vad som skulle ha hänt."""
+    inputs = inputs or DryRunInputs()
+    commands, reports, stage_times, log = [], [], {}, []
+    started = time.perf_counter()
+    with capture_logs(log):
+        sim, virtual_load_id = _simulation(peak_guard, inputs, commands, reports, stage_times)
+        before = _snapshot(sim)
+        try:
+            stopped_at = await sim._evaluate(virtual_load_id)
+        except Exception as e:
+            stopped_at = "error"
+            log.append(f"ERROR: {type(e).__name__}: {e}")
+        after = _snapshot(sim)
+        limit_w = sim.limit.value_w()
+        try:
+            soc = sim._read_float(peak_guard.config.get(CONF_SOC_SENSOR))
+            battery_w = sim._read_float(peak_guard.config.get(CONF_BATTERY_POWER_SENSOR))
+        except ValueError:
+            soc = battery_w = None
+
+    data = sim.coordinator.data
+    return {
+        "stopped_at": stopped_at,
+        "inputs": {
+            "load_w": sim._last_load_w if stopped_at in ("quiet", "decision") else inputs.load_w,
+            "limit_w": _finite(limit_w),
+            "soc": soc,
+            "battery_power_w": battery_w,
+            "cloud_action": (data.action if data is not None else Action.HOLD).value,
+        },
+        "before": before,
+        "after": after,
+        "transitions": [
+            {"state": key, "from": before[key], "to": after[key]}
+            for key in before
+            if key != "last_command" and before[key] != after[key]
+        ],
+        "commands": commands,
+        "reports": reports,
+        "phases": sim.last_phases.as_dict() if sim.last_phases is not None else None,
+        "trace": list(sim.decision_trace),
+        "log": log,
+        "stage_timings_ms": stage_times,
+        "total_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
@@ -0,0 +1,102 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# energy.py
+# Lokal energiräkning för PeakGuard: hur mycket batteriet laddade ur under toppar, hur
+# mycket av toppen som kapades bort från nätet, och hur mycket solel som fångades under
+# solar override. Effekten integreras stegvis (vänster Riemann-summa, O(1) per händelse).
+
+import time
+
+# Mätare som PeakGuard för (namnen används även i sensorernas unique_id)
+METER_PEAK_DISCHARGE = "peak_discharge"
+METER_PEAK_SHAVED = "peak_shaved"
+METER_SOLAR_OVERRIDE = "solar_override"
+METERS = (METER_PEAK_DISCHARGE, METER_PEAK_SHAVED, METER_SOLAR_OVERRIDE)
+
+# Ett värde gäller högst så här länge (s) om inga nya händelser kommer (t.ex. efter en omstart)
+MAX_SAMPLE_GAP_S = 300.0
+
+# Sensorerna uppdateras när värdet har ändrats med minst så här mycket (kWh)
+PUBLISH_RESOLUTION_KWH = 0.001
+
+
+class EnergyIntegrator:
+    """Integrerar effekt (W) till energi (kWh). Effekten gäller fram till nästa prov."""
+
+    __slots__ = ("total_kwh", "_power_w", "_last_time")
+
+    def __init__(self):
+        self.total_kwh = 0.0
+        self._power_w = 0.0
+        self._last_time = None
+
+    def sample(self, power_w, now):
+        if self._last_time is not None and self._power_w > 0:
+            dt = min(max(0.0, now - self._last_time), MAX_SAMPLE_GAP_S)
+            self.total_kwh += self._power_w * dt / 3_600_000.0
+        self._power_w = max(0.0, power_w)
+        self._last_time = now
+
+
+class EnergyAccounting:
+    """Samlar PeakGuards energimätare och meddelar sensorerna när ett värde har ändrats."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.meters = {name: EnergyIntegrator() for name in METERS}
+        self._published = dict.fromkeys(METERS, 0.0)
+        self._listeners = []
+
+    def total_kwh(self, name):
+        return self.meters[name].total_kwh
+
+    def restore(self, name, kwh):
+        """Lägger till ett sparat värde (från sensorns senaste state efter en omstart)."""
+        try:
+            kwh = float(kwh)
+        except (TypeError, ValueError):
+            return
+        if kwh > 0:
+            self.meters[name].total_kwh += kwh
+            self._published[name] = self.meters[name].total_kwh
+
+    def sample(self, peak_discharge_w=0.0, peak_shaved_w=0.0, solar_override_w=0.0):
+        now = self.clock()
+        self.meters[METER_PEAK_DISCHARGE].sample(peak_discharge_w, now)
+        self.meters[METER_PEAK_SHAVED].sample(peak_shaved_w, now)
+        self.meters[METER_SOLAR_OVERRIDE].sample(solar_override_w, now)
+
+        changed = False
+        for name, meter in self.meters.items():
+            if meter.total_kwh - self._published[name] >= PUBLISH_RESOLUTION_KWH:
+                self._published[name] = meter.total_kwh
+                changed = True
+        if changed:
+            for listener in list(self._listeners):
+                listener()
+
+    def async_add_listener(self, update_callback):
+        self._listeners.append(update_callback)
+
+        def remove_listener():
+            if update_callback in self._listeners:
+                self._listeners.remove(update_callback)
+
+        return remove_listener
+
+    def diagnostics(self):
+        return {name: round(meter.total_kwh, 3) for name, meter in self.meters.items()}
@@ -0,0 +1,108 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# filters.py
+# Dödbandsfilter för inkommande state_changed-händelser.
+# Många elmätare skickar händelser för oförändrade värden (eller bara ändrade attribut).
+# Filtret släpper bara igenom händelser där värdet har rört sig minst dödbandet sedan
+# förra släppta händelsen, men släpper alltid igenom värden nära beslutsgränserna.
+
+from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN # type: ignore
+
+
+class DeadbandFilter:
+    """Filtrerar numeriska händelser per entitet med absoluta dödband.
+
+    thresholds_for(entity_id) returnerar beslutsgränserna uttryckta i entitetens egna
+    värden, eller None om alla händelser ska släppas igenom (t.ex. under en aktiv topp).
+    generation() (valfri) returnerar det som gränserna bygger på. När värdet ändras börjar
+    filtret om, så att nästa händelse från varje entitet släpps igenom.
+    """
+
+    def __init__(self, deadbands, thresholds_for, generation=None):
+        # Entiteter utan dödband (t.ex. status-sensorn) filtreras inte
+        self.deadbands = {entity_id: float(db) for entity_id, db in deadbands.items() if entity_id}
+        self._thresholds_for = thresholds_for
+        self._generation = generation
+        self._last_generation = None
+        self._last_passed = {}
+        self.resets = 0
+        self.stats = {"passed": 0, "filtered": 0}
+        self.per_entity = {entity_id: {"passed": 0, "filtered": 0} for entity_id in self.deadbands}
+
+    def accept(self, entity_id, new_state):
+        """Returnerar True om händelsen ska utvärderas."""
+        deadband = self.deadbands.get(entity_id)
+        if deadband is None:
+            self._count(entity_id, "passed")
+            return True
+
+        if self._generation is not None:
+            generation = self._generation()
+            if generation != self._last_generation:
+                self._last_generation = generation
+                self.reset()
+
+        value = None
+        if new_state is not None and new_state.state not in (STATE_UNKNOWN, STATE_UNAVAILABLE):
+            try:
+                value = float(new_state.state)
+            except (TypeError, ValueError):
+                value = None
+
+        if value is None or self._should_pass(entity_id, value, deadband):
+            self._last_passed[entity_id] = value
+            self._count(entity_id, "passed")
+            return True
+
+        self._count(entity_id, "filtered")
+        return False
+
+    def reset(self):
+        """Glömmer de senast släppta värdena: nästa händelse från varje entitet utvärderas."""
+        if self._last_passed:
+            self._last_passed.clear()
+            self.resets += 1
+
+    def _should_pass(self, entity_id, value, deadband):
+        last = self._last_passed.get(entity_id)
+        if last is None:
+            return True
+        delta = abs(value - last)
+        if delta > 0 and delta >= deadband:
+            return True
+
+        thresholds = self._thresholds_for(entity_id)
+        if thresholds is None:
+            return True
+        if delta == 0:
+            # Oförändrat värde (bara attributen har ändrats)
+            return False
+        # Nära en gräns (eller passerar den) släpps allt igenom
+        return any(abs(value - t) <= deadband or (last < t) != (value < t) for t in thresholds)
+
+    def _count(self, entity_id, key):
+        self.stats[key] += 1
+        # Entiteter utan dödband räknas också (läggs till vid första händelsen)
+        self.per_entity.setdefault(entity_id, {"passed": 0, "filtered": 0})[key] += 1
+
+    def diagnostics(self):
+        return {
+            "deadbands_w": dict(self.deadbands),
+            "stats": dict(self.stats),
+            "resets": self.resets,
+            "per_entity": {entity_id: dict(counts) for entity_id, counts in self.per_entity.items()},
+        }
@@ -0,0 +1,252 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# hourly_stats.py
+# Timstatistik för PeakGuard i HA:s långtidsstatistik (external statistics).
+# Varje utvärdering uppdaterar en ackumulator i minnet (O(1)). En gång i timmen skrivs
+# de avslutade timmarna i ett anrop per statistik-id: max/medel/min-last, kapad energi
+# och antal sekunder med aktiv topp. En fråga om "månadens tre högsta toppar" läser då
+# några hundra rader i stället för alla råa state-rader.
+# Statistik-id:na innehåller config entryns id, så att två installationer inte skriver över varandra.
+
+import logging
+from collections import deque
+from dataclasses import dataclass
+from datetime import timedelta
+from homeassistant.components.recorder import get_instance # type: ignore
+from homeassistant.components.recorder.models import StatisticData, StatisticMetaData # type: ignore
+from homeassistant.components.recorder.statistics import ( # type: ignore
+    async_add_external_statistics,
+    get_last_statistics,
+)
+from .const import DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+STAT_LOAD = f"{DOMAIN}:peak_guard_load"
+STAT_SHAVED_ENERGY = f"{DOMAIN}:peak_shaved_energy"
+STAT_ACTIVE_TIME = f"{DOMAIN}:peak_active_time"
+
+# Ett värde gäller högst så här länge (s) om inga nya utvärderingar kommer
+MAX_SAMPLE_GAP_S = 300.0
+
+# Avslutade timmar som väntar på att skrivas (om recorder inte är igång sparas högst två dygn)
+MAX_PENDING_HOURS = 48
+
+
+@dataclass(frozen=True, slots=True)
+class HourAggregate:
+    start: object         # Timmens början (UTC)
+    max_load_w: float
+    min_load_w: float
+    mean_load_w: float    # Tidsviktat medel
+    shaved_kwh: float     # Kapad energi under timmen
+    active_s: float       # Sekunder med aktiv topp
+
+
+def _hour_of(now):
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+class HourlyAccumulator:
+    """Bygger timaggregat stegvis. Värdet från en utvärdering gäller fram till nästa."""
+
+    def __init__(self):
+        self.pending = deque(maxlen=MAX_PENDING_HOURS)
+        self._hour = None
+        self._last_time = None
+        self._load_w = 0.0
+        self._active = False
+        self._shaved_at_start = 0.0
+        self._shaved_total = 0.0
+        self._reset_hour()
+
+    def _reset_hour(self):
+        self._max = None
+        self._min = None
+        self._load_ws = 0.0     # Integrerad last (W·s)
+        self._covered_s = 0.0
+        self._active_s = 0.0
+
+    def sample(self, load_w, active, shaved_total_kwh, now):
+        """Lägger till en utvärdering (now = UTC datetime)."""
+        if self._hour is None:
+            self._start_hour(_hour_of(now), now, shaved_total_kwh)
+        else:
+            self._advance(now, shaved_total_kwh)
+        self._load_w = load_w
+        self._active = active
+        self._shaved_total = shaved_total_kwh
+        self._max = load_w if self._max is None else max(self._max, load_w)
+        self._min = load_w if self._min is None else min(self._min, load_w)
+
+    def close_due_hours(self, now, shaved_total_kwh=None):
+        """Avslutar timmen om den är slut (anropas av timern, även utan nya utvärderingar)."""
+        if self._hour is None:
+            return
+        if shaved_total_kwh is None:
+            shaved_total_kwh = self._shaved_total
+        self._advance(now, shaved_total_kwh)
+        self._shaved_total = shaved_total_kwh
+
+    def _advance(self, now, shaved_total_kwh):
+        hour_end = self._hour + timedelta(hours=1)
+        if now >= hour_end:
+            self._integrate(hour_end)
+            self._close(shaved_total_kwh)
+            # Långt uppehåll: det gamla värdet gäller inte in i den nya timmen
+            gap = (now - hour_end).total_seconds()
+            new_hour = _hour_of(now)
+            self._start_hour(new_hour, new_hour if gap < MAX_SAMPLE_GAP_S else now, shaved_total_kwh)
+            if self._last_time == new_hour:
+                # Värdet från förra timmen gäller från timmens början
+                self._max = self._min = self._load_w
+        self._integrate(now)
+
+    def _start_hour(self, hour, since, shaved_total_kwh):
+        self._hour = hour
+        self._last_time = since
+        self._shaved_at_start = shaved_total_kwh
+        self._reset_hour()
+
+    def _integrate(self, until):
+        dt = min(max(0.0, (until - self._last_time).total_seconds()), MAX_SAMPLE_GAP_S)
+        self._load_ws += self._load_w * dt
+        self._covered_s += dt
+        if self._active:
+            self._active_s += dt
+        self._last_time = until
+
+    def _close(self, shaved_total_kwh):
+        if self._max is None:
+            return
+        mean = self._load_ws / self._covered_s if self._covered_s else self._load_w
+        self.pending.append(HourAggregate(
+            start=self._hour,
+            max_load_w=self._max,
+            min_load_w=self._min,
+            mean_load_w=mean,
+            shaved_kwh=max(0.0, shaved_total_kwh - self._shaved_at_start),
+            active_s=self._active_s,
+        ))
+
+    def drop_pending(self, count):
+        """Tar bort de `count` äldsta timmarna (efter att de har skrivits)."""
+        for _ in range(min(count, len(self.pending))):
+            self.pending.popleft()
+
+
+def statistic_id(base, entry_id=None):
+    """Statistik-id för en config entry (HA kräver gemener, siffror och _ efter kolon)."""
+    if not entry_id:
+        return base
+    return f"{base}_{''.join(c if c.isalnum() else '_' for c in str(entry_id).lower())}"
+
+
+class HourlyStatisticsWriter:
+    """Skriver avslutade timmar till HA:s långtidsstatistik, en gång per timme."""
+
+    def __init__(self, hass, accumulator, energy_total, entry_id=None):
+        self.hass = hass
+        self.accumulator = accumulator
+        self._energy_total = energy_total  # Funktion som returnerar kapad energi totalt (kWh)
+        self.statistic_ids = {
+            base: statistic_id(base, entry_id) for base in (STAT_LOAD, STAT_SHAVED_ENERGY, STAT_ACTIVE_TIME)
+        }
+        self._sums = None  # Löpande summor, hämtas från recorder vid första skrivningen
+        self.stats = {"flushes": 0, "hours_written": 0, "errors": 0}
+
+    async def async_hourly(self, now):
+        """Timer-callback (strax efter varje heltimme)."""
+        self.accumulator.close_due_hours(now, self._energy_total())
+        await self.async_flush()
+
+    async def async_flush(self):
+        if not self.accumulator.pending:
+            return
+        if "recorder" not in self.hass.config.components:
+            _LOGGER.debug("Recorder is not loaded. Keeping hourly PeakGuard statistics in memory.")
+            return
+        # Timmarna och summorna tas bort/uppdateras först när allt har skrivits. Misslyckas
+        # ett anrop försöker nästa timme igen med samma timmar (start-tiden gör det idempotent).
+        try:
+            if self._sums is None:
+                self._sums = await self._async_last_sums()
+            hours = list(self.accumulator.pending)
+            sums = self._write(hours)
+        except Exception as e:
+            self.stats["errors"] += 1
+            _LOGGER.warning(f"Could not write hourly PeakGuard statistics: {e}")
+            return
+        self._sums = sums
+        self.accumulator.drop_pending(len(hours))
+        self.stats["flushes"] += 1
+        self.stats["hours_written"] += len(hours)
+
+    async def _async_last_sums(self):
+        """Senaste summan för varje summerad statistik (så att summorna fortsätter efter en omstart)."""
+        sums = {}
+        for base in (STAT_SHAVED_ENERGY, STAT_ACTIVE_TIME):
+            stat_id = self.statistic_ids[base]
+            last = await get_instance(self.hass).async_add_executor_job(
+                get_last_statistics, self.hass, 1, stat_id, True, {"sum"}
+            )
+            rows = last.get(stat_id) if last else None
+            sums[base] = (rows[0].get("sum") or 0.0) if rows else 0.0
+        return sums
+
+    def _write(self, hours):
+        """Skriver timmarna och returnerar de nya summorna (sparas av anroparen)."""
+        sums = dict(self._sums)
+        load_rows, shaved_rows, active_rows = [], [], []
+        for hour in hours:
+            load_rows.append(StatisticData(
+                start=hour.start, mean=hour.mean_load_w, min=hour.min_load_w, max=hour.max_load_w
+            ))
+            sums[STAT_SHAVED_ENERGY] += hour.shaved_kwh
+            shaved_rows.append(StatisticData(
+                start=hour.start, state=hour.shaved_kwh, sum=sums[STAT_SHAVED_ENERGY]
+            ))
+            sums[STAT_ACTIVE_TIME] += hour.active_s
+            active_rows.append(StatisticData(
+                start=hour.start, state=hour.active_s, sum=sums[STAT_ACTIVE_TIME]
+            ))
+
+        ids = self.statistic_ids
+        async_add_external_statistics(
+            self.hass, _metadata(ids[STAT_LOAD], "PeakGuard load", "W", mean=True), load_rows
+        )
+        async_add_external_statistics(
+            self.hass, _metadata(ids[STAT_SHAVED_ENERGY], "PeakGuard shaved energy", "kWh"), shaved_rows
+        )
+        async_add_external_statistics(
+            self.hass, _metadata(ids[STAT_ACTIVE_TIME], "PeakGuard active time", "s"), active_rows
+        )
+        return sums
+
+    def diagnostics(self):
+        return {**self.stats, "pending_hours": len(self.accumulator.pending)}
+
+
+def _metadata(statistic_id, name, unit, mean=False):
+    return StatisticMetaData(
+        has_mean=mean,
+        has_sum=not mean,
+        name=name,
+        source=DOMAIN,
+        statistic_id=statistic_id,
+        unit_of_measurement=unit,
+    )
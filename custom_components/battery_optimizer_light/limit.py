@@ -0,0 +1,135 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# limit.py
+# Effektgränsen som PeakGuard bevakar. Källan är en sensor/input_number eller ett fast värde.
+# Värdet cachas och uppdateras bara när källans eget state ändras. Enheten tas från
+# unit_of_measurement; bara om enhet saknas gissas den utifrån storleken (som tidigare).
+# Med ett lokalt schema (schedule.py) gäller schemats gräns, och källan bara i de fönster
+# som inte anger någon egen gräns.
+
+import logging
+import math
+from homeassistant.core import callback # type: ignore
+from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN # type: ignore
+from homeassistant.helpers.event import async_track_state_change_event # type: ignore
+
+_LOGGER = logging.getLogger(__name__)
+
+# Omräkning till Watt
+UNIT_FACTORS = {"W": 1.0, "kW": 1000.0, "MW": 1000000.0}
+
+
+def state_to_watts(state):
+    """Tolkar ett state som effekt i W. Returnerar None om värdet saknas.
+
+    Ogiltiga värden ger ValueError, precis som float().
+    """
+    if state is None or state.state in (STATE_UNKNOWN, STATE_UNAVAILABLE):
+        return None
+    value = float(state.state)
+    unit = state.attributes.get("unit_of_measurement")
+    factor = UNIT_FACTORS.get(unit) if isinstance(unit, str) else None
+    if factor is not None:
+        return value * factor
+    # Okänd enhet: små värden antas vara kW
+    return value * 1000 if value < 100 else value
+
+
+class PeakLimit:
+    """Cachat gränsvärde (W) från en entitet eller ett fast värde."""
+
+    def __init__(self, hass, entity_id=None, fixed_kw=None, schedule=None):
+        self.hass = hass
+        self.entity_id = entity_id
+        self.fixed_w = float(fixed_kw) * 1000.0 if fixed_kw else None
+        self.schedule = schedule  # LimitSchedule eller None
+        self.refresh_count = 0
+        self._tracking = False
+        self._state = None
+        self._raw = None
+        self._value_w = None
+
+    @property
+    def source(self):
+        return "fixed" if self.fixed_w is not None else self.entity_id
+
+    def value_w(self):
+        """Returnerar gränsvärdet i W (None om källan inte har något giltigt värde).
+
+        Utanför schemats fönster (eller i ett fönster utan gräns) är värdet math.inf.
+        """
+        if self.schedule is not None:
+            scheduled_w = self.schedule.value_w()
+            if scheduled_w is not None:
+                return scheduled_w
+        if self.fixed_w is not None:
+            return self.fixed_w
+        if not self._tracking:
+            # Ingen bevakning startad (t.ex. i tester): läs state direkt, tolkningen cachas ändå
+            self._refresh(self.hass.states.get(self.entity_id))
+        return self._value_w
+
+    def cached_w(self):
+        """Senast kända gränsvärde (W) utan att läsa eller tolka state (t.ex. för metrics)."""
+        if self.schedule is not None and self.schedule.cached_w is not None:
+            return self.schedule.cached_w
+        if self.fixed_w is not None:
+            return self.fixed_w
+        return self._value_w
+
+    @callback
+    def async_track(self):
+        """Startar bevakning av källan. Returnerar en funktion som stoppar bevakningen."""
+        if self.fixed_w is not None or not self.entity_id:
+            return None
+        self._tracking = True
+        self._refresh(self.hass.states.get(self.entity_id))
+        unsub = async_track_state_change_event(self.hass, [self.entity_id], self._handle_state_change)
+
+        @callback
+        def stop():
+            self._tracking = False
+            unsub()
+
+        return stop
+
+    @callback
+    def _handle_state_change(self, event):
+        self._refresh(event.data.get("new_state"))
+
+    def _refresh(self, state):
+        if state is not None and state is self._state and state.state == self._raw:
+            return
+        self._state = state
+        self._raw = state.state if state is not None else None
+        self.refresh_count += 1
+        try:
+            self._value_w = state_to_watts(state)
+        except ValueError:
+            _LOGGER.warning(f"Peak limit {self.entity_id} has an invalid value: {self._raw}")
+            self._value_w = None
+
+    def diagnostics(self):
+        value_w = self.value_w()
+        return {
+            "source": self.source,
+            "value_w": value_w if value_w is None or math.isfinite(value_w) else "unlimited",
+            "source_value_w": self._value_w if self.fixed_w is None else self.fixed_w,
+            "tracking": self._tracking,
+            "refresh_count": self.refresh_count,
+            "schedule": self.schedule.diagnostics() if self.schedule is not None else None,
+        }
@@ -0,0 +1,79 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# metrics.py
+# Enkla mätvärden i minnet (histogram) för diagnostik. Allt är begränsat i storlek
+# så att det kan uppdateras på varje händelse och läsas ut direkt.
+
+from bisect import bisect_left
+
+# Hinkar i sekunder, från 1 ms upp till 10 s
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """Histogram med fasta hinkar för latensmätningar (sekunder)."""
+
+    __slots__ = ("buckets", "counts", "count", "total", "max")
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # En extra hink för värden över den största gränsen (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        """Returnerar histogrammet i ett format som passar diagnostik (millisekunder)."""
+        buckets = {f"le_{b * 1000:g}ms": c for b, c in zip(self.buckets, self.counts[:-1], strict=True)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+            "buckets": buckets,
+        }
+
+
+# Hinkar för uppnådd/begärd effekt (andel)
+DEFAULT_RATIO_BUCKETS = (0.25, 0.5, 0.75, 0.9, 1.1, 1.25, 1.5)
+
+
+class RatioHistogram(LatencyHistogram):
+    """Histogram för kvoter, t.ex. uppnådd effekt delat med begärd."""
+
+    __slots__ = ()
+
+    def __init__(self, buckets=DEFAULT_RATIO_BUCKETS):
+        super().__init__(buckets)
+
+    def as_dict(self):
+        buckets = {f"le_{b * 100:g}%": c for b, c in zip(self.buckets, self.counts[:-1], strict=True)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else None,
+            "max": round(self.max, 3),
+            "buckets": buckets,
+        }
@@ -0,0 +1,154 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# models.py
+# Typad modell för svaret från /signal. Svaret tolkas och valideras en gång per anrop,
+# sedan läser sensorer och PeakGuard vanliga attribut (inga .get() med utspridda defaults).
+
+import math
+from dataclasses import dataclass, replace
+from datetime import datetime
+from enum import StrEnum
+import homeassistant.util.dt as dt_util
+
+# Standardvärden när backend inte skickar fältet
+DEFAULT_PEAK_POWER_KW = 12.0     # Högt, för att inte trigga i onödan
+DEFAULT_MAX_DISCHARGE_KW = 3.3   # Växelriktarens max om backend inte anger något
+
+
+class InvalidSignal(ValueError):
+    """Svaret från /signal har fel format."""
+
+
+class Action(StrEnum):
+    CHARGE = "CHARGE"
+    DISCHARGE = "DISCHARGE"
+    HOLD = "HOLD"
+    IDLE = "IDLE"
+    UNKNOWN = "UNKNOWN"  # Okänt läge från backend -> PeakGuard gör inget
+
+    @classmethod
+    def parse(cls, value):
+        try:
+            return cls(str(value).strip().upper())
+        except ValueError:
+            return cls.UNKNOWN
+
+
+def _number(data, key, default, minimum=None, maximum=None):
+    value = data.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        raise InvalidSignal(f"{key} must be a number, got {value!r}")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidSignal(f"{key} must be a number, got {value!r}") from None
+    if not math.isfinite(value):
+        raise InvalidSignal(f"{key} must be finite, got {value!r}")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise InvalidSignal(f"{key} is out of range: {value}")
+    return value
+
+
+@dataclass(frozen=True, slots=True)
+class SignalData:
+    """Ett tolkat /signal-svar (från molnet eller den lokala reservplanen)."""
+
+    action: Action = Action.HOLD
+    target_power_kw: float = 0.0
+    reason: str = "Unknown"
+    min_soc_buffer: float = 0.0
+    peak_power_kw: float = DEFAULT_PEAK_POWER_KW
+    max_discharge_kw: float = DEFAULT_MAX_DISCHARGE_KW
+    is_peak_shaving_active: bool = True
+    peakguard_status: str | None = None
+    source: str = "cloud"               # "cloud" eller "local"
+    received_at: datetime | None = None  # När svaret togs emot (för att avgöra hur gammalt det är)
+
+    @classmethod
+    def from_response(cls, data, received_at=None):
+        """Tolkar och validerar ett råsvar. Felaktiga svar ger InvalidSignal."""
+        if not isinstance(data, dict):
+            raise InvalidSignal(f"Expected a JSON object, got {type(data).__name__}")
+
+        action = data.get("action")
+        if action is not None and not isinstance(action, str):
+            raise InvalidSignal(f"action must be a string, got {action!r}")
+
+        reason = data.get("reason")
+        status = data.get("peakguard_status")
+        active = data.get("is_peak_shaving_active", True)
+        return cls(
+            action=Action.parse(action) if action is not None else Action.HOLD,
+            target_power_kw=_number(data, "target_power_kw", 0.0),
+            reason=str(reason) if reason is not None else "Unknown",
+            min_soc_buffer=_number(data, "min_soc_buffer", 0.0, minimum=0.0, maximum=100.0),
+            peak_power_kw=_number(data, "peak_power_kw", DEFAULT_PEAK_POWER_KW, minimum=0.0),
+            max_discharge_kw=_number(data, "max_discharge_kw", DEFAULT_MAX_DISCHARGE_KW, minimum=0.0),
+            is_peak_shaving_active=bool(active) if active is not None else True,
+            peakguard_status=str(status) if status else None,
+            source=str(data.get("source") or "cloud"),
+            received_at=received_at or dt_util.utcnow(),
+        )
+
+    @property
+    def peak_guard_enabled(self):
+        """False om backend har stängt av effektvakten (flaggan eller en status annan än Active)."""
+        if self.peakguard_status and self.peakguard_status != "Active":
+            return False
+        return self.is_peak_shaving_active
+
+    @property
+    def target_power_w(self):
+        return self.target_power_kw * 1000.0
+
+    @property
+    def max_discharge_w(self):
+        return self.max_discharge_kw * 1000.0
+
+    def age(self, now=None):
+        """Hur gammalt svaret är (timedelta), eller None om tiden är okänd."""
+        if self.received_at is None:
+            return None
+        return (now or dt_util.utcnow()) - self.received_at
+
+    def with_plan(self, action, target_power_kw, reason):
+        """Kopia med den lokala planens beslut (övriga fält från senaste molnsvaret behålls)."""
+        return replace(
+            self,
+            action=Action.parse(action),
+            target_power_kw=float(target_power_kw),
+            reason=reason,
+            source="local",
+            received_at=dt_util.utcnow(),
+        )
+
+    def as_dict(self):
+        """För diagnostik."""
+        return {
+            "action": self.action.value,
+            "target_power_kw": self.target_power_kw,
+            "reason": self.reason,
+            "min_soc_buffer": self.min_soc_buffer,
+            "peak_power_kw": self.peak_power_kw,
+            "max_discharge_kw": self.max_discharge_kw,
+            "is_peak_shaving_active": self.is_peak_shaving_active,
+            "peakguard_status": self.peakguard_status,
+            "source": self.source,
+            "received_at": self.received_at.isoformat() if self.received_at else None,
+        }
@@ -0,0 +1,112 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# phases.py
+# Säkringsskydd per fas. Huvudsäkringen löser ut på den mest belastade fasen, så en
+# enfasig ugn kan överlasta L1 trots att den totala effekten är långt under gränsen.
+# Alla faser utvärderas i en genomgång, och resultatet uttrycks i Watt för växelriktaren
+# (som bara kan avlasta de faser den är kopplad till).
+
+import math
+from dataclasses import dataclass
+from homeassistant.const import STATE_UNAVAILABLE, STATE_UNKNOWN # type: ignore
+from .limit import UNIT_FACTORS
+
+NOMINAL_VOLTAGE_V = 230.0
+PHASES = ("L1", "L2", "L3")
+CURRENT_FACTORS = {"A": 1.0, "mA": 0.001}
+
+
+def state_to_amps(state, voltage=NOMINAL_VOLTAGE_V):
+    """Tolkar ett fas-state som ström (A). Effekt (W/kW) räknas om med nominell spänning.
+
+    Returnerar None om värdet saknas. Ogiltiga värden ger ValueError, precis som float().
+    """
+    if state is None or state.state in (STATE_UNKNOWN, STATE_UNAVAILABLE):
+        return None
+    value = float(state.state)
+    unit = state.attributes.get("unit_of_measurement")
+    if unit in CURRENT_FACTORS:
+        return value * CURRENT_FACTORS[unit]
+    if unit in UNIT_FACTORS:
+        return value * UNIT_FACTORS[unit] / voltage
+    # Okänd enhet: fas-sensorer är oftast ström
+    return value
+
+
+@dataclass(frozen=True, slots=True)
+class PhaseHeadroom:
+    """Resultatet av en genomgång av faserna."""
+
+    fuse_a: float
+    currents_a: dict          # Uppmätt ström per fas (med batteriets bidrag)
+    virtual_a: dict           # Ström per fas utan batteriet
+    worst_phase: str | None   # Mest belastade fasen som växelriktaren matar
+    excess_w: float           # > 0: urladdning som behövs. < 0: utrymme för laddning (W)
+    uncovered: tuple          # Överlastade faser som växelriktaren inte kan avlasta
+    utilization: float        # Högsta ström / säkring (alla faser)
+
+    def as_dict(self):
+        return {
+            "fuse_a": self.fuse_a,
+            "currents_a": {p: round(c, 1) for p, c in self.currents_a.items()},
+            "virtual_a": {p: round(c, 1) for p, c in self.virtual_a.items()},
+            "worst_phase": self.worst_phase,
+            "excess_w": round(self.excess_w) if math.isfinite(self.excess_w) else None,
+            "uncovered": list(self.uncovered),
+            "utilization": round(self.utilization, 2),
+        }
+
+
+def evaluate_phases(currents_a, fuse_a, inverter_phases, battery_w=0.0, voltage=NOMINAL_VOLTAGE_V):
+    """Räknar fram marginalen mot säkringen för alla faser i en genomgång.
+
+    currents_a: uppmätt ström per fas ({"L1": 12.3, ...}), import positiv.
+    inverter_phases: faserna som växelriktaren matar. Effekten antas delas lika mellan dem.
+    battery_w: batteriets effekt (positiv vid urladdning). Den räknas bort så att resultatet
+    gäller växelriktarens totala börvärde, på samma sätt som den virtuella lasten.
+    """
+    fed = [p for p in inverter_phases if p in currents_a]
+    share = len(inverter_phases) or 1
+    battery_a = battery_w / share / voltage
+
+    virtual = {}
+    excess_w = None
+    worst_phase = None
+    uncovered = []
+    utilization = 0.0
+    for phase, measured in currents_a.items():
+        current = measured + battery_a if phase in fed else measured
+        virtual[phase] = current
+        utilization = max(utilization, current / fuse_a)
+        if phase in fed:
+            # Effekt som växelriktaren behöver ge (eller får ta) för att fasen ska ligga på säkringen
+            phase_excess_w = (current - fuse_a) * voltage * share
+            if excess_w is None or phase_excess_w > excess_w:
+                excess_w = phase_excess_w
+                worst_phase = phase
+        elif current > fuse_a:
+            uncovered.append(phase)
+
+    return PhaseHeadroom(
+        fuse_a=fuse_a,
+        currents_a=dict(currents_a),
+        virtual_a=virtual,
+        worst_phase=worst_phase,
+        excess_w=excess_w if excess_w is not None else float("-inf"),
+        uncovered=tuple(uncovered),
+        utilization=utilization,
+    )
@@ -0,0 +1,134 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# planner.py
+# Lokal reservplanering när molnet inte svarar.
+# Läser spotpriser (Nordpool-format) och räknar fram ett schema (CHARGE/DISCHARGE/HOLD)
+# med dynamisk programmering över tidsluckorna. Beräkningen är vektoriserad över
+# SoC-nivåerna och körs i en executor-tråd (numpy importeras först där).
+
+from dataclasses import dataclass, field
+from datetime import datetime
+
+SOC_LEVELS = 100           # Upplösning i SoC (1 % per nivå)
+CHARGE_EFFICIENCY = 0.95   # Verkningsgrad vid laddning
+DISCHARGE_EFFICIENCY = 0.95  # Verkningsgrad vid urladdning
+
+
+@dataclass(frozen=True)
+class PriceSlot:
+    start: datetime
+    end: datetime
+    price: float
+
+    @property
+    def hours(self):
+        return (self.end - self.start).total_seconds() / 3600.0
+
+
+@dataclass(frozen=True)
+class LocalPlan:
+    """Resultatet av den lokala planeringen. slots[0] gäller för nuvarande lucka."""
+    action: str
+    target_power_kw: float
+    slots: list = field(default_factory=list)  # [(start, action)]
+
+
+def _parse_time(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def parse_price_slots(attributes, now):
+    """Läser raw_today/raw_tomorrow (Nordpool) och returnerar kommande luckor."""
+    slots = []
+    for key in ("raw_today", "raw_tomorrow"):
+        for item in attributes.get(key) or []:
+            try:
+                price = item.get("value")
+                if price is None:
+                    continue
+                slot = PriceSlot(_parse_time(item["start"]), _parse_time(item["end"]), float(price))
+                if slot.end <= now or slot.hours <= 0:
+                    continue
+            except (KeyError, TypeError, ValueError):
+                # Trasig lucka (eller tid utan tidszon) hoppas över
+                continue
+            slots.append(slot)
+    slots.sort(key=lambda s: s.start)
+    return slots
+
+
+def plan_schedule(slots, soc_pct, capacity_kwh, max_power_kw, min_soc_pct=0.0):
+    """Räknar fram billigaste schemat med dynamisk programmering.
+
+    Tillståndet är SoC-nivån (0..SOC_LEVELS). För varje lucka väljs laddning eller urladdning
+    med full effekt, eller HOLD. Alla SoC-nivåer räknas samtidigt (vektoriserat), och
+    luckorna gås igenom baklänges. Kvarvarande energi vid horisontens slut värderas till
+    medianpriset så att planen inte tömmer batteriet bara för att horisonten tar slut.
+    """
+    import numpy as np
+
+    if not slots or capacity_kwh <= 0 or max_power_kw <= 0:
+        return LocalPlan("HOLD", 0.0)
+
+    n = SOC_LEVELS
+    kwh_per_level = capacity_kwh / n
+    levels = np.arange(n + 1)
+    min_level = int(np.clip(np.ceil(min_soc_pct / 100.0 * n), 0, n))
+
+    prices = np.array([s.price for s in slots], dtype=float)
+    # Antal nivåer som full effekt flyttar under respektive lucka (minst en)
+    steps = np.maximum(1, np.rint(np.array([max_power_kw * s.hours for s in slots]) / kwh_per_level)).astype(int)
+
+    # Värdet av energi som finns kvar när horisonten tar slut
+    terminal_price = float(np.median(prices))
+    value = -levels * kwh_per_level * DISCHARGE_EFFICIENCY * terminal_price
+
+    # policy[t, nivå] = 0 HOLD, 1 CHARGE, 2 DISCHARGE
+    policy = np.zeros((len(slots), n + 1), dtype=np.int8)
+    for t in range(len(slots) - 1, -1, -1):
+        price = prices[t]
+        up = np.minimum(levels + steps[t], n)
+        down = np.maximum(levels - steps[t], min_level)
+        # Under buffertnivån får vi inte ladda ur alls
+        down = np.where(levels <= min_level, levels, down)
+
+        cost_hold = value
+        cost_charge = (up - levels) * kwh_per_level / CHARGE_EFFICIENCY * price + value[up]
+        cost_discharge = -(levels - down) * kwh_per_level * DISCHARGE_EFFICIENCY * price + value[down]
+
+        costs = np.stack((cost_hold, cost_charge, cost_discharge))
+        choice = np.argmin(costs, axis=0)
+        # Vid lika kostnad väljs HOLD (argmin tar första), vilket undviker onödiga cykler
+        policy[t] = choice
+        value = costs[choice, levels]
+
+    # Simulera framåt från nuvarande SoC för att få ut schemat
+    names = ("HOLD", "CHARGE", "DISCHARGE")
+    level = int(np.clip(round(soc_pct / 100.0 * n), 0, n))
+    schedule = []
+    for t, slot in enumerate(slots):
+        choice = int(policy[t, level])
+        schedule.append((slot.start, names[choice]))
+        if choice == 1:
+            level = min(level + int(steps[t]), n)
+        elif choice == 2:
+            level = max(level - int(steps[t]), min_level)
+
+    action = schedule[0][1]
+    return LocalPlan(action, max_power_kw if action != "HOLD" else 0.0, schedule)
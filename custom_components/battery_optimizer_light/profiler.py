@@ -0,0 +1,261 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# profiler.py
+# Profilering på begäran (tjänsten battery_optimizer_light.profile).
+# cProfile slås bara på medan integrationens egen kod kör: PeakGuard.update, coordinatorns
+# _async_update_data och sensorernas properties. En korutin profileras bara mellan sina
+# await, så andra integrationer som kör under tiden kommer inte med i resultatet.
+# Ingen omstart av HA behövs, och allt återställs när mätningen är klar.
+
+import asyncio
+import cProfile
+import inspect
+import logging
+import os
+import pstats
+from collections import Counter
+from functools import wraps
+import voluptuous as vol  # type: ignore
+import homeassistant.util.dt as dt_util
+from . import sensor
+
+_LOGGER = logging.getLogger(__name__)
+
+# Metoder i sensor-klasserna som räknar ut värden (utöver properties)
+SENSOR_METHODS = ("_refresh_value",)
+
+DEFAULT_PROFILE_S = 60
+MAX_PROFILE_S = 600
+DEFAULT_TOP_N = 20
+MAX_TOP_N = 200
+
+# Tjänstens fält (samma gränser som i services.yaml)
+PROFILE_SCHEMA = vol.Schema({
+    vol.Optional("duration", default=DEFAULT_PROFILE_S): vol.All(
+        vol.Coerce(int), vol.Range(min=1, max=MAX_PROFILE_S)
+    ),
+    vol.Optional("top", default=DEFAULT_TOP_N): vol.All(vol.Coerce(int), vol.Range(min=1, max=MAX_TOP_N)),
+})
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bara en mätning åt gången (cProfile kan inte köras i flera instanser samtidigt)
+_active = None
+
+
+class _ProfiledAwait:
+    """Driver en korutin och har profileraren påslagen bara medan den kör."""
+
+    __slots__ = ("_profiler", "_coro")
+
+    def __init__(self, profiler, coro):
+        self._profiler = profiler
+        self._coro = coro
+
+    def __await__(self):
+        coro = self._coro
+        value = None
+        error = None
+        while True:
+            self._profiler.enter()
+            try:
+                if error is not None:
+                    yielded = coro.throw(error)
+                else:
+                    yielded = coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self._profiler.exit()
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as e:  # Även avbrott (CancelledError) skickas vidare in i korutinen
+                value = None
+                error = e
+
+
+class IntegrationProfiler:
+    """Deterministisk profilering (cProfile) av utvalda ingångar i integrationen."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.calls = Counter()
+        self.errors = 0
+        self._depth = 0
+        self._restore = []
+
+    # --- På/av ---
+
+    def enter(self):
+        if self._depth == 0:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Ett annat profileringsverktyg är aktivt. Mätningen hoppar över anropet.
+                self.errors += 1
+                return
+        self._depth += 1
+
+    def exit(self):
+        if self._depth == 0:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            self.profile.disable()
+
+    def wrap(self, name, func):
+        """Returnerar func inlindad så att den profileras (fungerar för både korutiner och vanliga)."""
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                self.calls[name] += 1
+                return await _ProfiledAwait(self, func(*args, **kwargs))
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            self.enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+        return wrapper
+
+    # --- Instrumentering ---
+
+    def instrument(self, obj, attr, name=None):
+        """Lindar in en metod på ett objekt (instansattribut, tas bort efteråt)."""
+        func = getattr(obj, attr, None)
+        if func is None:
+            return
+        name = name or f"{type(obj).__name__}.{attr}"
+        had_own = attr in vars(obj)
+        original = vars(obj).get(attr)
+        setattr(obj, attr, self.wrap(name, func))
+        if had_own:
+            self._restore.append(lambda: setattr(obj, attr, original))
+        else:
+            self._restore.append(lambda: delattr(obj, attr))
+
+    def instrument_class(self, cls, methods=()):
+        """Lindar in alla properties (och angivna metoder) som klassen själv definierar."""
+        for attr, value in list(vars(cls).items()):
+            if isinstance(value, property) and value.fget is not None:
+                wrapped = property(
+                    self.wrap(f"{cls.__name__}.{attr}", value.fget), value.fset, value.fdel, value.__doc__
+                )
+            elif attr in methods and callable(value):
+                wrapped = self.wrap(f"{cls.__name__}.{attr}", value)
+            else:
+                continue
+            setattr(cls, attr, wrapped)
+            self._restore.append(lambda attr=attr, value=value: setattr(cls, attr, value))
+
+    def restore(self):
+        while self._restore:
+            self._restore.pop()()
+        if self._depth:
+            self._depth = 0
+            self.profile.disable()
+
+    # --- Resultat ---
+
+    def dump(self, path):
+        """Skriver stats-filen (pstats-format, kan öppnas med snakeviz m.fl.). Körs i executor."""
+        self.profile.dump_stats(path)
+
+    def summary(self, top=DEFAULT_TOP_N):
+        """Topp-N funktioner sorterade på kumulativ tid. Körs i executor."""
+        self.profile.create_stats()
+        if not self.profile.stats:
+            return {"total_ms": 0.0, "top": []}
+        stats = pstats.Stats(self.profile).stats
+        rows = []
+        for (filename, lineno, func), (_cc, ncalls, tottime, cumtime, _callers) in stats.items():
+            rows.append({
+                "function": _describe(filename, lineno, func),
+                "calls": ncalls,
+                "own_ms": round(tottime * 1000, 3),
+                "cumulative_ms": round(cumtime * 1000, 3),
+                "integration": filename.startswith(_PACKAGE_DIR),
+            })
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return {
+            "total_ms": round(sum(tottime for _cc, _nc, tottime, _ct, _c in stats.values()) * 1000, 3),
+            "top": rows[:top],
+        }
+
+
+def _describe(filename, lineno, func):
+    if filename == "~":
+        return func  # Inbyggd funktion, t.ex. "<built-in method time.monotonic>"
+    if filename.startswith(_PACKAGE_DIR):
+        filename = os.path.relpath(filename, _PACKAGE_DIR)
+    else:
+        filename = os.path.join(*filename.split(os.sep)[-2:])
+    return f"{filename}:{lineno}({func})"
+
+
+def _sensor_classes():
+    return [
+        cls for cls in vars(sensor).values()
+        if inspect.isclass(cls) and cls.__module__ == sensor.__name__
+    ]
+
+
+async def async_profile(hass, coordinator, peak_guard, duration=DEFAULT_PROFILE_S, top=DEFAULT_TOP_N):
+    """Profilerar integrationen i duration sekunder och returnerar en sammanfattning.
+
+    Stats-filen skrivs till HA:s konfigurationsmapp (/config).
+    """
+    global _active
+    if _active is not None:
+        return {"error": "A profiling session is already running", "started": _active}
+
+    duration = min(max(1, int(duration)), MAX_PROFILE_S)
+    top = min(max(1, int(top)), MAX_TOP_N)
+    started = dt_util.utcnow()
+    profiler = IntegrationProfiler()
+    _active = started.isoformat()
+    try:
+        profiler.instrument(peak_guard, "update", "PeakGuard.update")
+        profiler.instrument(coordinator, "_async_update_data", "Coordinator._async_update_data")
+        for cls in _sensor_classes():
+            profiler.instrument_class(cls, SENSOR_METHODS)
+        _LOGGER.info(f"Profiling Battery Optimizer Light for {duration} s")
+        await asyncio.sleep(duration)
+    finally:
+        profiler.restore()
+        _active = None
+
+    path = hass.config.path(f"battery_optimizer_light_profile_{started.strftime('%Y%m%dT%H%M%S')}.prof")
+    summary = await hass.async_add_executor_job(profiler.summary, top)
+    try:
+        await hass.async_add_executor_job(profiler.dump, path)
+    except OSError as e:
+        _LOGGER.warning(f"Could not write profile stats to {path}: {e}")
+        path = None
+    _LOGGER.info(f"Profiling done ({sum(profiler.calls.values())} calls). Stats written to {path}")
+    return {
+        "duration_s": duration,
+        "stats_file": path,
+        "calls": dict(profiler.calls),
+        "skipped": profiler.errors,
+        **summary,
+    }
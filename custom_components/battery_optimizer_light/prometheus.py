@@ -0,0 +1,202 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# prometheus.py
+# Integrationens räknare och histogram i Prometheus textformat:
+#
+#     GET /api/battery_optimizer_light/metrics   (Authorization: Bearer <långlivad token>)
+#
+# Allt läses från räknarna i minnet (samma som diagnostiken). Ingenting läses från
+# state-maskinen eller recordern, så en skrapning var 15:e sekund kostar nästan inget.
+
+import math
+from aiohttp import web
+from homeassistant.components.http import HomeAssistantView # type: ignore
+from .const import DOMAIN
+from .energy import METERS
+
+PREFIX = "battery_optimizer_light"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Registry:
+    """Samlar mätvärden per familj (en HELP/TYPE per namn, även med flera config entries)."""
+
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, name, kind, help_text):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help_text, [])
+        return family[2]
+
+    def sample(self, name, kind, help_text, value, labels):
+        if value is None:
+            return
+        self._family(f"{PREFIX}_{name}", kind, help_text).append(("", labels, value))
+
+    def counter(self, name, help_text, value, **labels):
+        self.sample(f"{name}_total", "counter", help_text, value, labels)
+
+    def gauge(self, name, help_text, value, **labels):
+        self.sample(name, "gauge", help_text, value, labels)
+
+    def histogram(self, name, help_text, hist, **labels):
+        """Ett LatencyHistogram (eller RatioHistogram) med kumulativa hinkar."""
+        samples = self._family(f"{PREFIX}_{name}", "histogram", help_text)
+        cumulative = 0
+        for bound, count in zip(hist.buckets, hist.counts, strict=False):
+            cumulative += count
+            samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+        samples.append(("_bucket", {**labels, "le": "+Inf"}, hist.count))
+        samples.append(("_sum", labels, hist.total))
+        samples.append(("_count", labels, hist.count))
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(value)
+
+
+def _collect_coordinator(registry, coordinator, entry):
+    registry.gauge("cloud_up", "1 if the last cloud update succeeded", coordinator.last_update_success, entry=entry)
+    for outcome, count in coordinator.stats.items():
+        registry.counter("cloud_signal", "Cloud /signal requests by outcome", count, entry=entry, outcome=outcome)
+    registry.histogram(
+        "cloud_signal_duration_seconds", "Duration of cloud /signal requests", coordinator.signal_latency, entry=entry
+    )
+    reports = coordinator.reports
+    for outcome, count in reports.stats.items():
+        registry.counter("reports", "PeakGuard reports by outcome", count, entry=entry, outcome=outcome)
+    registry.gauge("reports_pending", "PeakGuard reports waiting to be sent", reports.pending_count, entry=entry)
+
+
+def _collect_peak_guard(registry, pg, entry):
+    # Läge
+    registry.gauge("peak_active", "1 while PeakGuard is shaving a peak", pg.is_active, entry=entry)
+    registry.gauge("solar_override", "1 while solar override is active", pg.is_solar_override, entry=entry)
+    registry.gauge("maintenance", "1 while the battery is in maintenance", pg.in_maintenance, entry=entry)
+    registry.gauge("load_watts", "Last evaluated house load", pg._last_load_w, entry=entry)
+    registry.gauge("limit_watts", "Current peak limit (+Inf outside the limit schedule)", pg.limit.cached_w(),
+                   entry=entry)
+
+    # Händelser och utvärderingar
+    if pg.event_filter is not None:
+        for entity_id, counts in pg.event_filter.per_entity.items():
+            for result, count in counts.items():
+                registry.counter(
+                    "events", "State change events by deadband filter result (all tracked entities)", count,
+                    entry=entry, entity_id=entity_id, result=result,
+                )
+    registry.counter("evaluations", "PeakGuard evaluations", pg.pipeline_stats["evaluations"], entry=entry)
+    for outcome, count in pg.pipeline_stats.items():
+        if outcome != "evaluations":
+            registry.counter(
+                "evaluation_outcomes", "Where PeakGuard evaluations stopped", count, entry=entry, outcome=outcome
+            )
+    registry.histogram("update_duration_seconds", "PeakGuard update duration", pg.update_latency, entry=entry)
+    registry.histogram(
+        "event_queue_delay_seconds", "Delay from state change to evaluation", pg.watchdog.queue_delay, entry=entry
+    )
+    for stage, hist in pg.watchdog.stage_latency.items():
+        registry.histogram("stage_duration_seconds", "Time per PeakGuard stage", hist, entry=entry, stage=stage)
+    registry.counter("slow_updates", "Updates over the time budget", pg.watchdog.slow_count, entry=entry)
+
+    # Kommandon och kvittens
+    for (command, result), count in pg.command_counts.items():
+        registry.counter("commands", "Battery commands sent", count, entry=entry, command=command, result=result)
+    actuation = pg.actuation
+    for outcome, count in actuation.stats.items():
+        registry.counter("actuation", "Battery command acknowledgements by outcome", count,
+                         entry=entry, outcome=outcome)
+    registry.histogram(
+        "actuation_response_seconds", "Time from command until the battery follows", actuation.latency, entry=entry
+    )
+    registry.histogram(
+        "actuation_achieved_ratio", "Achieved divided by requested battery power", actuation.achieved, entry=entry
+    )
+    registry.gauge("actuation_pending", "1 while waiting for the battery to follow", actuation.pending is not None,
+                   entry=entry)
+    client = getattr(pg.actuator, "client", None)
+    if client is not None:
+        for key, count in client.stats.items():
+            if key == "max_in_flight":
+                registry.gauge("modbus_max_in_flight", "Most Modbus requests in flight at once", count, entry=entry)
+            else:
+                registry.counter("modbus", "Modbus TCP client operations", count, entry=entry, kind=key)
+        registry.gauge("modbus_connected", "1 while the Modbus connection is open", client.connected, entry=entry)
+
+    # Energi och skuggregulator
+    for meter in METERS:
+        registry.counter("energy_kwh", "Locally integrated energy", pg.energy.total_kwh(meter), entry=entry,
+                         meter=meter)
+    if pg.shadow is not None:
+        for kind, count in pg.shadow.stats.items():
+            registry.counter("shadow", "Shadow controller comparisons", count, entry=entry, kind=kind)
+
+
+def render_metrics(coordinators):
+    """Prometheus-text för alla config entries (entry_id -> coordinator)."""
+    registry = _Registry()
+    for entry, coordinator in coordinators.items():
+        _collect_coordinator(registry, coordinator, entry)
+        peak_guard = getattr(coordinator, "peak_guard", None)
+        if peak_guard is not None:
+            _collect_peak_guard(registry, peak_guard, entry)
+    return registry.render()
+
+
+class BatteryOptimizerMetricsView(HomeAssistantView):
+    """Prometheus-endpoint. Kräver inloggning (långlivad token) som resten av HA:s API."""
+
+    url = f"/api/{DOMAIN}/metrics"
+    name = f"api:{DOMAIN}:metrics"
+    requires_auth = True
+
+    def __init__(self, hass):
+        self.hass = hass
+
+    async def get(self, request):
+        text = render_metrics(self.hass.data.get(DOMAIN, {}))
+        return web.Response(body=text.encode(), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,192 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# reports.py
+# Kö för PeakGuard-händelser (peak, clear, failure, fasöverlast, solar override).
+# Händelserna skickas med i nästa /signal-anrop och kvitteras per händelse i svaret.
+# Brådskande händelser skickas direkt via /report_batch. Om backend inte stödjer
+# batchning används de gamla endpoints (en POST per händelse).
+
+import asyncio
+import logging
+import math
+import time
+import uuid
+from collections import deque
+import homeassistant.util.dt as dt_util
+from homeassistant.helpers.aiohttp_client import async_get_clientsession # type: ignore
+from .const import CONF_API_URL, CONF_API_KEY, DIAGNOSTICS_HISTORY_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+# Händelser som inte kan vänta på nästa /signal (var 5:e minut)
+URGENT_REPORT_TYPES = {"report_peak_failure"}
+
+# Max antal händelser som sparas om molnet är nere (äldsta kastas först)
+MAX_PENDING_REPORTS = 100
+
+
+class ReportQueue:
+    """Samlar händelser och skickar dem batchade till molnet."""
+
+    def __init__(self, hass, config):
+        self.hass = hass
+        self.api_url = config[CONF_API_URL].rstrip('/')
+        self.api_key = config[CONF_API_KEY]
+        self._pending = deque(maxlen=MAX_PENDING_REPORTS)
+        self._flush_lock = asyncio.Lock()
+        self.request_timeout = 10
+        # None = okänt (inget /signal-svar ännu), True/False när backend har svarat
+        self.supports_batching = None
+        self.history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self.stats = {"queued": 0, "acked_via_signal": 0, "sent_via_batch": 0, "sent_legacy": 0, "failed": 0}
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def enqueue(self, endpoint, grid_w, limit_w):
+        """Lägger en händelse i kön. Returnerar True om den bör skickas direkt."""
+        self._pending.append({
+            "id": uuid.uuid4().hex,
+            "type": endpoint,
+            "time": dt_util.utcnow().isoformat(),
+            "grid_power_kw": round(grid_w / 1000.0, 2),
+            "limit_kw": round(limit_w / 1000.0, 2) if math.isfinite(limit_w) else None,
+        })
+        self.stats["queued"] += 1
+        return endpoint in URGENT_REPORT_TYPES or self.supports_batching is False
+
+    def signal_payload(self):
+        """Händelser som skickas med i nästa /signal-anrop."""
+        return list(self._pending)
+
+    def handle_signal_response(self, data):
+        """Tar bort kvitterade händelser. Returnerar True om något återstår att skicka direkt."""
+        acked = data.get("acked_events") if isinstance(data, dict) else None
+        if acked is None:
+            # Äldre backend utan batch-stöd: skicka kön via de gamla endpoints
+            if self.supports_batching is not False:
+                _LOGGER.debug("Backend does not acknowledge events. Using legacy report endpoints.")
+            self.supports_batching = False
+            return bool(self._pending)
+
+        self.supports_batching = True
+        self._remove_acked(acked, "signal")
+        return False
+
+    def _remove_acked(self, acked_ids, via):
+        acked_ids = set(acked_ids)
+        if not acked_ids:
+            return
+        remaining = deque(maxlen=MAX_PENDING_REPORTS)
+        for event in self._pending:
+            if event["id"] in acked_ids:
+                self._record(event, via, status=200)
+                self.stats["acked_via_signal" if via == "signal" else "sent_via_batch"] += 1
+            else:
+                remaining.append(event)
+        self._pending = remaining
+
+    def _record(self, event, via, status=None, error=None, latency=None):
+        self.history.append({
+            "time": dt_util.utcnow().isoformat(),
+            "event_time": event["time"],
+            "endpoint": event["type"],
+            "grid_power_kw": event["grid_power_kw"],
+            "limit_kw": event["limit_kw"],
+            "via": via,
+            "status": status,
+            "error": error,
+            "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        })
+
+    async def async_flush(self):
+        """Skickar väntande händelser direkt (batch-endpoint eller en och en)."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            session = async_get_clientsession(self.hass)
+            if self.supports_batching is not False and await self._async_send_batch(session):
+                return
+            await self._async_send_legacy(session)
+
+    async def _async_send_batch(self, session):
+        """Skickar hela kön i ett anrop. Returnerar False om backend saknar endpointen."""
+        events = list(self._pending)
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                f"{self.api_url}/report_batch",
+                json={"api_key": self.api_key, "events": events},
+                timeout=self.request_timeout,
+            ) as resp:
+                if resp.status == 404:
+                    self.supports_batching = False
+                    return False
+                if resp.status != 200:
+                    self.stats["failed"] += 1
+                    for event in events:
+                        self._record(event, "batch", status=resp.status, latency=time.perf_counter() - started)
+                    return True
+                data = await resp.json()
+        except Exception as e:
+            # Behåll händelserna i kön, de följer med nästa /signal
+            self.stats["failed"] += 1
+            _LOGGER.error(f"Failed to send report batch: {e}")
+            return True
+
+        self._remove_acked(data.get("acked_events", []), "batch")
+        return True
+
+    async def _async_send_legacy(self, session):
+        """Skickar varje händelse till sin egen endpoint (äldre backend)."""
+        while self._pending:
+            event = self._pending[0]
+            started = time.perf_counter()
+            payload = {
+                "api_key": self.api_key,
+                "grid_power_kw": event["grid_power_kw"],
+                "limit_kw": event["limit_kw"],
+            }
+            try:
+                async with session.post(
+                    f"{self.api_url}/{event['type']}", json=payload, timeout=self.request_timeout
+                ) as resp:
+                    status = resp.status
+            except Exception as e:
+                self.stats["failed"] += 1
+                self._record(event, "legacy", error=f"{type(e).__name__}: {e}", latency=time.perf_counter() - started)
+                _LOGGER.error(f"Failed to report {event['type']}: {e}")
+                return
+
+            # Oavsett svar tas händelsen bort (samma beteende som tidigare, inga eviga omförsök)
+            if event in self._pending:
+                self._pending.remove(event)
+            self._record(event, "legacy", status=status, latency=time.perf_counter() - started)
+            if status == 200:
+                self.stats["sent_legacy"] += 1
+                _LOGGER.debug(f"Cloud report sent: {event['type']}: {event['grid_power_kw']} kW")
+            else:
+                self.stats["failed"] += 1
+
+    def diagnostics(self):
+        return {
+            "supports_batching": self.supports_batching,
+            "pending": list(self._pending),
+            "stats": dict(self.stats),
+            "history": list(self.history),
+        }
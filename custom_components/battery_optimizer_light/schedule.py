@@ -0,0 +1,199 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# schedule.py
+# Lokalt schema för effektgränsen. Många nätägare tar bara betalt för toppar vissa tider
+# (t.ex. vardagar 07-19 i november-mars), och utanför dem ska batteriet inte slita cykler.
+#
+#     - months: [11, 12, 1, 2, 3]
+#       weekdays: [mon, tue, wed, thu, fri]
+#       start: "07:00"
+#       end: "19:00"          # Tidigare än start = över midnatt
+#       limit_kw: 5.0         # Utelämnad = vanliga gränsen (molnet), "unlimited" = ingen gräns
+#
+# Fönstren kompileras vid start till en sorterad intervalltabell per månad (minut i veckan).
+# Uppslagningen är en bisect (O(log n)), och resultatet gäller tills intervallet eller timmen
+# tar slut, så de flesta händelser bara jämför en tidsstämpel. Utanför alla fönster: ingen gräns.
+# Fönstren gäller i listans ordning (det första som matchar vinner).
+
+import math
+import time
+from bisect import bisect_right
+from dataclasses import dataclass
+import homeassistant.util.dt as dt_util
+
+# Gränsvärde utan gräns (PeakGuard tar då inga toppar, men solar override och laddning fungerar)
+UNLIMITED_W = math.inf
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+@dataclass(frozen=True, slots=True)
+class LimitWindow:
+    months: frozenset
+    weekdays: tuple       # 0 = måndag
+    start: int            # Minut på dygnet
+    end: int              # Minut på dygnet (1440 = midnatt). <= start betyder över midnatt
+    limit_w: float | None  # None = vanliga gränsen, UNLIMITED_W = ingen gräns
+
+    @classmethod
+    def from_config(cls, window):
+        if not isinstance(window, dict):
+            raise ValueError(f"Schedule window must be a mapping, got {window!r}")
+        months = window.get("months") or range(1, 13)
+        weekdays = window.get("weekdays") or WEEKDAYS
+        try:
+            months = frozenset(int(m) for m in months)
+            weekdays = tuple(sorted({WEEKDAYS.index(str(d).strip().lower()[:3]) for d in weekdays}))
+        except ValueError:
+            raise ValueError(f"Invalid months or weekdays in schedule window {window!r}") from None
+        if not months <= frozenset(range(1, 13)):
+            raise ValueError(f"Months must be 1-12 in schedule window {window!r}")
+
+        limit = window.get("limit_kw")
+        if limit is None or str(limit).strip().lower() in ("", "cloud", "default"):
+            limit_w = None
+        elif str(limit).strip().lower() in ("unlimited", "none", "off"):
+            limit_w = UNLIMITED_W
+        else:
+            limit_w = float(limit) * 1000.0
+            if not limit_w > 0:
+                raise ValueError(f"limit_kw must be positive in schedule window {window!r}")
+
+        return cls(
+            months=months,
+            weekdays=weekdays,
+            start=_parse_minute(window.get("start", "00:00")),
+            end=_parse_minute(window.get("end", "24:00")),
+            limit_w=limit_w,
+        )
+
+    def ranges(self):
+        """Fönstrets intervall i minuter från måndag 00:00 (delas vid veckoskiftet)."""
+        length = (self.end - self.start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        for day in self.weekdays:
+            start = day * MINUTES_PER_DAY + self.start
+            end = start + length
+            if end <= MINUTES_PER_WEEK:
+                yield start, end
+            else:
+                yield start, MINUTES_PER_WEEK
+                yield 0, end - MINUTES_PER_WEEK
+
+
+def _parse_minute(value):
+    try:
+        hours, minutes = str(value).strip().split(":")[:2]
+        minute = int(hours) * 60 + int(minutes)
+    except ValueError:
+        raise ValueError(f"Invalid time in schedule: {value!r} (expected HH:MM)") from None
+    if not 0 <= minute <= MINUTES_PER_DAY:
+        raise ValueError(f"Invalid time in schedule: {value!r}")
+    return minute
+
+
+def _compile(windows, month):
+    """Intervalltabell för en månad: (starter, gränser, fönsterindex), sorterad på startminut."""
+    ranges = [
+        (start, end, index)
+        for index, window in enumerate(windows)
+        if month in window.months
+        for start, end in window.ranges()
+    ]
+    bounds = sorted({0} | {s for s, _e, _i in ranges} | {e for _s, e, _i in ranges if e < MINUTES_PER_WEEK})
+    starts, limits, indexes = [], [], []
+    for bound in bounds:
+        index = min((i for s, e, i in ranges if s <= bound < e), default=None)
+        if indexes and indexes[-1] == index:
+            continue  # Samma fönster som intervallet före: slå ihop
+        starts.append(bound)
+        limits.append(windows[index].limit_w if index is not None else UNLIMITED_W)
+        indexes.append(index)
+    return starts, limits, indexes
+
+
+class LimitSchedule:
+    """Effektgränsen enligt ett schema. value_w() returnerar None när den vanliga gränsen gäller."""
+
+    def __init__(self, windows, clock=time.time, local_now=dt_util.now):
+        self.windows = tuple(windows)
+        self._clock = clock
+        self._local_now = local_now
+        # En tabell per månad. Månader med samma fönster delar tabell.
+        compiled = {}
+        self._tables = {}
+        for month in range(1, 13):
+            key = tuple(i for i, w in enumerate(self.windows) if month in w.months)
+            if key not in compiled:
+                compiled[key] = _compile(self.windows, month)
+            self._tables[month] = compiled[key]
+        self._valid_until = -math.inf
+        self._value_w = None
+        self._window = None
+        self.lookups = 0
+        self.transitions = 0  # Antal gånger gränsen har bytt värde (läses av dödbandsfiltret)
+
+    @classmethod
+    def from_config(cls, windows, **kwargs):
+        """Skapar schemat från konfigurationen (lista med fönster). Fel ger ValueError."""
+        if isinstance(windows, dict):
+            windows = [windows]
+        if not isinstance(windows, (list, tuple)):
+            raise ValueError(f"Limit schedule must be a list of windows, got {windows!r}")
+        return cls([LimitWindow.from_config(w) for w in windows], **kwargs)
+
+    @property
+    def cached_w(self):
+        """Gränsen från senaste uppslaget (utan att slå upp på nytt)."""
+        return self._value_w
+
+    def value_w(self):
+        """Gränsen just nu (W), UNLIMITED_W, eller None om den vanliga källan gäller."""
+        if self._clock() < self._valid_until:
+            return self._value_w
+        return self._refresh()
+
+    def _refresh(self):
+        now_ts = self._clock()
+        local = self._local_now()
+        starts, limits, indexes = self._tables[local.month]
+        minute = local.weekday() * MINUTES_PER_DAY + local.hour * 60 + local.minute
+        i = bisect_right(starts, minute) - 1
+        end = starts[i + 1] if i + 1 < len(starts) else MINUTES_PER_WEEK
+        seconds_into_minute = local.second + local.microsecond / 1e6
+        # Gäller till intervallets slut, men högst till nästa hel timme (månadsskifte och sommartid)
+        until_end = (end - minute) * 60 - seconds_into_minute
+        until_hour = (60 - local.minute) * 60 - seconds_into_minute
+        self._valid_until = now_ts + min(until_end, until_hour)
+        if limits[i] != self._value_w:
+            self.transitions += 1
+        self._value_w = limits[i]
+        self._window = indexes[i]
+        self.lookups += 1
+        return self._value_w
+
+    def diagnostics(self):
+        value = self._value_w
+        return {
+            "windows": len(self.windows),
+            "intervals": {month: len(table[0]) for month, table in self._tables.items()},
+            "active_window": self._window,
+            "limit_w": "unlimited" if value == UNLIMITED_W else value,
+            "lookups": self.lookups,
+            "transitions": self.transitions,
+        }
@@ -15,11 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from homeassistant.components.sensor import ( # type: ignore
+    RestoreSensor,
     SensorEntity,
     SensorDeviceClass,
     SensorStateClass,
 )
+from homeassistant.core import callback # type: ignore
 from homeassistant.helpers.entity import DeviceInfo # type: ignore
+from homeassistant.helpers.event import async_track_state_change_event # type: ignore
 from homeassistant.helpers.update_coordinator import CoordinatorEntity # type: ignore
 from homeassistant.const import STATE_UNKNOWN, STATE_UNAVAILABLE, EntityCategory # type: ignore
 from .const import (
@@ -29,6 +32,8 @@ from .const import (
     CONF_VIRTUAL_LOAD_SENSOR,
     CONF_GRID_SENSOR_INVERT,
 )
+from .energy import METER_PEAK_DISCHARGE, METER_PEAK_SHAVED, METER_SOLAR_OVERRIDE
+from .models import Action, DEFAULT_PEAK_POWER_KW
 
 async def async_setup_entry(hass, entry, async_add_entities):
     coordinator = hass.data[DOMAIN][entry.entry_id]
@@ -43,10 +48,32 @@ async def async_setup_entry(hass, entry, async_add_entities):
         BatteryLightVirtualLoadSensor(coordinator),
         BatteryLightChargeTargetSensor(coordinator),
         BatteryLightDischargeTargetSensor(coordinator),
+        BatteryLightResponseTimeSensor(coordinator),
+        BatteryLightEnergySensor(
+            coordinator, METER_PEAK_DISCHARGE, "Optimizer Light Peak Discharge Energy", "mdi:battery-arrow-down"
+        ),
+        BatteryLightEnergySensor(
+            coordinator, METER_PEAK_SHAVED, "Optimizer Light Peak Shaved Energy", "mdi:chart-bell-curve-cumulative"
+        ),
+        BatteryLightEnergySensor(
+            coordinator, METER_SOLAR_OVERRIDE, "Optimizer Light Solar Override Energy", "mdi:solar-power"
+        ),
     ])
 
-class BatteryOptimizerSensorBase(CoordinatorEntity, SensorEntity):
-    """Gemensam basklass för att gruppera sensorer under en Device."""
+class BatteryOptimizerSensorBase(CoordinatorEntity, RestoreSensor):
+    """Gemensam basklass för att gruppera sensorer under en Device.
+
+    Värdet räknas ut en gång per uppdatering (från coordinatorn eller PeakGuard)
+    och sparas i _attr_native_value, så att läsningar av state blir billiga.
+
+    Vid uppstart återställs senast kända värde tills första svaret från molnet
+    har kommit, så att t.ex. PeakGuard har ett gränsvärde direkt.
+    """
+    # Sensorer som bara speglar molnets data visar återställt värde tills ny data finns.
+    # Sensorer som även beror på lokalt tillstånd (PeakGuard) räknas alltid om.
+    _restore_until_refresh = True
+    _restored_value = None
+    _last_available = None  # Tillgänglighet vid senaste skrivningen (ett misslyckat anrop ska synas)
     @property
     def device_info(self) -> DeviceInfo:
         return DeviceInfo(
@@ -57,6 +84,59 @@ class BatteryOptimizerSensorBase(CoordinatorEntity, SensorEntity):
             configuration_url="https://battery-prod.awestinconsulting.se",
         )
 
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        if self._restore_until_refresh and self.coordinator.data is None:
+            last_data = await self.async_get_last_sensor_data()
+            if last_data is not None:
+                self._restored_value = last_data.native_value
+
+        # Lyssna även på PeakGuard, eftersom lokala tillstånd (peak, solar override) påverkar flera sensorer
+        peak_guard = getattr(self.coordinator, "peak_guard", None)
+        if peak_guard is not None:
+            self.async_on_remove(peak_guard.async_add_listener(self._handle_coordinator_update))
+        self._refresh_value()
+
+    def _compute_value(self):
+        """Räknar ut sensorns värde (överlagras av subklasserna). Default är inget värde (unknown)."""
+        return None
+
+    def _compute_icon(self, value):
+        """Returnerar ikonen för ett värde. Default är den statiska ikonen."""
+        return self._attr_icon
+
+    @property
+    def available(self) -> bool:
+        # Ett återställt värde är giltigt tills molnet har svarat (även om första anropet misslyckas)
+        if self.coordinator.data is None and self._restored_value is not None:
+            return True
+        return super().available
+
+    def _refresh_value(self) -> bool:
+        """Uppdaterar cachat värde och ikon. Returnerar True om något (även tillgängligheten) ändrades."""
+        if self.coordinator.data is None and self._restored_value is not None:
+            value = self._restored_value
+        else:
+            value = self._compute_value()
+        icon = self._compute_icon(value)
+        available = self.available
+        if value == self._attr_native_value and icon == self._attr_icon and available == self._last_available:
+            return False
+        self._attr_native_value = value
+        self._attr_icon = icon
+        self._last_available = available
+        return True
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        # Skriv bara till state-maskinen om just den här sensorns värde eller tillgänglighet ändrats
+        if self._refresh_value():
+            self.async_write_ha_state()
+
+    @property
+    def _peak_guard(self):
+        return getattr(self.coordinator, "peak_guard", None)
+
 class BatteryLightActionSensor(BatteryOptimizerSensorBase):
     def __init__(self, coordinator):
         super().__init__(coordinator)
@@ -64,22 +144,24 @@ class BatteryLightActionSensor(BatteryOptimizerSensorBase):
         self._attr_unique_id = f"{coordinator.api_key}_light_action"
         self._attr_icon = "mdi:lightning-bolt-circle"
 
-    @property
-    def state(self):
-        raw_action = (self.coordinator.data or {}).get("action", "UNKNOWN")
+    def _compute_value(self):
+        data = self.coordinator.data
+        if data is None:
+            return Action.UNKNOWN.value
 
         # Om PeakGuard har aktiverat Solar Override, visa IDLE (Auto) istället för HOLD
-        if hasattr(self.coordinator, "peak_guard") and self.coordinator.peak_guard.is_solar_override:
-            if raw_action == "HOLD":
-                return "IDLE"
-        return raw_action
+        pg = self._peak_guard
+        if pg is not None and pg.is_solar_override:
+            if data.action is Action.HOLD:
+                return Action.IDLE.value
+        return data.action.value
 
 class BatteryLightPowerSensor(BatteryOptimizerSensorBase):
     def __init__(self, coordinator):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Power"
         self._attr_unique_id = f"{coordinator.api_key}_light_power"
-        self._attr_unit_of_measurement = "kW"
+        self._attr_native_unit_of_measurement = "kW"
         self._attr_icon = "mdi:flash"
 
         # Talar om för HA att det är effekt -> Ger rätt grafer och färger
@@ -87,11 +169,13 @@ class BatteryLightPowerSensor(BatteryOptimizerSensorBase):
         # Talar om att det är ett mätvärde -> Sparar statistik för långtidshistorik
         self._attr_state_class = SensorStateClass.MEASUREMENT
 
-    @property
-    def state(self):
-        return (self.coordinator.data or {}).get("target_power_kw", 0.0)
+    def _compute_value(self):
+        data = self.coordinator.data
+        return data.target_power_kw if data is not None else 0.0
 
 class BatteryLightReasonSensor(BatteryOptimizerSensorBase):
+    _restore_until_refresh = False
+
     def __init__(self, coordinator):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Reason"
@@ -99,71 +183,73 @@ class BatteryLightReasonSensor(BatteryOptimizerSensorBase):
         self._attr_icon = "mdi:text-box-outline"
         self._attr_entity_category = EntityCategory.DIAGNOSTIC
 
-    @property
-    def state(self):
+    def _compute_value(self):
         # 1. Kolla först om den lokala effektvakten jobbar
         # (Detta skriver över molnets status, vilket är korrekt eftersom lokalt skydd har prio)
-        if hasattr(self.coordinator, "peak_guard"):
-            pg = self.coordinator.peak_guard
+        pg = self._peak_guard
+        if pg is not None:
             if pg.is_active:
                 return "Local Peak Guard Triggered"
             if pg.is_solar_override:
                 return "Solar Override (Local)"
 
         # 2. Annars visa vad molnet säger (t.ex. "Charging due to cheap price")
-        return (self.coordinator.data or {}).get("reason", "Unknown")
+        data = self.coordinator.data
+        return data.reason if data is not None else "Unknown"
 
 class BatteryLightBufferSensor(BatteryOptimizerSensorBase):
     def __init__(self, coordinator):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Buffer Target"
         self._attr_unique_id = f"{coordinator.api_key}_light_buffer"
-        self._attr_unit_of_measurement = "%"
+        self._attr_native_unit_of_measurement = "%"
         self._attr_icon = "mdi:shield-check"
 
         # Visar batteri-procent snyggt i HA
         self._attr_device_class = SensorDeviceClass.BATTERY
 
-    @property
-    def state(self):
-        # Hämtar 'min_soc_buffer' från backend JSON. Default 0.0 om det saknas.
-        return (self.coordinator.data or {}).get("min_soc_buffer", 0.0)
+    def _compute_value(self):
+        # Hämtar 'min_soc_buffer' från backend. Default 0.0 om det saknas.
+        data = self.coordinator.data
+        return data.min_soc_buffer if data is not None else 0.0
 
 class BatteryLightPeakSensor(BatteryOptimizerSensorBase):
     def __init__(self, coordinator):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Peak Limit"
         self._attr_unique_id = f"{coordinator.api_key}_light_peak_limit"
-        self._attr_unit_of_measurement = "kW"
+        self._attr_native_unit_of_measurement = "kW"
         self._attr_icon = "mdi:transmission-tower-export"
         self._attr_device_class = SensorDeviceClass.POWER
 
-    @property
-    def state(self):
+    def _compute_value(self):
         # Hämta värdet från backend. Default 12.0 (högt) om det saknas för att inte trigga i onödan.
-        return (self.coordinator.data or {}).get("peak_power_kw", 12.0)
+        data = self.coordinator.data
+        return data.peak_power_kw if data is not None else DEFAULT_PEAK_POWER_KW
 
 class BatteryLightStatusSensor(BatteryOptimizerSensorBase):
+    _restore_until_refresh = False
+
     def __init__(self, coordinator):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light PeakGuard Status"
         self._attr_unique_id = f"{coordinator.api_key}_peakguard_status"
         self._attr_entity_category = EntityCategory.DIAGNOSTIC
+        self._attr_icon = None
 
-    @property
-    def state(self):
+    def _compute_value(self):
         # Hämtar data från coordinator och lokal peak_guard instans. Först säkerställ att data finns.
-        data = self.coordinator.data or {}
-        is_active = data.get("is_peak_shaving_active", True)
-        pg_status = data.get("peakguard_status")
+        data = self.coordinator.data
+        is_active = data.is_peak_shaving_active if data is not None else True
+        pg_status = data.peakguard_status if data is not None else None
 
         is_triggered = False
         in_maintenance = False
         maintenance_reason = None
         is_solar_override = False
 
-        if hasattr(self.coordinator, "peak_guard"):
-            pg = self.coordinator.peak_guard
+        pg = self._peak_guard
+        if pg is not None:
             is_triggered = pg.is_active
             in_maintenance = pg.in_maintenance
             maintenance_reason = pg.maintenance_reason
@@ -185,10 +271,9 @@ class BatteryLightStatusSensor(BatteryOptimizerSensorBase):
 
         return "Monitoring" if is_active else "Disabled"
 
-    @property
-    def icon(self):
+    def _compute_icon(self, value):
         """Returnerar en dynamisk ikon baserat på status."""
-        status = self.state
+        status = value
         if status == "Disabled" or status == "Off":
             return "mdi:shield-off"
         if "Paused" in status:
@@ -204,15 +289,16 @@ class BatteryLightStatusSensor(BatteryOptimizerSensorBase):
 class BatteryLightVirtualLoadSensor(SensorEntity):
     """Sensor som visar den beräknade virtuella lasten (för verifiering)."""
     def __init__(self, coordinator):
-        # Vi ärver inte från CoordinatorEntity eftersom vi vill polla oftare (default 30s)
-        # eller bara visa beräknat värde, oberoende av moln-uppdateringar.
+        # Vi ärver inte från CoordinatorEntity eftersom värdet inte beror på moln-uppdateringar.
+        # Istället lyssnar vi på källsensorerna och räknar om när de ändras.
         self.coordinator = coordinator
         self._attr_name = "Optimizer Light Virtual Load"
         self._attr_unique_id = f"{coordinator.api_key}_virtual_load"
-        self._attr_unit_of_measurement = "W"
+        self._attr_native_unit_of_measurement = "W"
         self._attr_device_class = SensorDeviceClass.POWER
         self._attr_state_class = SensorStateClass.MEASUREMENT
         self._attr_icon = "mdi:home-lightning-bolt-outline"
+        self._attr_should_poll = False
 
     @property
     def device_info(self) -> DeviceInfo:
@@ -224,8 +310,38 @@ class BatteryLightVirtualLoadSensor(SensorEntity):
             configuration_url="https://battery-prod.awestinconsulting.se",
         )
 
-    @property
-    def state(self):
+    def _source_entities(self):
+        if not hasattr(self.coordinator, "peak_guard"):
+            return []
+        config = self.coordinator.peak_guard.config
+        virtual_load_id = config.get(CONF_VIRTUAL_LOAD_SENSOR)
+        if virtual_load_id:
+            return [virtual_load_id]
+        return [e for e in (config.get(CONF_GRID_SENSOR), config.get(CONF_BATTERY_POWER_SENSOR)) if e]
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        sources = self._source_entities()
+        if sources:
+            self.async_on_remove(
+                async_track_state_change_event(self.hass, sources, self._handle_source_change)
+            )
+        self._refresh_value()
+
+    @callback
+    def _handle_source_change(self, event) -> None:
+        if self._refresh_value():
+            self.async_write_ha_state()
+
+    def _refresh_value(self) -> bool:
+        """Räknar om lasten. Returnerar True om värdet ändrades."""
+        value = self._compute_value()
+        if value == self._attr_native_value:
+            return False
+        self._attr_native_value = value
+        return True
+
+    def _compute_value(self):
         if not hasattr(self.coordinator, "peak_guard"):
             return None
 
@@ -278,18 +394,15 @@ class BatteryLightChargeTargetSensor(BatteryOptimizerSensorBase):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Charge Target"
         self._attr_unique_id = f"{coordinator.api_key}_light_charge_target"
-        self._attr_unit_of_measurement = "W"
+        self._attr_native_unit_of_measurement = "W"
         self._attr_device_class = SensorDeviceClass.POWER
         self._attr_state_class = SensorStateClass.MEASUREMENT
         self._attr_icon = "mdi:battery-arrow-up"
 
-    @property
-    def state(self):
-        data = self.coordinator.data or {}
-        action = data.get("action", "IDLE")
-        if action == "CHARGE":
-            kw = data.get("target_power_kw", 0.0)
-            return int(kw * 1000)
+    def _compute_value(self):
+        data = self.coordinator.data
+        if data is not None and data.action is Action.CHARGE:
+            return int(data.target_power_w)
         return 0
 
 class BatteryLightDischargeTargetSensor(BatteryOptimizerSensorBase):
@@ -298,16 +411,90 @@ class BatteryLightDischargeTargetSensor(BatteryOptimizerSensorBase):
         super().__init__(coordinator)
         self._attr_name = "Optimizer Light Discharge Target"
         self._attr_unique_id = f"{coordinator.api_key}_light_discharge_target"
-        self._attr_unit_of_measurement = "W"
+        self._attr_native_unit_of_measurement = "W"
         self._attr_device_class = SensorDeviceClass.POWER
         self._attr_state_class = SensorStateClass.MEASUREMENT
         self._attr_icon = "mdi:battery-arrow-down"
 
-    @property
-    def state(self):
-        data = self.coordinator.data or {}
-        action = data.get("action", "IDLE")
-        if action == "DISCHARGE":
-            kw = data.get("target_power_kw", 0.0)
-            return int(kw * 1000)
+    def _compute_value(self):
+        data = self.coordinator.data
+        if data is not None and data.action is Action.DISCHARGE:
+            return int(data.target_power_w)
         return 0
+
+class BatteryLightResponseTimeSensor(BatteryOptimizerSensorBase):
+    """Batteriets uppmätta svarstid på PeakGuards kommandon (sekunder, utjämnad)."""
+    _restore_until_refresh = False
+
+    def __init__(self, coordinator):
+        super().__init__(coordinator)
+        self._attr_name = "Optimizer Light Battery Response Time"
+        self._attr_unique_id = f"{coordinator.api_key}_light_battery_response_time"
+        self._attr_native_unit_of_measurement = "s"
+        self._attr_device_class = SensorDeviceClass.DURATION
+        self._attr_state_class = SensorStateClass.MEASUREMENT
+        self._attr_entity_category = EntityCategory.DIAGNOSTIC
+        self._attr_icon = "mdi:timer-sync-outline"
+
+    def _compute_value(self):
+        pg = self._peak_guard
+        latency_s = pg.actuation_latency_s if pg is not None else None
+        return round(latency_s, 2) if latency_s is not None else None
+
+class BatteryLightEnergySensor(RestoreSensor):
+    """Energi (kWh) som PeakGuard har räknat lokalt. Kan användas i HA:s energipanel.
+
+    Värdet återställs vid omstart och fortsätter sedan att räknas upp. Sensorn beror inte på
+    molnet och är därför alltid tillgänglig.
+    """
+    def __init__(self, coordinator, meter, name, icon):
+        self.coordinator = coordinator
+        self._meter = meter
+        self._attr_name = name
+        self._attr_unique_id = f"{coordinator.api_key}_light_{meter}_energy"
+        self._attr_native_unit_of_measurement = "kWh"
+        self._attr_device_class = SensorDeviceClass.ENERGY
+        self._attr_state_class = SensorStateClass.TOTAL_INCREASING
+        self._attr_suggested_display_precision = 3
+        self._attr_icon = icon
+        self._attr_should_poll = False
+
+    @property
+    def device_info(self) -> DeviceInfo:
+        return DeviceInfo(
+            identifiers={(DOMAIN, self.coordinator.api_key)},
+            name="Battery Optimizer Light",
+            manufacturer="Awestin Consulting",
+            model="Cloud Optimizer",
+            configuration_url="https://battery-prod.awestinconsulting.se",
+        )
+
+    @property
+    def _energy(self):
+        peak_guard = getattr(self.coordinator, "peak_guard", None)
+        return peak_guard.energy if peak_guard is not None else None
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        energy = self._energy
+        if energy is None:
+            return
+        last_data = await self.async_get_last_sensor_data()
+        if last_data is not None:
+            energy.restore(self._meter, last_data.native_value)
+        self.async_on_remove(energy.async_add_listener(self._handle_energy_update))
+        self._refresh_value()
+
+    @callback
+    def _handle_energy_update(self) -> None:
+        if self._refresh_value():
+            self.async_write_ha_state()
+
+    def _refresh_value(self) -> bool:
+        """Uppdaterar värdet (avrundat till Wh). Returnerar True om det ändrades."""
+        energy = self._energy
+        value = round(energy.total_kwh(self._meter), 3) if energy is not None else 0.0
+        if value == self._attr_native_value:
+            return False
+        self._attr_native_value = value
+        return True
@@ -0,0 +1,256 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# shadow.py
+# Skuggregulator för att jämföra beslutslogik på riktig last (A/B).
+# En andra PeakGuard med avvikande inställningar (eller en annan regulator-klass) utvärderar
+# samma händelser efter den riktiga, så att den riktiga aldrig väntar på skuggan. Skuggan ser
+# samma indata: de sensorvärden, den molnsignal och det gränsvärde som den riktiga utvärderingen
+# använde spelas in och spelas upp för skuggan. Skuggans kommandon och rapporter sparas men
+# skickas aldrig. Skillnaderna mot den riktiga regulatorn räknas: oenighet om läget,
+# extra/uteblivna kommandon och missade toppar.
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+import homeassistant.util.dt as dt_util
+from .actuation import ActuationTracker
+from .const import (
+    CONF_LIMIT_ENTITY,
+    CONF_LIMIT_FIXED_KW,
+    CONF_LIMIT_SCHEDULE,
+    CONF_SHADOW_CONFIG,
+    DIAGNOSTICS_HISTORY_SIZE,
+)
+from .dryrun import capture_logs
+
+# Effektskillnad (W) som räknas som ett annat kommando
+COMMAND_POWER_TOLERANCE_W = 100
+
+# Kommandon som den riktiga regulatorn skickar, och sensorvärden den läser, under pågående utvärdering
+_live_commands = ContextVar("battery_optimizer_light_live_commands", default=None)
+_live_reads = ContextVar("battery_optimizer_light_live_reads", default=None)
+
+
+def note_live_command(script_name, data):
+    """Anropas när den riktiga PeakGuard skickar ett kommando (no-op utan skuggregulator)."""
+    commands = _live_commands.get()
+    if commands is not None:
+        commands.append((script_name, dict(data)))
+
+
+def note_live_read(entity_id, state):
+    """Anropas när den riktiga PeakGuard läser ett state (no-op utan skuggregulator)."""
+    reads = _live_reads.get()
+    if reads is not None and entity_id not in reads:
+        reads[entity_id] = state
+
+
+@dataclass(slots=True)
+class LiveSnapshot:
+    """Indata och utfall från en riktig utvärdering, som skuggan sedan utvärderas mot."""
+
+    virtual_load_id: str | None
+    limit_id: str | None
+    data: object              # Molnsignalen (SignalData) när utvärderingen startade
+    limit_w: float | None     # Det riktiga gränsvärdet (används när skuggan delar gräns)
+    live_before: dict
+    reads: dict = field(default_factory=dict)     # entity_id -> state som den riktiga läste
+    commands: list = field(default_factory=list)  # (script, data) som den riktiga skickade
+
+
+class _SnapshotLimit:
+    """Den riktiga gränsen, med värdet från den inspelade utvärderingen."""
+
+    def __init__(self, limit):
+        self.entity_id = limit.entity_id
+        self.value = None
+
+    def value_w(self):
+        return self.value
+
+
+def _state(guard):
+    return {"peak_active": guard.is_active, "solar_override": guard.is_solar_override}
+
+
+def _power(data):
+    return float(data.get("power", 0) or 0)
+
+
+def _unmatched(commands, others):
+    """Kommandon i commands som saknar motsvarighet (samma script, ungefär samma effekt) i others."""
+    remaining = list(others)
+    unmatched = []
+    for script, data in commands:
+        for i, (other_script, other_data) in enumerate(remaining):
+            if script == other_script and abs(_power(data) - _power(other_data)) <= COMMAND_POWER_TOLERANCE_W:
+                del remaining[i]
+                break
+        else:
+            unmatched.append((script, data))
+    return unmatched
+
+
+class ShadowController:
+    """Kör en skugg-PeakGuard bredvid den riktiga och räknar skillnaderna.
+
+    overrides: inställningar som skiljer skuggan från den riktiga (samma nycklar som config entry).
+    controller: klassen för skuggan (PeakGuard eller en subklass med ny logik).
+    """
+
+    def __init__(self, live, overrides, controller=None):
+        self.live = live
+        self.overrides = dict(overrides)
+        controller = controller or type(live)
+        config = {k: v for k, v in live.config.items() if k != CONF_SHADOW_CONFIG}
+        self.shadow = controller(live.hass, {**config, **self.overrides}, live.coordinator)
+        self._shared_limit = None
+        if not {CONF_LIMIT_FIXED_KW, CONF_LIMIT_ENTITY, CONF_LIMIT_SCHEDULE} & self.overrides.keys():
+            # Samma gränsvärde som den riktiga (cachat och bevakat där, värdet spelas in)
+            self._shared_limit = self.shadow.limit = _SnapshotLimit(live.limit)
+
+        # Skuggan läser den inspelade utvärderingens indata
+        self._snapshot = None
+        self._signal = SimpleNamespace(data=None, reports=live.coordinator.reports)
+        self.shadow.coordinator = self._signal
+        self.shadow._get_state = self._snapshot_state
+
+        # Skuggan får inga sidoeffekter: kommandon och rapporter sparas bara
+        self._commands = None
+        self.shadow._call_script = self._record_command
+        self.shadow._send_report = self._record_report
+        # Kvittensen byggs om efter att _call_script har bytts ut: den riktiga skickade om via
+        # den ursprungliga metoden, och skuggan ska aldrig kunna styra batteriet
+        self.shadow.actuation = ActuationTracker(live.hass, None, self._record_command)
+        self.log = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+
+        self.stats = dict.fromkeys((
+            "evaluations", "disagreements", "extra_commands", "missing_commands",
+            "missed_peaks", "extra_peaks", "shadow_reports", "shadow_errors",
+        ), 0)
+        self.divergences = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self._disagreeing = False
+        self.started = dt_util.utcnow()
+
+    async def _record_command(self, script_name, data):
+        if self._commands is not None:
+            self._commands.append((script_name, dict(data)))
+
+    async def _record_report(self, endpoint, description, grid_w, limit_w):
+        self.stats["shadow_reports"] += 1
+
+    @contextmanager
+    def record(self, virtual_load_id, limit_id=None):
+        """Spelar in indata och kommandon från en riktig utvärdering. Ger en LiveSnapshot."""
+        snapshot = LiveSnapshot(
+            virtual_load_id,
+            limit_id,
+            self.live.coordinator.data,
+            self.live.limit.value_w() if self._shared_limit is not None else None,
+            _state(self.live),
+        )
+        reads_token = _live_reads.set(snapshot.reads)
+        commands_token = _live_commands.set(snapshot.commands)
+        try:
+            yield snapshot
+        finally:
+            _live_commands.reset(commands_token)
+            _live_reads.reset(reads_token)
+
+    def _snapshot_state(self, entity_id):
+        """Skuggans state-läsning: det den riktiga läste, annars nuvarande state."""
+        snapshot = self._snapshot
+        if snapshot is not None and entity_id in snapshot.reads:
+            return snapshot.reads[entity_id]
+        return self.live.hass.states.get(entity_id)
+
+    async def async_evaluate(self, snapshot):
+        """Utvärderar skuggan med en riktig utvärderings indata och jämför utfallen."""
+        shadow_before = _state(self.shadow)
+        self._snapshot = snapshot
+        self._signal.data = snapshot.data
+        if self._shared_limit is not None:
+            self._shared_limit.value = snapshot.limit_w
+        shadow_commands = self._commands = []
+        try:
+            with capture_logs(self.log):
+                await self.shadow._evaluate(snapshot.virtual_load_id, snapshot.limit_id)
+        except Exception as e:  # Ett fel i skuggan får aldrig påverka den riktiga regulatorn
+            self.stats["shadow_errors"] += 1
+            self.log.append(f"ERROR: {type(e).__name__}: {e}")
+        finally:
+            self._commands = None
+            self._snapshot = None
+        self._compare(snapshot.live_before, shadow_before, snapshot.commands, shadow_commands)
+
+    def _compare(self, live_before, shadow_before, live_commands, shadow_commands):
+        self.stats["evaluations"] += 1
+        live_after = _state(self.live)
+        shadow_after = _state(self.shadow)
+        load_w = self.live._last_load_w
+
+        disagreeing = live_after != shadow_after
+        if disagreeing:
+            self.stats["disagreements"] += 1
+            if not self._disagreeing:
+                self._divergence("disagreement", load_w, live=live_after, shadow=shadow_after)
+        self._disagreeing = disagreeing
+
+        # Toppar som bara den ena regulatorn tog hand om
+        live_engaged = live_after["peak_active"] and not live_before["peak_active"]
+        shadow_engaged = shadow_after["peak_active"] and not shadow_before["peak_active"]
+        if live_engaged and not shadow_after["peak_active"]:
+            self.stats["missed_peaks"] += 1
+            self._divergence("missed_peak", load_w)
+        if shadow_engaged and not live_after["peak_active"]:
+            self.stats["extra_peaks"] += 1
+            self._divergence("extra_peak", load_w)
+
+        extra = _unmatched(shadow_commands, live_commands)
+        missing = _unmatched(live_commands, shadow_commands)
+        if extra:
+            self.stats["extra_commands"] += len(extra)
+            self._divergence("extra_command", load_w, commands=extra)
+        if missing:
+            self.stats["missing_commands"] += len(missing)
+            self._divergence("missing_command", load_w, commands=missing)
+
+    def _divergence(self, kind, load_w, **details):
+        entry = {
+            "time": dt_util.utcnow().isoformat(),
+            "kind": kind,
+            "load_w": round(load_w) if load_w is not None else None,
+        }
+        if "commands" in details:
+            details["commands"] = [{"script": s, "data": d} for s, d in details["commands"]]
+        entry.update(details)
+        self.divergences.append(entry)
+
+    def diagnostics(self):
+        evaluations = self.stats["evaluations"]
+        return {
+            "overrides": self.overrides,
+            "controller": type(self.shadow).__name__,
+            "since": self.started.isoformat(),
+            "stats": dict(self.stats),
+            "agreement": round(1 - self.stats["disagreements"] / evaluations, 4) if evaluations else None,
+            "shadow_state": _state(self.shadow),
+            "divergences": list(self.divergences),
+            "log": list(self.log),
+        }
@@ -0,0 +1,170 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# watchdog.py
+# Vakthund för PeakGuards egen hantering av state_changed-händelser.
+# Varje utvärdering tidsstämplas (kötid i event-loopen och total hanteringstid) och tiden
+# delas upp per steg: state-läsningar, beslut, script-anrop och molnrapport.
+# Om hanteringen tar längre tid än budgeten loggas en varning och ett reparationsärende
+# skapas, med information om vilket steg som var långsamt.
+
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import timedelta
+import homeassistant.util.dt as dt_util
+from homeassistant.helpers import issue_registry as ir # type: ignore
+from .const import DOMAIN, DIAGNOSTICS_HISTORY_SIZE
+from .metrics import LatencyHistogram
+
+_LOGGER = logging.getLogger(__name__)
+
+# Tidsbudget för en utvärdering (sekunder)
+UPDATE_BUDGET_S = 0.05
+
+# Steg som tiden fördelas på
+STAGE_STATE_READS = "state_reads"
+STAGE_DECISION = "decision"
+STAGE_SCRIPT = "call_script"
+STAGE_REPORT = "cloud_report"
+STAGES = (STAGE_STATE_READS, STAGE_DECISION, STAGE_SCRIPT, STAGE_REPORT)
+
+# Varning och ärende upprepas högst så här ofta
+WARNING_INTERVAL = timedelta(minutes=10)
+# Ärendet tas bort när inga långsamma utvärderingar har skett på så här länge
+ISSUE_CLEAR_AFTER = timedelta(hours=1)
+
+ISSUE_ID = "slow_peak_guard_update"
+
+# Pågående utvärdering i aktuell task (flera utvärderingar kan köras samtidigt)
+_current_timing = ContextVar("battery_optimizer_light_update_timing", default=None)
+
+
+class UpdateTiming:
+    """Tidmätning för en utvärdering. Tid som inte hör till något annat steg räknas som beslut."""
+
+    __slots__ = ("started", "queue_delay", "stages")
+
+    def __init__(self, queue_delay=None):
+        self.started = time.perf_counter()
+        self.queue_delay = queue_delay
+        self.stages = dict.fromkeys((STAGE_STATE_READS, STAGE_SCRIPT, STAGE_REPORT), 0.0)
+
+    def add(self, stage, seconds):
+        self.stages[stage] += seconds
+
+    def finish(self):
+        """Returnerar (total tid, tid per steg) i sekunder."""
+        total = time.perf_counter() - self.started
+        stages = dict(self.stages)
+        stages[STAGE_DECISION] = max(0.0, total - sum(self.stages.values()))
+        return total, stages
+
+
+def current_timing():
+    """Returnerar tidmätningen för utvärderingen som körs i aktuell task (eller None)."""
+    return _current_timing.get()
+
+
+def queue_delay_since(fired_timestamp):
+    """Tid (sekunder) från att händelsen skapades tills hanteringen startar."""
+    if not isinstance(fired_timestamp, (int, float)):
+        return None
+    return max(0.0, time.time() - fired_timestamp)
+
+
+class UpdateWatchdog:
+    """Samlar tider för PeakGuards utvärderingar och larmar när budgeten överskrids."""
+
+    def __init__(self, hass, budget=UPDATE_BUDGET_S):
+        self.hass = hass
+        self.budget = budget
+        self.queue_delay = LatencyHistogram()
+        self.stage_latency = {stage: LatencyHistogram() for stage in STAGES}
+        self.slow_updates = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+        self.slow_count = 0
+        self._last_warning = None
+        self._last_slow = None
+        self._issue_active = False
+
+    def start(self, queue_delay=None):
+        """Startar tidmätning för en utvärdering. Returnerar (timing, token)."""
+        timing = UpdateTiming(queue_delay)
+        return timing, _current_timing.set(timing)
+
+    def finish(self, timing, token):
+        """Avslutar tidmätningen och kontrollerar budgeten."""
+        _current_timing.reset(token)
+        total, stages = timing.finish()
+
+        if timing.queue_delay is not None:
+            self.queue_delay.observe(timing.queue_delay)
+        for stage, seconds in stages.items():
+            self.stage_latency[stage].observe(seconds)
+
+        now = dt_util.utcnow()
+        if total <= self.budget:
+            if self._issue_active and now - self._last_slow > ISSUE_CLEAR_AFTER:
+                ir.async_delete_issue(self.hass, DOMAIN, ISSUE_ID)
+                self._issue_active = False
+            return
+
+        slowest = max(stages, key=stages.get)
+        self.slow_count += 1
+        self._last_slow = now
+        record = {
+            "time": now.isoformat(),
+            "total_ms": round(total * 1000, 1),
+            "queue_delay_ms": round(timing.queue_delay * 1000, 1) if timing.queue_delay is not None else None,
+            "slowest_stage": slowest,
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in stages.items()},
+        }
+        self.slow_updates.append(record)
+
+        if self._last_warning is not None and now - self._last_warning < WARNING_INTERVAL:
+            return
+        self._last_warning = now
+
+        _LOGGER.warning(
+            f"PeakGuard update took {record['total_ms']} ms (budget {self.budget * 1000:g} ms). "
+            f"Slowest stage: {slowest} ({record['stages_ms'][slowest]} ms). "
+            f"Queue delay: {record['queue_delay_ms']} ms."
+        )
+        ir.async_create_issue(
+            self.hass,
+            DOMAIN,
+            ISSUE_ID,
+            is_fixable=False,
+            severity=ir.IssueSeverity.WARNING,
+            translation_key=ISSUE_ID,
+            translation_placeholders={
+                "total_ms": str(record["total_ms"]),
+                "budget_ms": f"{self.budget * 1000:g}",
+                "stage": slowest,
+                "stage_ms": str(record["stages_ms"][slowest]),
+            },
+        )
+        self._issue_active = True
+
+    def diagnostics(self):
+        return {
+            "budget_ms": self.budget * 1000,
+            "slow_count": self.slow_count,
+            "queue_delay": self.queue_delay.as_dict(),
+            "stages": {stage: hist.as_dict() for stage, hist in self.stage_latency.items()},
+            "slow_updates": list(self.slow_updates),
+        }
@@ -0,0 +1,196 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# fake_backend.py
+# Lokal ersättning för molnets backend (aiohttp-server på 127.0.0.1) för tester och benchmarks.
+# Svarar på /signal, /report_batch och de gamla rapport-endpoints, och sparar alla anrop.
+#
+#     backend = FakeBackend(timeline=[{"action": "CHARGE", "target_power_kw": 2.0}])
+#     await backend.start()
+#     backend.fail_next(503, "timeout", 401)   # Nästa tre anrop misslyckas på olika sätt
+#     ...  # config["api_url"] = backend.url
+#     await backend.stop()
+
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from aiohttp import web
+
+REPORT_ENDPOINTS = (
+    "report_peak",
+    "report_peak_clear",
+    "report_peak_failure",
+    "report_solar_override",
+    "report_solar_override_clear",
+)
+
+# Hur länge servern väntar vid ett simulerat "timeout" (längre än klientens timeout)
+DEFAULT_HANG_S = 60.0
+
+
+@dataclass
+class RecordedRequest:
+    path: str
+    body: dict
+    status: int
+    time: float = field(default_factory=time.monotonic)
+
+
+class FakeBackend:
+    """Fejkad backend med skriptbar tidslinje, fördröjning och fel.
+
+    timeline: lista med /signal-svar. Varje anrop tar nästa, det sista upprepas.
+    latency: fördröjning (s) före varje svar.
+    error_rate: andel anrop (0..1) som slumpmässigt får 500.
+    api_key: anrop med annan nyckel får 401.
+    ack_events: kvittera händelser i /signal-svaret (False = äldre backend).
+    supports_batch: False ger 404 på /report_batch.
+    """
+
+    def __init__(
+        self,
+        timeline=None,
+        latency=0.0,
+        error_rate=0.0,
+        api_key="12345",
+        ack_events=True,
+        supports_batch=True,
+        seed=0,
+        hang_seconds=DEFAULT_HANG_S,
+    ):
+        self.timeline = list(timeline or [{"action": "HOLD", "target_power_kw": 0.0, "peak_power_kw": 5.0}])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.api_key = api_key
+        self.ack_events = ack_events
+        self.supports_batch = supports_batch
+        self.hang_seconds = hang_seconds
+        self.requests = []
+        self._faults = deque()
+        self._signal_count = 0
+        self._rng = random.Random(seed)
+        self._runner = None
+        self.url = None
+
+    # --- Skriptning ---
+
+    def fail_next(self, *faults):
+        """Lägger fel för kommande anrop: HTTP-status (int), "timeout" eller "disconnect"."""
+        self._faults.extend(faults)
+
+    def requests_to(self, path):
+        return [r for r in self.requests if r.path == path]
+
+    @property
+    def reported_events(self):
+        """Alla händelser som backend har tagit emot (via /signal, batch eller gamla endpoints)."""
+        events = []
+        for r in self.requests:
+            if r.status != 200:
+                continue
+            if r.path in ("/signal", "/report_batch"):
+                events.extend(e["type"] for e in r.body.get("events") or [])
+            elif r.path.lstrip("/") in REPORT_ENDPOINTS:
+                events.append(r.path.lstrip("/"))
+        return events
+
+    # --- Server ---
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/signal", self._handle_signal)
+        app.router.add_post("/report_batch", self._handle_batch)
+        for endpoint in REPORT_ENDPOINTS:
+            app.router.add_post(f"/{endpoint}", self._handle_legacy)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    # --- Hantering ---
+
+    async def _prepare(self, request):
+        """Gemensamt för alla endpoints. Returnerar (body, felrespons eller None)."""
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        fault = self._faults.popleft() if self._faults else None
+        if fault is None and self.error_rate and self._rng.random() < self.error_rate:
+            fault = 500
+
+        if fault == "timeout":
+            await asyncio.sleep(self.hang_seconds)
+            fault = 504
+        if fault == "disconnect":
+            self.requests.append(RecordedRequest(request.path, body, 0))
+            request.transport.close()
+            return body, web.Response(status=500)
+        if isinstance(fault, int):
+            self.requests.append(RecordedRequest(request.path, body, fault))
+            return body, web.Response(status=fault, text=f"Injected error {fault}")
+
+        if body.get("api_key") != self.api_key:
+            self.requests.append(RecordedRequest(request.path, body, 401))
+            return body, web.Response(status=401, text="Invalid API key")
+        return body, None
+
+    async def _handle_signal(self, request):
+        body, error = await self._prepare(request)
+        if error is not None:
+            return error
+        self.requests.append(RecordedRequest(request.path, body, 200))
+        index = min(self._signal_count, len(self.timeline) - 1)
+        self._signal_count += 1
+        response = dict(self.timeline[index])
+        if self.ack_events:
+            response["acked_events"] = [e["id"] for e in body.get("events") or []]
+        return web.json_response(response)
+
+    async def _handle_batch(self, request):
+        if not self.supports_batch:
+            return web.Response(status=404)
+        body, error = await self._prepare(request)
+        if error is not None:
+            return error
+        self.requests.append(RecordedRequest(request.path, body, 200))
+        return web.json_response({"acked_events": [e["id"] for e in body.get("events") or []]})
+
+    async def _handle_legacy(self, request):
+        body, error = await self._prepare(request)
+        if error is not None:
+            return error
+        self.requests.append(RecordedRequest(request.path, body, 200))
+        return web.json_response({"status": "ok"})
@@ -0,0 +1,188 @@
+# Battery Optimizer Light
+# Copyright (C) 2026 @awestin67
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# fake_modbus.py
+# Lokal Modbus TCP-simulator av en växelriktare (127.0.0.1) för tester och benchmarks.
+# Stödjer läsning av holding registers (0x03) och skrivning (0x06, 0x10), och sparar alla anrop.
+# Med samma registerkarta som ModbusActuator följer återläsningen läge och effekt, så att
+# kommandon kan kontrolleras mot "batteriets" faktiska effekt.
+#
+#     inverter = await FakeModbusInverter(latency=0.02).start()
+#     inverter.fail_next(4)   # Nästa anrop får undantaget "server device failure"
+#     ...  # config["modbus_host"], config["modbus_port"] = inverter.host, inverter.port
+#     await inverter.stop()
+
+import asyncio
+import struct
+import time
+from dataclasses import dataclass, field
+
+DEFAULT_REGISTERS = {
+    "mode": 0,
+    "setpoint": 1,
+    "readback": 2,
+    "modes": {"auto": 0, "charge": 1, "discharge": 2},
+    "scale_w": 1,
+    "signed": False,
+}
+
+
+@dataclass
+class RecordedModbusRequest:
+    function: int
+    address: int
+    values: list
+    transaction: int
+    time: float = field(default_factory=time.monotonic)
+
+
+class FakeModbusInverter:
+    """Fejkad växelriktare med holding registers, fördröjning och skriptbara fel.
+
+    latency: tid (s) från anrop till svar. Svaren kommer i samma ordning som anropen, men
+        flera anrop kan vara ute samtidigt (som över ett riktigt nät).
+    registers: registerkartan som återläsningen följer (None = ingen simulerad återläsning).
+    """
+
+    def __init__(self, latency=0.0, registers=DEFAULT_REGISTERS, size=256):
+        self.latency = latency
+        self.map = registers
+        self.registers = [0] * size
+        self.requests = []
+        self.connections = 0
+        self._faults = []
+        self._server = None
+        self._tasks = set()
+        self.host = "127.0.0.1"
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def fail_next(self, *faults):
+        """Nästa anrop misslyckas: ett Modbus-undantag (heltal) eller "disconnect"."""
+        self._faults.extend(faults)
+
+    # --- Växelriktarens tillstånd ---
+
+    @property
+    def battery_power_w(self):
+        """Batteriets effekt som återläsningen visar (urladdning positiv)."""
+        if self.map is None:
+            return 0
+        raw = self.registers[self.map["setpoint"]]
+        if raw & 0x8000:
+            raw -= 0x10000
+        power = raw * self.map["scale_w"]
+        mode = self.registers[self.map["mode"]]
+        modes = self.map["modes"]
+        if mode == modes["charge"]:
+            return -abs(power)
+        if mode == modes["discharge"]:
+            return abs(power)
+        return 0
+
+    def _update_readback(self):
+        if self.map is not None and self.map.get("readback") is not None:
+            self.registers[self.map["readback"]] = int(self.battery_power_w / self.map["scale_w"]) & 0xFFFF
+
+    # --- Protokoll ---
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        responses = asyncio.Queue()
+        sender = asyncio.create_task(self._send_responses(writer, responses))
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                if self._faults and self._faults[0] == "disconnect":
+                    self._faults.pop(0)
+                    break
+                response = self._process(transaction, pdu)
+                frame = struct.pack(">HHHB", transaction, protocol, len(response) + 1, unit) + response
+                await responses.put((time.monotonic() + self.latency, frame))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+            self._tasks.discard(task)
+
+    async def _send_responses(self, writer, responses):
+        while True:
+            due, frame = await responses.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(frame)
+            await writer.drain()
+
+    def _process(self, transaction, pdu):
+        function = pdu[0]
+        address = struct.unpack(">H", pdu[1:3])[0]
+        if function == 0x03:
+            count = struct.unpack(">H", pdu[3:5])[0]
+            values = []
+        elif function == 0x06:
+            values = [struct.unpack(">H", pdu[3:5])[0]]
+            count = 1
+        elif function == 0x10:
+            count = struct.unpack(">H", pdu[3:5])[0]
+            values = list(struct.unpack(f">{count}H", pdu[6:6 + 2 * count]))
+        else:
+            return bytes([function | 0x80, 1])
+        self.requests.append(RecordedModbusRequest(function, address, values, transaction))
+
+        if self._faults:
+            return bytes([function | 0x80, self._faults.pop(0)])
+        if address + count > len(self.registers):
+            return bytes([function | 0x80, 2])
+
+        if function == 0x03:
+            data = struct.pack(f">{count}H", *self.registers[address:address + count])
+            return bytes([function, len(data)]) + data
+        self.registers[address:address + count] = values
+        self._update_readback()
+        return pdu[:5]
+
+    def writes(self):
+        """Skrivna (adress, värde) i ordning."""
+        return [
+            (r.address + i, v)
+            for r in self.requests if r.function in (0x06, 0x10)
+            for i, v in enumerate(r.values)
+        ]
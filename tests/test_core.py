@@ -16,6 +16,7 @@
 
 import sys
 import os
+import time
 from unittest.mock import MagicMock
 import datetime
 
@@ -33,9 +34,12 @@ sys.modules["homeassistant.helpers.entity"] = mock_hass
 sys.modules["homeassistant.exceptions"] = mock_hass
 sys.modules["homeassistant.components"] = mock_hass
 sys.modules["homeassistant.loader"] = mock_hass
+# @callback ska lämna funktionen orörd (annars blir metoderna MagicMocks)
+mock_hass.callback = lambda func: func
 
 mock_util = MagicMock()
 mock_util.utcnow.side_effect = lambda: datetime.datetime.now(datetime.timezone.utc)
+mock_util.now.side_effect = lambda: datetime.datetime.now(datetime.timezone.utc)
 sys.modules["homeassistant.util"] = mock_util
 sys.modules["homeassistant.util.dt"] = mock_util
 mock_hass.util.dt = mock_util
@@ -61,25 +65,92 @@ mock_uc.DataUpdateCoordinator = MockDataUpdateCoordinator
 class MockCoordinatorEntity:
     def __init__(self, coordinator):
         self.coordinator = coordinator
+
+    @property
+    def available(self):
+        return self.coordinator.last_update_success
+
+    async def async_added_to_hass(self):
+        pass
+
+    def async_on_remove(self, func):
+        pass
 mock_uc.CoordinatorEntity = MockCoordinatorEntity
 sys.modules["homeassistant.helpers.update_coordinator"] = mock_uc
 
 mock_sensor = MagicMock()
 class MockSensorEntity:
-    pass
+    _attr_native_value = None
+    _attr_icon = None
+
+    @property
+    def native_value(self):
+        return self._attr_native_value
+
+    @property
+    def icon(self):
+        return self._attr_icon
+
+    def async_write_ha_state(self):
+        self.write_count = getattr(self, "write_count", 0) + 1
+
+    async def async_get_last_sensor_data(self):
+        return None
+
+    async def async_added_to_hass(self):
+        pass
+
+    def async_on_remove(self, func):
+        pass
 mock_sensor.SensorEntity = MockSensorEntity
+mock_sensor.RestoreSensor = MockSensorEntity
 mock_sensor.SensorDeviceClass = MagicMock()
 mock_sensor.SensorStateClass = MagicMock()
 sys.modules["homeassistant.components.sensor"] = mock_sensor
 
+mock_diagnostics = MagicMock()
+mock_diagnostics.async_redact_data = lambda data, keys: {
+    k: ("**REDACTED**" if k in keys else (mock_diagnostics.async_redact_data(v, keys) if isinstance(v, dict) else v))
+    for k, v in data.items()
+}
+sys.modules["homeassistant.components.diagnostics"] = mock_diagnostics
+
+mock_recorder = MagicMock()
+sys.modules["homeassistant.components.recorder"] = mock_recorder
+sys.modules["homeassistant.components.recorder.models"] = mock_recorder.models
+sys.modules["homeassistant.components.recorder.statistics"] = mock_recorder.statistics
+mock_recorder.models.StatisticData = dict
+mock_recorder.models.StatisticMetaData = dict
+
+mock_http = MagicMock()
+class MockHomeAssistantView:
+    pass
+mock_http.HomeAssistantView = MockHomeAssistantView
+sys.modules["homeassistant.components.http"] = mock_http
+
+mock_ir = MagicMock()
+sys.modules["homeassistant.helpers.issue_registry"] = mock_ir
+mock_hass.issue_registry = mock_ir
+
 # Lägg till rotmappen i sökvägen så vi kan importera komponenten
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import aiohttp  # noqa: E402
 import pytest  # noqa: E402
 from unittest.mock import AsyncMock, patch  # noqa: E402
 from custom_components.battery_optimizer_light.coordinator import BatteryOptimizerLightCoordinator  # noqa: E402
 from custom_components.battery_optimizer_light import PeakGuard  # noqa: E402
-from custom_components.battery_optimizer_light.sensor import BatteryLightStatusSensor, BatteryLightVirtualLoadSensor  # noqa: E402
+from custom_components.battery_optimizer_light.models import SignalData, Action  # noqa: E402
+from custom_components.battery_optimizer_light.planner import parse_price_slots, plan_schedule  # noqa: E402
+from custom_components.battery_optimizer_light.diagnostics import async_get_config_entry_diagnostics  # noqa: E402
+from custom_components.battery_optimizer_light.sensor import (  # noqa: E402
+    BatteryLightStatusSensor,
+    BatteryLightVirtualLoadSensor,
+    BatteryLightChargeTargetSensor,
+    BatteryLightPeakSensor,
+)
+from fake_backend import FakeBackend  # noqa: E402
+from fake_modbus import FakeModbusInverter  # noqa: E402
 
 # --- MOCK DATA ---
 MOCK_CONFIG = {
@@ -119,7 +190,7 @@ async def test_coordinator_handles_unavailable_soc(mock_hass_instance):
 async def test_peak_guard_triggers_discharge(mock_hass_instance):
     """Krav: Om lasten är högre än gränsen ska batteriet urladdas."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"} # Molnet säger HOLD, men PeakGuard ska ta över
+    coordinator.data = SignalData.from_response({"action": "HOLD"}) # Molnet säger HOLD, men PeakGuard ska ta över
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -168,7 +239,7 @@ async def test_peak_guard_triggers_discharge(mock_hass_instance):
 async def test_peak_guard_respects_safe_limit(mock_hass_instance):
     """Krav: Om lasten är låg ska vi återgå till molnets plan (eller Auto)."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "IDLE"} # Molnet säger IDLE
+    coordinator.data = SignalData.from_response({"action": "IDLE"}) # Molnet säger IDLE
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
     guard._has_reported = True # Låtsas att vi var i ett larm-läge
@@ -213,7 +284,9 @@ async def test_peak_guard_disabled_by_backend(mock_hass_instance):
     """Krav: Om backend säger att peak shaving är inaktivt ska inget hända."""
     coordinator = MagicMock()
     # is_peak_shaving_active = False
-    coordinator.data = {"action": "HOLD", "is_peak_shaving_active": False, "peakguard_status": "Off"}
+    coordinator.data = SignalData.from_response(
+        {"action": "HOLD", "is_peak_shaving_active": False, "peakguard_status": "Off"}
+    )
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -245,7 +318,7 @@ def test_status_sensor():
     """Testar att status-sensorn visar rätt text (Disabled/Monitoring/Triggered)."""
     coordinator = MagicMock()
     coordinator.api_key = "12345"
-    coordinator.data = {"is_peak_shaving_active": True}
+    coordinator.data = SignalData.from_response({"is_peak_shaving_active": True})
 
     # Mocka peak_guard på coordinatorn
     peak_guard = MagicMock()
@@ -258,45 +331,129 @@ def test_status_sensor():
     sensor = BatteryLightStatusSensor(coordinator)
 
     # Fall 1: Monitoring (Aktiv men inte triggad)
-    assert sensor.state == "Monitoring"
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Monitoring"
     assert sensor.icon == "mdi:shield-search"
 
     # Fall 2: Triggered
     peak_guard.is_active = True
-    assert sensor.state == "Triggered"
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Triggered"
     assert sensor.icon == "mdi:shield-alert"
 
     # Fall 3: Disabled
-    coordinator.data = {"is_peak_shaving_active": False, "peakguard_status": "Off"}
+    coordinator.data = SignalData.from_response({"is_peak_shaving_active": False, "peakguard_status": "Off"})
     peak_guard.is_active = False
-    assert sensor.state == "Off"
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Off"
     assert sensor.icon == "mdi:shield-off"
 
     # Fall 3b: Paused
-    coordinator.data = {"is_peak_shaving_active": False, "peakguard_status": "Paused"}
-    assert sensor.state == "Paused"
+    coordinator.data = SignalData.from_response({"is_peak_shaving_active": False, "peakguard_status": "Paused"})
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Paused"
     assert sensor.icon == "mdi:pause-circle-outline"
 
     # Fall 4: Maintenance
-    coordinator.data = {"is_peak_shaving_active": True, "peakguard_status": "Active"}
+    coordinator.data = SignalData.from_response({"is_peak_shaving_active": True, "peakguard_status": "Active"})
     peak_guard.is_active = False
     peak_guard.in_maintenance = True
     peak_guard.maintenance_reason = "Service Mode"
-    assert sensor.state == "Maintenance mode detected (Service Mode). Pausing control."
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Maintenance mode detected (Service Mode). Pausing control."
     assert sensor.icon == "mdi:tools"
 
     # Fall 5: Solar Override
     peak_guard.in_maintenance = False
     peak_guard.is_solar_override = True
-    assert sensor.state == "Solar Override Active"
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == "Solar Override Active"
     assert sensor.icon == "mdi:solar-panel"
 
+def test_sensor_writes_state_only_on_change():
+    """Krav: En sensor ska bara skriva till state-maskinen när dess eget värde ändrats."""
+    coordinator = MagicMock()
+    coordinator.api_key = "12345"
+    coordinator.data = SignalData.from_response({"action": "CHARGE", "target_power_kw": 2.0, "reason": "Cheap"})
+
+    sensor = BatteryLightChargeTargetSensor(coordinator)
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == 2000
+    assert sensor.write_count == 1
+
+    # Ny data men samma värde för just denna sensor -> ingen skrivning
+    coordinator.data = SignalData.from_response({"action": "CHARGE", "target_power_kw": 2.0, "reason": "Still cheap"})
+    sensor._handle_coordinator_update()
+    assert sensor.write_count == 1
+
+    coordinator.data = SignalData.from_response({"action": "HOLD", "target_power_kw": 0.0})
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == 0
+    assert sensor.write_count == 2
+
+    # Misslyckat anrop: samma värde men sensorn blir otillgänglig, och det ska skrivas
+    coordinator.last_update_success = False
+    sensor._handle_coordinator_update()
+    assert sensor.available is False
+    assert sensor.write_count == 3
+    sensor._handle_coordinator_update()
+    assert sensor.write_count == 3
+    coordinator.last_update_success = True
+    sensor._handle_coordinator_update()
+    assert sensor.available is True
+    assert sensor.write_count == 4
+
+@pytest.mark.asyncio
+async def test_peak_sensor_restores_last_value_until_first_refresh():
+    """Krav: Vid uppstart ska gränsvärdet återställas direkt, utan att vänta på molnet."""
+    coordinator = MagicMock()
+    coordinator.api_key = "12345"
+    coordinator.data = None  # Molnet har inte svarat ännu
+    coordinator.last_update_success = False  # Första anropet misslyckades
+    coordinator.peak_guard.async_add_listener.return_value = MagicMock()
+
+    sensor = BatteryLightPeakSensor(coordinator)
+    sensor.async_get_last_sensor_data = AsyncMock(return_value=MagicMock(native_value=5.5))
+
+    await sensor.async_added_to_hass()
+
+    # Återställt värde används och sensorn är tillgänglig trots misslyckat anrop
+    assert sensor.native_value == 5.5
+    assert sensor.available is True
+
+    # PeakGuard-ändringar får inte skriva över det återställda värdet med default (12.0)
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == 5.5
+
+    # När molnet svarar tar det nya värdet över
+    coordinator.data = SignalData.from_response({"peak_power_kw": 6.0})
+    coordinator.last_update_success = True
+    sensor._handle_coordinator_update()
+    assert sensor.native_value == 6.0
+
+def test_peak_guard_notifies_listeners_on_state_change(mock_hass_instance):
+    """Krav: PeakGuard ska meddela registrerade lyssnare när dess tillstånd ändras."""
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+
+    listener = MagicMock()
+    remove = guard.async_add_listener(listener)
+
+    guard._set_reported_state(True)
+    guard._set_reported_state(True)  # Ingen ändring -> ingen notifiering
+    assert listener.call_count == 1
+
+    remove()
+    guard._set_reported_state(False)
+    assert listener.call_count == 1
+
 @pytest.mark.asyncio
 async def test_peak_guard_reports_failure_on_overload(mock_hass_instance):
     """Krav: Om behovet överstiger max växelriktareffekt ska failure rapporteras."""
     coordinator = MagicMock()
     # Sätt max_discharge_kw till 3.3 kW (3300 W)
-    coordinator.data = {"action": "HOLD", "max_discharge_kw": 3.3}
+    coordinator.data = SignalData.from_response({"action": "HOLD", "max_discharge_kw": 3.3})
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -342,7 +499,7 @@ async def test_peak_guard_reports_failure_on_overload(mock_hass_instance):
 async def test_solar_override_reports_to_cloud(mock_hass_instance):
     """Krav: När Solar Override aktiveras ska det rapporteras till molnet."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"} # Molnet säger HOLD
+    coordinator.data = SignalData.from_response({"action": "HOLD"}) # Molnet säger HOLD
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -429,7 +586,7 @@ async def test_peak_guard_calculates_load_with_inverted_grid(mock_hass_instance)
     config["virtual_load_sensor"] = None
 
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"}
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
 
     guard = PeakGuard(mock_hass_instance, config, coordinator)
 
@@ -497,18 +654,20 @@ def test_virtual_load_sensor_calculation():
     coordinator.hass.states.get.side_effect = get_state_side_effect
 
     # Fall 1: Normal beräkning (5000 + 1000 = 6000)
-    assert sensor.state == 6000
+    sensor._handle_source_change(None)
+    assert sensor.native_value == 6000
 
     # Fall 2: Inverterad grid
     peak_guard.config["grid_sensor_invert"] = True
     # (-5000 + 1000 = -4000)
-    assert sensor.state == -4000
+    sensor._handle_source_change(None)
+    assert sensor.native_value == -4000
 
 @pytest.mark.asyncio
 async def test_peak_guard_solar_override_hysteresis(mock_hass_instance):
     """Krav: Solar Override ska ha hysteres för att undvika 'flapping' vid gränsvärdet."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"}
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -559,7 +718,7 @@ async def test_peak_guard_pauses_on_custom_keyword(mock_hass_instance):
     config["battery_status_keywords"] = "service mode, critical error"
 
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"}
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
 
     guard = PeakGuard(mock_hass_instance, config, coordinator)
 
@@ -589,7 +748,7 @@ async def test_peak_guard_pauses_on_custom_keyword(mock_hass_instance):
 async def test_peak_guard_stops_at_zero_soc(mock_hass_instance):
     """Krav: PeakGuard ska sluta urladda när SoC når 0%."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"} # Molnet säger HOLD
+    coordinator.data = SignalData.from_response({"action": "HOLD"}) # Molnet säger HOLD
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
     guard._has_reported = True # Vi simulerar att PeakGuard redan är aktivt
@@ -655,7 +814,7 @@ async def test_peak_guard_stops_at_zero_soc(mock_hass_instance):
 async def test_peak_guard_throttles_charge(mock_hass_instance):
     """Krav: Om molnet vill ladda men lasten är hög, ska laddningen strypas."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "CHARGE", "target_power_kw": 3.0} # 3000W
+    coordinator.data = SignalData.from_response({"action": "CHARGE", "target_power_kw": 3.0}) # 3000W
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -696,7 +855,7 @@ async def test_peak_guard_throttles_charge(mock_hass_instance):
 async def test_peak_guard_sticky_solar_override_on_idle(mock_hass_instance):
     """Krav: Om Solar Override är aktiv och molnet svarar IDLE, ska override ligga kvar."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "IDLE"} # Molnet svarar IDLE (Auto)
+    coordinator.data = SignalData.from_response({"action": "IDLE"}) # Molnet svarar IDLE (Auto)
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -734,7 +893,7 @@ async def test_peak_guard_sticky_solar_override_on_idle(mock_hass_instance):
 async def test_peak_guard_handles_high_export_as_solar_override(mock_hass_instance):
     """Krav: Vid hög export ska Solar Override aktiveras (inte blockeras)."""
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"}
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -786,7 +945,7 @@ async def test_peak_guard_prevents_solar_override_during_buffer_fill_lag(mock_ha
     Med fixen ska vi se att Grid Import > 100W och blockera det.
     """
     coordinator = MagicMock()
-    coordinator.data = {"action": "HOLD"} # Molnet säger HOLD (Buffer Fill active)
+    coordinator.data = SignalData.from_response({"action": "HOLD"}) # Molnet säger HOLD (Buffer Fill active)
 
     guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
 
@@ -833,3 +992,1433 @@ async def test_peak_guard_prevents_solar_override_during_buffer_fill_lag(mock_ha
     # Verifiera att Solar Override INTE aktiveras, trots att lasten är -500W
     # Detta bevisar att "Import-spärren" fungerar.
     assert guard.is_solar_override is False
+
+@pytest.mark.asyncio
+async def test_coordinator_records_signal_history_and_retries(mock_hass_instance):
+    """Krav: Varje /signal-anrop ska sparas med latens, och omförsök ska räknas."""
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+
+    mock_state = MagicMock()
+    mock_state.state = "50"
+    mock_hass_instance.states.get.return_value = mock_state
+
+    with patch("custom_components.battery_optimizer_light.coordinator.async_get_clientsession") as mock_get_session, \
+         patch("custom_components.battery_optimizer_light.coordinator.asyncio.sleep", new=AsyncMock()):
+        mock_session = MagicMock()
+        mock_get_session.return_value = mock_session
+
+        failing = MagicMock()
+        failing.__aenter__.return_value = failing
+        failing.status = 503
+        failing.text = AsyncMock(return_value="Service Unavailable")
+
+        ok = MagicMock()
+        ok.__aenter__.return_value = ok
+        ok.status = 200
+        ok.json = AsyncMock(return_value={"action": "HOLD"})
+
+        mock_session.post.side_effect = [failing, ok]
+
+        data = await coordinator._async_update_data()
+
+    assert data.action is Action.HOLD
+    assert coordinator.stats["requests"] == 2
+    assert coordinator.stats["retries"] == 1
+    assert coordinator.stats["successes"] == 1
+    assert [h["status"] for h in coordinator.signal_history] == [503, 200]
+    assert coordinator.signal_latency.count == 2
+
+@pytest.mark.asyncio
+async def test_diagnostics_redacts_api_key_and_includes_history(mock_hass_instance):
+    """Krav: Diagnostiken ska dölja API-nyckeln och visa kommandohistorik och latens."""
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    coordinator.peak_guard = guard
+    coordinator.last_update_success = True
+
+    await guard._call_script("sonnen_force_discharge", {"power": 1500})
+    await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit")
+
+    entry = MagicMock()
+    entry.entry_id = "abc"
+    entry.data = MOCK_CONFIG
+    mock_hass_instance.data = {"battery_optimizer_light": {"abc": coordinator}}
+
+    result = await async_get_config_entry_diagnostics(mock_hass_instance, entry)
+
+    assert result["config"]["api_key"] == "**REDACTED**"
+    assert result["peak_guard"]["command_history"][0]["script"] == "sonnen_force_discharge"
+    assert result["peak_guard"]["update_latency"]["count"] == 1
+    assert result["coordinator"]["stats"]["requests"] == 0
+
+def _mock_response(status, json_data=None, text=""):
+    response = MagicMock()
+    response.__aenter__.return_value = response
+    response.status = status
+    response.json = AsyncMock(return_value=json_data)
+    response.text = AsyncMock(return_value=text)
+    return response
+
+@pytest.mark.asyncio
+async def test_reports_piggyback_on_signal_and_are_acked(mock_hass_instance):
+    """Krav: Väntande händelser ska skickas med i /signal och tas bort när de kvitterats."""
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    coordinator.peak_guard = guard
+
+    mock_state = MagicMock()
+    mock_state.state = "50"
+    mock_hass_instance.states.get.return_value = mock_state
+
+    with patch("custom_components.battery_optimizer_light.reports.async_get_clientsession") as report_session, \
+         patch("custom_components.battery_optimizer_light.coordinator.async_get_clientsession") as mock_get_session:
+        # Peak och clear läggs i kön utan egna HTTP-anrop
+        await guard._report_peak(7000.0, 5000.0)
+        await guard._report_peak_clear(3000.0, 5000.0)
+        report_session.return_value.post.assert_not_called()
+        assert coordinator.reports.pending_count == 2
+
+        mock_session = MagicMock()
+        mock_get_session.return_value = mock_session
+        pending_ids = [e["id"] for e in coordinator.reports.signal_payload()]
+        mock_session.post.return_value = _mock_response(200, {"action": "HOLD", "acked_events": pending_ids[:1]})
+
+        await coordinator._async_update_data()
+
+        _, kwargs = mock_session.post.call_args
+        events = kwargs["json"]["events"]
+        assert [e["type"] for e in events] == ["report_peak", "report_peak_clear"]
+        assert events[0]["grid_power_kw"] == 7.0
+
+        # Bara den kvitterade händelsen tas bort, den andra följer med nästa gång
+        assert [e["id"] for e in coordinator.reports.signal_payload()] == pending_ids[1:]
+        assert coordinator.reports.supports_batching is True
+
+@pytest.mark.asyncio
+async def test_reports_fall_back_to_legacy_endpoints(mock_hass_instance):
+    """Krav: Om backend inte kvitterar händelser ska de gamla endpoints användas."""
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    coordinator.reports.enqueue("report_solar_override", -500.0, 5000.0)
+
+    background = []
+    mock_hass_instance.async_create_background_task = MagicMock(side_effect=lambda coro, name: background.append(coro))
+    mock_state = MagicMock()
+    mock_state.state = "50"
+    mock_hass_instance.states.get.return_value = mock_state
+
+    with patch("custom_components.battery_optimizer_light.reports.async_get_clientsession") as report_session, \
+         patch("custom_components.battery_optimizer_light.coordinator.async_get_clientsession") as mock_get_session:
+        mock_get_session.return_value.post.return_value = _mock_response(200, {"action": "HOLD"})
+        report_session.return_value.post.return_value = _mock_response(200)
+
+        await coordinator._async_update_data()
+        assert coordinator.reports.supports_batching is False
+        for coro in background:
+            await coro
+
+        args, kwargs = report_session.return_value.post.call_args
+        assert args[0] == "http://test-api/report_solar_override"
+        assert kwargs["json"] == {"api_key": "12345", "grid_power_kw": -0.5, "limit_kw": 5.0}
+        assert coordinator.reports.pending_count == 0
+
+@pytest.mark.asyncio
+async def test_urgent_report_is_sent_via_batch_endpoint(mock_hass_instance):
+    """Krav: Brådskande händelser (failure) ska inte vänta på nästa /signal."""
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+
+    with patch("custom_components.battery_optimizer_light.reports.async_get_clientsession") as report_session:
+        session = report_session.return_value
+        session.post.side_effect = lambda url, json, timeout: _mock_response(
+            200, {"acked_events": [e["id"] for e in json["events"]]}
+        )
+
+        await guard._report_peak_failure(9000.0, 5000.0)
+
+        args, kwargs = session.post.call_args
+        assert args[0] == "http://test-api/report_batch"
+        assert kwargs["json"]["events"][0]["type"] == "report_peak_failure"
+        assert coordinator.reports.pending_count == 0
+        assert coordinator.reports.stats["sent_via_batch"] == 1
+
+def _price_attributes(prices, start=None):
+    """Bygger Nordpool-liknande attribut med timpriser från nu."""
+    start = start or datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    raw = []
+    for i, price in enumerate(prices):
+        slot_start = start + datetime.timedelta(hours=i)
+        raw.append({"start": slot_start, "end": slot_start + datetime.timedelta(hours=1), "value": price})
+    return {"raw_today": raw, "raw_tomorrow": []}
+
+def test_local_planner_charges_cheap_and_discharges_expensive():
+    """Krav: Den lokala planen ska ladda när det är billigt och ladda ur när det är dyrt."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    slots = parse_price_slots(_price_attributes([0.10, 0.10, 2.00, 2.00]), now)
+    plan = plan_schedule(slots, soc_pct=20, capacity_kwh=10.0, max_power_kw=3.0)
+
+    assert plan.action == "CHARGE"
+    assert plan.target_power_kw == 3.0
+    assert [action for _, action in plan.slots] == ["CHARGE", "CHARGE", "DISCHARGE", "DISCHARGE"]
+
+    # Under buffertnivån får planen inte ladda ur
+    expensive = parse_price_slots(_price_attributes([3.00, 0.50]), now)
+    plan = plan_schedule(expensive, soc_pct=10, capacity_kwh=10.0, max_power_kw=3.0, min_soc_pct=10)
+    assert plan.action != "DISCHARGE"
+
+@pytest.mark.asyncio
+async def test_coordinator_uses_local_fallback_when_cloud_is_stale(mock_hass_instance):
+    """Krav: Om molnet inte svarar och signalen är för gammal ska den lokala planen ta över."""
+    config = {**MOCK_CONFIG, "price_sensor": "sensor.nordpool", "battery_capacity_kwh": 10.0,
+              "fallback_after_minutes": 30}
+    from dataclasses import replace
+
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, config)
+    coordinator.last_cloud_data = SignalData.from_response(
+        {"peak_power_kw": 5.0, "max_discharge_kw": 3.0, "action": "HOLD"}
+    )
+
+    soc_state = MagicMock()
+    soc_state.state = "20"
+    price_state = MagicMock()
+    price_state.attributes = _price_attributes([0.10, 0.10, 2.00, 2.00])
+    mock_hass_instance.states.get.side_effect = lambda e: price_state if e == "sensor.nordpool" else soc_state
+    mock_hass_instance.async_add_executor_job = AsyncMock(side_effect=lambda func, *args: func(*args))
+
+    with patch.object(coordinator, "_async_fetch_signal", AsyncMock(side_effect=UpdateFailed("down"))):
+        # Signalen är färsk -> inget reservläge, felet släpps igenom
+        with pytest.raises(UpdateFailed):
+            await coordinator._async_update_data()
+
+        last = coordinator.last_cloud_data
+        coordinator.last_cloud_data = replace(last, received_at=last.received_at - datetime.timedelta(minutes=45))
+        assert coordinator.signal_age() >= datetime.timedelta(minutes=45)
+        data = await coordinator._async_update_data()
+
+    assert data.action is Action.CHARGE
+    assert data.source == "local"
+    assert data.peak_power_kw == 5.0  # Övriga fält från senaste molnsvaret behålls
+    mock_hass_instance.async_add_executor_job.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_watchdog_flags_slow_script_stage(mock_hass_instance):
+    """Krav: En utvärdering över budgeten ska ge varning, reparationsärende och visa långsamt steg."""
+    import asyncio
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    mock_ir.async_create_issue.reset_mock()
+
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0"),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="7000"),
+        "sensor.soc": MagicMock(state="50"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    async def slow_script(*args, **kwargs):
+        await asyncio.sleep(0.08)
+
+    mock_hass_instance.services.async_call.side_effect = slow_script
+
+    fired_at = __import__("time").time() - 0.02
+    await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit", fired_at=fired_at)
+
+    diag = guard.diagnostics()["watchdog"]
+    assert diag["slow_count"] == 1
+    assert diag["slow_updates"][0]["slowest_stage"] == "call_script"
+    assert diag["slow_updates"][0]["queue_delay_ms"] >= 20
+    assert diag["queue_delay"]["count"] == 1
+    assert mock_ir.async_create_issue.call_args.args[2] == "slow_peak_guard_update"
+    assert mock_ir.async_create_issue.call_args.kwargs["translation_placeholders"]["stage"] == "call_script"
+
+    # En snabb utvärdering ska inte larma
+    mock_hass_instance.services.async_call.side_effect = None
+    await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit")
+    assert guard.watchdog.slow_count == 1
+
+@pytest.mark.asyncio
+async def test_peak_guard_pipeline_skips_unchanged_status_and_quiet_load(mock_hass_instance):
+    """Krav: Oförändrad status ska inte tolkas om, och tyst last ska stoppas i filtret."""
+    config = MOCK_CONFIG.copy()
+    config["battery_status_sensor"] = "sensor.battery_status"
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "IDLE"})
+    guard = PeakGuard(mock_hass_instance, config, coordinator)
+
+    status_state = MagicMock(state="OnGrid")
+    load_state = MagicMock(state="1500")
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0"),
+        "sensor.husets_netto_last_virtuell": load_state,
+        "sensor.battery_status": status_state,
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    for _ in range(3):
+        await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit")
+
+    stats = guard.pipeline_stats
+    assert stats["evaluations"] == 3
+    assert stats["status_cached"] == 2
+    assert stats["quiet"] == 3
+    assert stats["decision"] == 0
+    mock_hass_instance.services.async_call.assert_not_called()
+
+    # Ny status tolkas direkt, även om lasten är tyst
+    status_state.state = "battery_care"
+    await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit")
+    assert guard.in_maintenance is True
+    assert stats["maintenance"] == 1
+
+    # Ny last tolkas om (cachen får inte ge gammalt värde) och når besluten
+    status_state.state = "OnGrid"
+    guard._in_maintenance = False
+    load_state.state = "7000"
+    states["sensor.soc"] = MagicMock(state="50")
+    guard._report_peak = AsyncMock()
+    await guard.update("sensor.husets_netto_last_virtuell", "sensor.optimizer_light_peak_limit")
+    assert stats["decision"] == 1
+    guard._report_peak.assert_called_with(7000.0, 5000.0)
+
+def test_deadband_filter_drops_small_changes_but_passes_near_thresholds(mock_hass_instance):
+    """Krav: Små ändringar filtreras bort, men värden nära beslutsgränserna släpps alltid igenom."""
+    from custom_components.battery_optimizer_light.filters import DeadbandFilter
+
+    config = MOCK_CONFIG.copy()
+    del config["virtual_load_sensor"]
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "IDLE"})
+    guard = PeakGuard(mock_hass_instance, config, coordinator)
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    event_filter = DeadbandFilter({"sensor.grid": 50, "sensor.bat_power": 50}, guard.deadband_thresholds)
+
+    def accept(value, entity_id="sensor.grid"):
+        return event_filter.accept(entity_id, MagicMock(state=str(value)))
+
+    assert accept(1000) is True      # Första värdet
+    assert accept(1000) is False     # Bara attributen ändrade
+    assert accept(1020) is False     # Inom dödbandet
+    assert accept(1100) is True      # Utanför dödbandet
+    assert accept(4420) is True
+    assert accept(4440) is False     # 60 W från väckningsgränsen (4500 W)
+    assert accept(4460) is True      # Nära väckningsgränsen
+    assert event_filter.accept("sensor.battery_status", MagicMock(state="OnGrid")) is True  # Ej filtrerad
+    assert event_filter.per_entity["sensor.grid"] == {"passed": 4, "filtered": 3}
+
+    # Ny gräns eller nytt molnsvar: filtret börjar om, så oförändrade värden utvärderas mot de nya gränserna
+    event_filter = DeadbandFilter(
+        {"sensor.grid": 50, "sensor.bat_power": 50}, guard.deadband_thresholds, guard.deadband_generation
+    )
+    assert accept(3000) is True and accept(3000) is False
+    assert accept(0, "sensor.bat_power") is True and accept(0, "sensor.bat_power") is False
+    states["sensor.optimizer_light_peak_limit"] = MagicMock(state="2.5")
+    assert accept(3000) is True
+    assert accept(0, "sensor.bat_power") is True  # Gäller alla entiteter, inte bara den första
+    assert accept(3000) is False
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    assert accept(3000) is True and accept(3000) is False
+    assert event_filter.diagnostics()["resets"] == 2
+
+    # Under en aktiv topp utvärderas allt
+    guard._has_reported = True
+    assert accept(4460) is True
+
+def test_peak_limit_uses_unit_and_refreshes_only_on_own_events(mock_hass_instance):
+    """Krav: Gränsen tolkas med unit_of_measurement och cachas tills källan själv ändras."""
+    from custom_components.battery_optimizer_light.limit import PeakLimit
+
+    limit_state = MagicMock(state="5000", attributes={"unit_of_measurement": "W"})
+    mock_hass_instance.states.get.side_effect = {"input_number.peak_limit": limit_state}.get
+
+    limit = PeakLimit(mock_hass_instance, "input_number.peak_limit")
+    limit.async_track()
+    assert limit.value_w() == 5000.0
+
+    # Många läsningar utan händelse ska inte läsa om källan
+    for _ in range(10):
+        limit.value_w()
+    assert mock_hass_instance.states.get.call_count == 1
+
+    # En händelse från källan uppdaterar värdet (kW, och storleken avgör inte längre enheten)
+    handler = limit._handle_state_change
+    handler(MagicMock(data={"new_state": MagicMock(state="150", attributes={"unit_of_measurement": "kW"})}))
+    assert limit.value_w() == 150000.0
+    handler(MagicMock(data={"new_state": MagicMock(state="unavailable", attributes={})}))
+    assert limit.value_w() is None
+
+    # Ett fast värde går före källan
+    assert PeakLimit(mock_hass_instance, "input_number.peak_limit", fixed_kw=7.5).value_w() == 7500.0
+
+@pytest.mark.asyncio
+async def test_coordinator_rejects_malformed_signal_without_retry(mock_hass_instance):
+    """Krav: Svaret tolkas en gång till en typad modell, och felaktiga svar stoppas direkt."""
+    signal = SignalData.from_response({"action": "charge", "target_power_kw": "2.5", "peak_power_kw": 6})
+    assert signal.action is Action.CHARGE
+    assert signal.target_power_w == 2500.0
+    assert signal.peak_power_kw == 6.0
+    assert signal.max_discharge_kw == 3.3
+    assert signal.age() is not None
+    with pytest.raises(AttributeError):
+        signal.action = Action.HOLD  # Oföränderlig
+
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    mock_hass_instance.states.get.return_value = MagicMock(state="50")
+    session = MagicMock()
+    session.post.return_value = _mock_response(200, {"action": "HOLD", "peak_power_kw": "lots"})
+
+    with patch(SIGNAL_SESSION, return_value=session):
+        with pytest.raises(UpdateFailed, match="Invalid response"):
+            await coordinator._async_update_data()
+
+    assert session.post.call_count == 1
+    assert coordinator.stats["invalid_responses"] == 1
+
+# --- END-TO-END MOT FEJKAD BACKEND ---
+
+SIGNAL_SESSION = "custom_components.battery_optimizer_light.coordinator.async_get_clientsession"
+REPORT_SESSION = "custom_components.battery_optimizer_light.reports.async_get_clientsession"
+
+def _e2e_coordinator(hass, backend):
+    """Koordinator mot den lokala backend, med korta timeouts så att testerna går snabbt."""
+    coordinator = BatteryOptimizerLightCoordinator(hass, {**MOCK_CONFIG, "api_url": backend.url})
+    coordinator.request_timeout = 0.5
+    coordinator.retry_delay = 0
+    coordinator.reports.request_timeout = 0.5
+    hass.states.get.return_value = MagicMock(state="50")
+    return coordinator
+
+@pytest.mark.asyncio
+async def test_e2e_signal_retries_on_errors_and_timeouts(mock_hass_instance):
+    """Krav: Omförsöken ska fungera mot en riktig HTTP-server (5xx, timeout, avbruten anslutning)."""
+    timeline = [{"action": "CHARGE", "target_power_kw": 2.0}, {"action": "DISCHARGE", "target_power_kw": 1.5}]
+    async with FakeBackend(timeline=timeline, hang_seconds=2) as backend, aiohttp.ClientSession() as session:
+        coordinator = _e2e_coordinator(mock_hass_instance, backend)
+        with patch(SIGNAL_SESSION, return_value=session):
+            backend.fail_next(503, "timeout")
+            data = await coordinator._async_update_data()
+            assert data.action is Action.CHARGE
+            assert [r.status for r in backend.requests_to("/signal")] == [503, 200]
+            assert coordinator.stats["retries"] == 2
+            assert coordinator.signal_history[1]["error"].startswith("TimeoutError")
+
+            # Tidslinjen går vidare vid nästa lyckade anrop
+            backend.fail_next("disconnect")
+            data = await coordinator._async_update_data()
+            assert data.action is Action.DISCHARGE
+
+            backend.fail_next(500, 500, 500)
+            with pytest.raises(UpdateFailed, match="after 3 attempts"):
+                await coordinator._async_update_data()
+            assert coordinator.stats["failures"] == 1
+
+@pytest.mark.asyncio
+async def test_e2e_signal_does_not_retry_on_401(mock_hass_instance):
+    """Krav: Fel API-nyckel ska ge ett enda anrop, inga omförsök."""
+    async with FakeBackend(api_key="other") as backend, aiohttp.ClientSession() as session:
+        coordinator = _e2e_coordinator(mock_hass_instance, backend)
+        with patch(SIGNAL_SESSION, return_value=session):
+            with pytest.raises(UpdateFailed, match="Authentication failed"):
+                await coordinator._async_update_data()
+    assert [r.status for r in backend.requests] == [401]
+    assert coordinator.stats["auth_failures"] == 1
+
+@pytest.mark.asyncio
+async def test_e2e_reports_are_acked_or_sent_to_legacy_endpoints(mock_hass_instance):
+    """Krav: Händelser ska nå backend, kvitterade via /signal eller via de gamla endpoints."""
+    for ack_events in (True, False):
+        async with FakeBackend(ack_events=ack_events) as backend, aiohttp.ClientSession() as session:
+            coordinator = _e2e_coordinator(mock_hass_instance, backend)
+            background = []
+            mock_hass_instance.async_create_background_task = MagicMock(
+                side_effect=lambda coro, name, background=background: background.append(coro)
+            )
+            coordinator.reports.enqueue("report_peak", 7000.0, 5000.0)
+            coordinator.reports.enqueue("report_peak_clear", 4000.0, 5000.0)
+
+            with patch(SIGNAL_SESSION, return_value=session), patch(REPORT_SESSION, return_value=session):
+                await coordinator._async_update_data()
+                for coro in background:
+                    await coro
+
+            assert coordinator.reports.pending_count == 0
+            if ack_events:
+                assert backend.reported_events == ["report_peak", "report_peak_clear"]
+                assert coordinator.reports.stats["acked_via_signal"] == 2
+            else:
+                # /signal tog emot händelserna men kvitterade inte, så de skickades igen en och en
+                legacy = [r.body for r in backend.requests if r.path != "/signal"]
+                assert [r.path for r in backend.requests[1:]] == ["/report_peak", "/report_peak_clear"]
+                assert legacy[0] == {"api_key": "12345", "grid_power_kw": 7.0, "limit_kw": 5.0}
+                assert coordinator.reports.stats["sent_legacy"] == 2
+
+@pytest.mark.asyncio
+async def test_solar_override_engages_directly_when_pv_and_forecast_show_surplus(mock_hass_instance):
+    """Krav: Med solcellseffekt och prognos som räcker till exporten ska override inte vänta 30 s,
+    men exporten måste ändå hålla i sig en stund."""
+    config = {**MOCK_CONFIG, "pv_power_sensor": "sensor.pv_power", "pv_forecast_sensor": "sensor.pv_forecast_now",
+              "solar_forecast_verify_s": 0}
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="-1000", attributes={}),
+        "sensor.soc": MagicMock(state="50", attributes={}),
+        "sensor.pv_power": MagicMock(state="3000", attributes={"unit_of_measurement": "W"}),
+        "sensor.pv_forecast_now": MagicMock(state="2.8", attributes={"unit_of_measurement": "kW"}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+    clock = [datetime.datetime(2026, 6, 1, 12, 0, tzinfo=datetime.timezone.utc)]
+
+    async def export_for(guard, seconds):
+        for _ in range(seconds + 1):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            clock[0] += datetime.timedelta(seconds=1)
+
+    with patch.object(mock_util, "utcnow", MagicMock(side_effect=lambda: clock[0])):
+        # Ett enskilt värde räcker aldrig, inte ens med verifieringstid 0 (minst 5 s)
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        await guard.update("sensor.husets_netto_last_virtuell")
+        assert guard.is_solar_override is False
+        await export_for(guard, 5)
+        assert guard.is_solar_override is True
+        assert guard.solar_fast_engagements == 1
+
+        # Låg solel men hög prognos: exporten kan inte förklaras av solen, vanlig verifiering på 30 s
+        states["sensor.pv_power"] = MagicMock(state="300", attributes={"unit_of_measurement": "W"})
+        states["sensor.pv_forecast_now"] = MagicMock(state="4.0", attributes={"unit_of_measurement": "kW"})
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        await export_for(guard, 10)
+        assert guard.is_solar_override is False
+        assert guard.solar_fast_engagements == 0
+
+        # Prognosen räcker inte till exporten (1 kW): vanlig verifiering på 30 s
+        states["sensor.pv_power"] = MagicMock(state="3000", attributes={"unit_of_measurement": "W"})
+        states["sensor.pv_forecast_now"] = MagicMock(state="0.8", attributes={"unit_of_measurement": "kW"})
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        await export_for(guard, 10)
+        assert guard.is_solar_override is False
+
+        # Import på elmätaren blockerar fortfarande, trots prognosen
+        states["sensor.pv_forecast_now"] = MagicMock(state="4.0", attributes={"unit_of_measurement": "kW"})
+        states["sensor.grid"] = MagicMock(state="500", attributes={})
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        await export_for(guard, 10)
+        assert guard.is_solar_override is False
+        assert guard._solar_override_trigger_start is None
+
+def test_cusum_detector_reacts_fast_on_clean_step_and_ignores_spikes():
+    """Krav: Ett tydligt lägesbyte upptäcks snabbt, en kort spik eller brus räcker inte."""
+    from custom_components.battery_optimizer_light.changepoint import CusumDetector
+
+    t0 = datetime.datetime(2026, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)
+    at = lambda s: t0 + datetime.timedelta(seconds=s)  # noqa: E731
+
+    # Rent byte: 5600 W över gränsen (taket 2000 W/s) -> bevisen räcker efter ~3 s
+    clean = CusumDetector(6000, drift=100, max_step=2000)
+    assert [clean.update(5600, at(s)) for s in range(5)] == [False, False, False, False, True]
+
+    # En spik (sensor-lag) följd av normal last: bevisen försvinner igen
+    spike = CusumDetector(6000, drift=100, max_step=2000)
+    spike.update(5600, at(0))
+    spike.update(-300, at(1))
+    assert not spike.update(-300, at(20))
+    assert spike.score == 0
+
+    # Brus kring gränsen: ingen detektering trots 60 s
+    noisy = CusumDetector(6000, drift=100, max_step=2000)
+    assert not any(noisy.update(300 if s % 2 else -400, at(s)) for s in range(60))
+
+@pytest.mark.asyncio
+async def test_peak_guard_uses_cusum_for_solar_override_and_maintenance_end(mock_hass_instance):
+    """Krav: Solar override och slutet på underhåll avgörs av bevis, och syns i beslutsspåret."""
+    config = {**MOCK_CONFIG, "battery_status_sensor": "sensor.status"}
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="-6000", attributes={}),
+        "sensor.soc": MagicMock(state="50", attributes={}),
+        "sensor.status": MagicMock(state="OnGrid", attributes={}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+    clock = [datetime.datetime(2026, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)]
+
+    def tick(seconds):
+        clock[0] += datetime.timedelta(seconds=seconds)
+
+    with patch.object(mock_util.utcnow, "side_effect", lambda: clock[0]):
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        for _ in range(5):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            tick(1)
+        # Stor export: klart efter några sekunder i stället för 30
+        assert guard.is_solar_override is True
+        assert guard.decision_trace[-1]["event"] == "solar_override_detected"
+        assert guard.decision_trace[-1]["decided_by"] == "cusum"
+        assert guard.decision_trace[-1]["elapsed_s"] < 5
+
+        # Underhåll: ett rent byte tillbaka tar tröskeln (20 s), inte 60 s
+        states["sensor.status"].state = "battery_care"
+        await guard.update("sensor.husets_netto_last_virtuell")
+        assert guard.in_maintenance is True
+        states["sensor.status"].state = "OnGrid"
+        for _ in range(21):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            tick(1)
+        assert guard.in_maintenance is False
+        assert guard.decision_trace[-1]["event"] == "maintenance_end"
+
+        # Fladdrande status: varje återfall ger längre väntan
+        states["sensor.status"].state = "battery_care"
+        await guard.update("sensor.husets_netto_last_virtuell")
+        for _ in range(2):
+            states["sensor.status"].state = "OnGrid"
+            for _ in range(10):
+                await guard.update("sensor.husets_netto_last_virtuell")
+                tick(1)
+            states["sensor.status"].state = "battery_care"
+            await guard.update("sensor.husets_netto_last_virtuell")
+        states["sensor.status"].state = "OnGrid"
+        for _ in range(25):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            tick(1)
+        assert guard.in_maintenance is True
+        assert guard.decision_trace[-1]["event"] == "maintenance_flap"
+        for _ in range(40):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            tick(1)
+        assert guard.in_maintenance is False
+
+@pytest.mark.asyncio
+async def test_solar_override_detection_is_counted_only_when_it_engages(mock_hass_instance):
+    """Krav: Bevis för solöverskott räknas och spåras bara när override faktiskt aktiveras."""
+    config = {
+        **MOCK_CONFIG,
+        "pv_power_sensor": "sensor.pv",
+        "pv_forecast_sensor": "sensor.pv_forecast",
+        "solar_forecast_verify_s": 5,
+    }
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "IDLE"})
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="-3000", attributes={}),
+        "sensor.soc": MagicMock(state="50", attributes={}),
+        "sensor.pv": MagicMock(state="4000", attributes={"unit_of_measurement": "W"}),
+        "sensor.pv_forecast": MagicMock(state="4.5", attributes={"unit_of_measurement": "kW"}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+    clock = [datetime.datetime(2026, 6, 1, 12, 0, tzinfo=datetime.timezone.utc)]
+
+    with patch.object(mock_util, "utcnow", MagicMock(side_effect=lambda: clock[0])):
+        guard = PeakGuard(mock_hass_instance, config, coordinator)
+        guard._report_solar_override = AsyncMock()
+        # Molnet vill IDLE: override kan inte aktiveras, hur länge exporten än håller i sig
+        for _ in range(10):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            clock[0] += datetime.timedelta(seconds=4)
+        assert guard.is_solar_override is False
+        assert guard.solar_fast_engagements == 0
+        assert not [e for e in guard.decision_trace if e["event"] == "solar_override_detected"]
+
+        # När molnet tillåter HOLD aktiveras override en gång, med ett enda spår
+        coordinator.data = SignalData.from_response({"action": "HOLD"})
+        for _ in range(3):
+            await guard.update("sensor.husets_netto_last_virtuell")
+            clock[0] += datetime.timedelta(seconds=1)
+        assert guard.is_solar_override is True
+        assert guard.solar_fast_engagements == 1
+        assert len([e for e in guard.decision_trace if e["event"] == "solar_override_detected"]) == 1
+        guard._report_solar_override.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_peak_guard_protects_the_most_loaded_phase(mock_hass_instance):
+    """Krav: En överlastad fas ska styra urladdning och laddning, även när totalen är under gränsen."""
+    from custom_components.battery_optimizer_light.phases import evaluate_phases
+
+    # Fas-sensorer i W räknas om till A, batteriets urladdning räknas bort på sina faser
+    phases = evaluate_phases({"L1": 4600.0 / 230, "L2": 10.0}, 16, ["L1", "L2", "L3"], battery_w=690.0)
+    assert phases.virtual_a["L1"] == pytest.approx(21.0)
+    assert phases.worst_phase == "L1"
+    assert phases.excess_w == pytest.approx(5 * 230 * 3)
+
+    config = {
+        **MOCK_CONFIG,
+        "phase_l1_sensor": "sensor.l1", "phase_l2_sensor": "sensor.l2", "phase_l3_sensor": "sensor.l3",
+        "main_fuse_a": 16, "inverter_phases": ["L1"],
+    }
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="10.0", attributes={}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="5000", attributes={}),
+        "sensor.soc": MagicMock(state="50", attributes={}),
+        "sensor.l1": MagicMock(state="20", attributes={"unit_of_measurement": "A"}),
+        "sensor.l2": MagicMock(state="3", attributes={"unit_of_measurement": "A"}),
+        "sensor.l3": MagicMock(state="460", attributes={"unit_of_measurement": "W"}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    # Ugnen på L1: totalen (5 kW) är långt under gränsen (10 kW), men L1 ligger 4 A över säkringen
+    guard = PeakGuard(mock_hass_instance, config, coordinator)
+    guard._report_peak = AsyncMock()
+    guard._report_peak_clear = AsyncMock()
+    guard._report_phase_overload = AsyncMock()
+    guard._report_phase_overload_clear = AsyncMock()
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active is True
+    mock_hass_instance.services.async_call.assert_called_with(
+        "script", "sonnen_force_discharge", service_data={"power": 920}
+    )
+    assert guard.diagnostics()["phases"]["worst_phase"] == "L1"
+    # Effektgränsen hölls: fasöverlasten rapporteras som egen händelse, inte som topp
+    guard._report_phase_overload.assert_awaited_once_with(5000.0, 10000.0)
+    guard._report_peak.assert_not_called()
+
+    # När fasen är avlastad skickas motsvarande clear-händelse
+    states["sensor.l1"].state = "5"
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active is False
+    guard._report_phase_overload_clear.assert_awaited_once_with(5000.0, 10000.0)
+    guard._report_peak_clear.assert_not_called()
+    states["sensor.l1"].state = "20"
+
+    # Växelriktaren sitter på L2: batteriet kan inte avlasta L1, det rapporteras som ett misslyckande
+    mock_hass_instance.services.async_call.reset_mock()
+    guard = PeakGuard(mock_hass_instance, {**config, "inverter_phases": ["L2"]}, coordinator)
+    guard._report_peak_failure = AsyncMock()
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active is False
+    guard._report_peak_failure.assert_called_once()
+    mock_hass_instance.services.async_call.assert_not_called()
+
+    # Laddning begränsas av den mest belastade fasen (trefasig växelriktare, L1 har 4 A kvar)
+    states["sensor.l1"].state = "12"
+    coordinator.data = SignalData.from_response({"action": "CHARGE", "target_power_kw": 3.0})
+    guard = PeakGuard(mock_hass_instance, {**config, "inverter_phases": ["L1", "L2", "L3"]}, coordinator)
+    await guard.update("sensor.husets_netto_last_virtuell")
+    mock_hass_instance.services.async_call.assert_called_with(
+        "script", "sonnen_force_charge", service_data={"power": 2550}
+    )
+
+@pytest.mark.asyncio
+async def test_energy_sensors_integrate_peak_and_solar_energy_and_restore(mock_hass_instance):
+    """Krav: Urladdning under toppar och solel under solar override räknas lokalt och överlever omstart."""
+    from custom_components.battery_optimizer_light.sensor import BatteryLightEnergySensor
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    coordinator.peak_guard = guard
+    clock = [1000.0]
+    guard.energy.clock = lambda: clock[0]
+
+    # Efter omstart: sparat värde 1.5 kWh läggs till
+    sensor = BatteryLightEnergySensor(coordinator, "peak_discharge", "Peak Discharge Energy", "mdi:battery")
+    sensor.async_get_last_sensor_data = AsyncMock(return_value=MagicMock(native_value=1.5))
+    await sensor.async_added_to_hass()
+    assert sensor.native_value == 1.5
+
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0"),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="7000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="2000"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+    guard._report_peak = AsyncMock()
+    guard._report_peak_clear = AsyncMock()
+
+    # Topp i 30 min: 2 kW urladdning, varav 2 kW över gränsen (7 kW last, 5 kW gräns)
+    for _ in range(6):
+        await guard.update("sensor.husets_netto_last_virtuell")
+        clock[0] += 300
+    states["sensor.husets_netto_last_virtuell"] = MagicMock(state="3000")
+    states["sensor.bat_power"] = MagicMock(state="0")
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active is False
+    assert guard.energy.total_kwh("peak_discharge") == pytest.approx(1.5 + 1.0)
+    assert guard.energy.total_kwh("peak_shaved") == pytest.approx(1.0)
+    assert sensor.native_value == 2.5
+    writes = sensor.write_count
+
+    # Tyst läge: ingen energi räknas, oavsett hur lång tid som går (och ett prov gäller högst 5 min)
+    clock[0] += 3600
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.energy.total_kwh("peak_discharge") == pytest.approx(2.5)
+    assert sensor.write_count == writes
+
+    # Solar override med 1.2 kW laddning i 10 min (tredje provet avslutar intervallet)
+    guard._is_solar_override = True
+    states["sensor.husets_netto_last_virtuell"] = MagicMock(state="-2000")
+    states["sensor.bat_power"] = MagicMock(state="-1200")
+    for _ in range(3):
+        await guard.update("sensor.husets_netto_last_virtuell")
+        clock[0] += 300
+    assert guard.is_solar_override is True
+    assert guard.energy.total_kwh("solar_override") == pytest.approx(1200 * 600 / 3_600_000)
+
+@pytest.mark.asyncio
+async def test_hourly_statistics_are_aggregated_and_written_in_batches(mock_hass_instance):
+    """Krav: Timaggregat (max, medel, kapad energi, aktiv tid) skrivs som en batch per timme."""
+    from custom_components.battery_optimizer_light.hourly_stats import (
+        HourlyAccumulator, HourlyStatisticsWriter, STAT_LOAD, STAT_SHAVED_ENERGY, STAT_ACTIVE_TIME,
+    )
+
+    t0 = datetime.datetime(2026, 1, 15, 17, 0, tzinfo=datetime.timezone.utc)
+    at = lambda minutes: t0 + datetime.timedelta(minutes=minutes)  # noqa: E731
+    acc = HourlyAccumulator()
+    # 17:00-17:30 2 kW, 17:30-17:45 topp på 8 kW (1 kWh kapad), 17:45- 4 kW
+    acc.sample(2000.0, False, 10.0, at(0))
+    for minute in range(5, 30, 5):
+        acc.sample(2000.0, False, 10.0, at(minute))
+    acc.sample(8000.0, True, 10.0, at(30))
+    acc.sample(8000.0, True, 10.5, at(35))
+    acc.sample(8000.0, True, 10.8, at(40))
+    acc.sample(4000.0, False, 11.0, at(45))
+    acc.sample(4000.0, False, 11.0, at(50))
+    acc.sample(4000.0, False, 11.0, at(55))
+    assert not acc.pending
+
+    # Timern strax efter 18:00 avslutar timmen, även utan nya utvärderingar
+    acc.close_due_hours(at(60) + datetime.timedelta(seconds=5), 11.0)
+    [hour] = acc.pending
+    assert hour.start == t0
+    assert hour.max_load_w == 8000.0
+    assert hour.mean_load_w == pytest.approx((2000 * 30 + 8000 * 15 + 4000 * 15) / 60)
+    assert hour.shaved_kwh == pytest.approx(1.0)
+    assert hour.active_s == 15 * 60
+
+    # Skrivaren fortsätter på senaste summan i recorder och skriver en batch per statistik-id
+    mock_hass_instance.config.components = {"recorder"}
+    mock_recorder.get_instance.return_value.async_add_executor_job = AsyncMock(
+        side_effect=lambda func, hass, n, statistic_id, *args: {statistic_id: [{"sum": 100.0}]}
+    )
+    add = mock_recorder.statistics.async_add_external_statistics
+    add.reset_mock()
+    writer = HourlyStatisticsWriter(mock_hass_instance, acc, lambda: 11.0, "01JENTRY-A")
+    load_id = f"{STAT_LOAD}_01jentry_a"
+    assert writer.statistic_ids == {
+        STAT_LOAD: load_id,
+        STAT_SHAVED_ENERGY: f"{STAT_SHAVED_ENERGY}_01jentry_a",
+        STAT_ACTIVE_TIME: f"{STAT_ACTIVE_TIME}_01jentry_a",
+    }
+    # En annan config entry får egna id:n
+    other = HourlyStatisticsWriter(mock_hass_instance, acc, lambda: 11.0, "01JENTRY-B")
+    assert set(other.statistic_ids.values()).isdisjoint(writer.statistic_ids.values())
+
+    # Misslyckad skrivning: timmen ligger kvar och summorna räknas inte upp
+    add.side_effect = [None, ValueError("Invalid statistic_id")]
+    await writer.async_flush()
+    assert len(acc.pending) == 1
+    assert writer.diagnostics()["errors"] == 1
+    assert writer.diagnostics()["hours_written"] == 0
+
+    add.reset_mock()
+    add.side_effect = None
+    await writer.async_flush()
+    written = {call.args[1]["statistic_id"]: call.args[2] for call in add.call_args_list}
+    assert add.call_count == 3
+    assert written[load_id] == [{"start": t0, "mean": hour.mean_load_w, "min": 2000.0, "max": 8000.0}]
+    assert written[f"{STAT_SHAVED_ENERGY}_01jentry_a"][0]["sum"] == pytest.approx(101.0)
+    assert written[f"{STAT_ACTIVE_TIME}_01jentry_a"][0]["sum"] == pytest.approx(100.0 + 900)
+    assert not acc.pending
+    assert writer.diagnostics()["hours_written"] == 1
+
+@pytest.mark.asyncio
+async def test_profile_service_covers_integration_code_and_restores(mock_hass_instance, tmp_path):
+    """Krav: Profilering på begäran mäter bara integrationens ingångar och skriver en stats-fil."""
+    import asyncio
+    import pstats
+    from custom_components.battery_optimizer_light.profiler import async_profile
+    from custom_components.battery_optimizer_light.sensor import BatteryLightEnergySensor
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    coordinator._async_update_data = update_data = AsyncMock()
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    coordinator.peak_guard = guard
+    mock_hass_instance.states.get.side_effect = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0"),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="7000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="2000"),
+    }.get
+    guard._report_peak = AsyncMock()
+    mock_hass_instance.config.path = lambda name: str(tmp_path / name)
+    mock_hass_instance.async_add_executor_job = AsyncMock(side_effect=lambda func, *args: func(*args))
+    energy_sensor = BatteryLightEnergySensor(coordinator, "peak_discharge", "Peak Discharge Energy", "mdi:battery")
+    original_property = vars(BatteryLightEnergySensor)["device_info"]
+
+    session = asyncio.create_task(async_profile(mock_hass_instance, coordinator, guard, duration=1, top=10))
+    await asyncio.sleep(0)
+    await guard.update("sensor.husets_netto_last_virtuell")
+    await guard.update("sensor.husets_netto_last_virtuell")
+    await coordinator._async_update_data()
+    energy_sensor.device_info  # noqa: B018
+    assert (await async_profile(mock_hass_instance, coordinator, guard, duration=1))["error"]
+    result = await session
+
+    assert result["calls"] == {
+        "PeakGuard.update": 2,
+        "Coordinator._async_update_data": 1,
+        "BatteryLightEnergySensor.device_info": 1,
+    }
+    assert len(result["top"]) == 10
+    assert any(row["integration"] and row["function"].endswith("(update)") for row in result["top"])
+    stats = pstats.Stats(result["stats_file"])
+    assert any(func == "update" for _file, _line, func in stats.stats)
+
+    # Allt är återställt efteråt
+    assert "update" not in vars(guard)
+    assert coordinator._async_update_data is update_data
+    assert vars(BatteryLightEnergySensor)["device_info"] is original_property
+
+@pytest.mark.asyncio
+async def test_dry_run_returns_decision_without_side_effects(mock_hass_instance, caplog):
+    """Krav: Provkörningen visar vad som skulle hända, utan kommandon, rapporter eller lägesbyten."""
+    import logging
+    from custom_components.battery_optimizer_light.dryrun import DryRunInputs, async_dry_run
+
+    caplog.set_level(logging.INFO, logger="custom_components.battery_optimizer_light")
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD", "max_discharge_kw": 3.0, "target_power_kw": 3.0})
+    coordinator.reports = MagicMock()
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    mock_hass_instance.states.get.side_effect = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="2000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }.get
+    listener = MagicMock()
+    guard.async_add_listener(listener)
+    stats_before = dict(guard.pipeline_stats)
+
+    # Sensorernas värden: lasten är låg, så inget görs
+    result = await async_dry_run(guard)
+    assert result["stopped_at"] == "quiet"
+    assert result["inputs"]["load_w"] == 2000.0
+    assert result["inputs"]["limit_w"] == 5000.0
+    assert result["commands"] == [] and result["transitions"] == []
+
+    # Angiven last över gränsen: topp, urladdning och rapport, men bara i svaret
+    result = await async_dry_run(guard, DryRunInputs.from_service_data({"load_w": 7500, "soc": 40}))
+    assert result["stopped_at"] == "decision"
+    assert result["transitions"] == [{"state": "peak_active", "from": False, "to": True}]
+    assert result["commands"] == [{"script": "sonnen_force_discharge", "data": {"power": 2500}}]
+    assert [r["event"] for r in result["reports"]] == ["report_peak"]
+    assert result["inputs"]["soc"] == 40.0
+    assert set(result["stage_timings_ms"]) == {"backend", "status", "inputs", "quiet_filter", "decide"}
+    assert any("PEAK DETECTED" in line for line in result["log"])
+    assert not any("PEAK DETECTED" in r.getMessage() for r in caplog.records)
+
+    # Angiven gräns och molnläge: laddning som begränsas av gränsen
+    result = await async_dry_run(
+        guard, DryRunInputs(load_w=4000, limit_w=6000, cloud_action="charge", battery_power_w=0)
+    )
+    assert result["inputs"]["cloud_action"] == "CHARGE"
+    assert result["commands"] == [{"script": "sonnen_force_charge", "data": {"power": 1800}}]
+
+    # Inget har hänt på riktigt
+    assert guard.is_active is False
+    assert guard.pipeline_stats == stats_before
+    mock_hass_instance.services.async_call.assert_not_called()
+    coordinator.reports.enqueue.assert_not_called()
+    listener.assert_not_called()
+    assert coordinator.data.action is Action.HOLD
+
+@pytest.mark.asyncio
+async def test_shadow_controller_counts_divergences_without_sending(mock_hass_instance):
+    """Krav: En skuggregulator ser samma värden, skickar aldrig kommandon och räknar skillnaderna."""
+    from custom_components.battery_optimizer_light.shadow import ShadowController
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    coordinator.reports = MagicMock()
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    guard._report_peak_clear = AsyncMock()
+    # Skuggan provar en högre gräns (6 kW i stället för 5 kW)
+    guard.shadow = ShadowController(guard, {"limit_fixed_kw": 6.0})
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="5500"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    # 5.5 kW: bara den riktiga tar toppen -> missad topp för skuggan
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active and not guard.shadow.shadow.is_active
+    mock_hass_instance.services.async_call.assert_called_once_with(
+        "script", "sonnen_force_discharge", service_data={"power": 500}
+    )
+
+    # 7 kW: båda laddar ur, men med olika effekt
+    states["sensor.husets_netto_last_virtuell"] = MagicMock(state="7000")
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.shadow.shadow.is_active
+
+    # 3 kW: båda släpper toppen och är överens igen
+    states["sensor.husets_netto_last_virtuell"] = MagicMock(state="3000")
+    await guard.update("sensor.husets_netto_last_virtuell")
+
+    stats = guard.shadow.stats
+    assert stats["evaluations"] == 3
+    assert stats["disagreements"] == 1
+    assert stats["missed_peaks"] == 1 and stats["extra_peaks"] == 0
+    assert stats["missing_commands"] == 2  # 500 W (ingen i skuggan) och 2000 W (skuggan ville 1000 W)
+    assert stats["extra_commands"] == 1
+    assert stats["shadow_reports"] == 2  # Topp och slut på topp, aldrig skickade
+    assert [d["kind"] for d in guard.shadow.divergences][:3] == ["disagreement", "missed_peak", "missing_command"]
+
+    # Bara den riktiga regulatorns kommandon har skickats, och skuggans loggrader syns inte i HA:s logg
+    sent = [c.kwargs["service_data"]["power"] for c in mock_hass_instance.services.async_call.call_args_list]
+    assert sent == [500, 2000]
+    coordinator.reports.enqueue.assert_not_called()
+    assert guard.diagnostics()["shadow"]["agreement"] == pytest.approx(2 / 3, abs=1e-3)
+
+@pytest.mark.asyncio
+async def test_shadow_controller_runs_after_live_decision_with_same_inputs(mock_hass_instance):
+    """Krav: Skuggan utvärderas efter det riktiga beslutet, med samma indata och utanför tidmätningen."""
+    import asyncio
+    from custom_components.battery_optimizer_light.shadow import ShadowController
+
+    order = []
+
+    class SlowShadow(PeakGuard):
+        async def _stage_decide(self, current_load, limit_w, cloud_action, phases=None):
+            order.append(("shadow", current_load, limit_w))
+            await asyncio.sleep(0.08)  # Längre än vakthundens budget (50 ms)
+            await super()._stage_decide(current_load, limit_w, cloud_action, phases)
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    guard.shadow = ShadowController(guard, {"load_deadband_w": 100}, controller=SlowShadow)
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="7000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    async def send(domain, script, service_data):
+        order.append(("live", script, service_data["power"]))
+        # Sensorerna och molnet hinner ändras innan skuggan körs
+        states["sensor.husets_netto_last_virtuell"] = MagicMock(state="3000")
+        coordinator.data = SignalData.from_response({"action": "IDLE"})
+
+    mock_hass_instance.services.async_call.side_effect = send
+    await guard.update("sensor.husets_netto_last_virtuell")
+
+    # Det riktiga kommandot gick först, och skuggan såg samma last och gräns som den riktiga
+    assert order == [("live", "sonnen_force_discharge", 2000), ("shadow", 7000.0, 5000.0)]
+    assert guard.shadow.shadow.is_active
+    stats = guard.shadow.stats
+    assert stats["evaluations"] == 1 and stats["disagreements"] == 0
+    assert stats["extra_commands"] == 0 and stats["missing_commands"] == 0
+    # Skuggans tid räknas inte in i den riktiga utvärderingen
+    assert guard.watchdog.slow_count == 0
+    assert guard.update_latency.total < 0.05
+
+    # Skuggans kvittens kan aldrig skicka om ett kommando till batteriet
+    mock_hass_instance.services.async_call.reset_mock()
+    tracker = guard.shadow.shadow.actuation
+    assert tracker is not guard.actuation and tracker.battery_entity is None
+    tracker.expect("sonnen_force_discharge", {"power": 2000})
+    guard.shadow._commands = []
+    await tracker._async_deadline()
+    mock_hass_instance.services.async_call.assert_not_called()
+    assert guard.shadow._commands == [("sonnen_force_discharge", {"power": 2000})]
+
+@pytest.mark.asyncio
+async def test_limit_schedule_only_shaves_peaks_in_billed_windows(mock_hass_instance):
+    """Krav: Gränsen följer ett lokalt schema, och utanför fönstren tas inga toppar."""
+    from custom_components.battery_optimizer_light.filters import DeadbandFilter
+    from custom_components.battery_optimizer_light.schedule import UNLIMITED_W, LimitSchedule
+
+    now = {"local": datetime.datetime(2026, 1, 5, 8, 0), "ts": 1000.0}
+    schedule = LimitSchedule.from_config([
+        {"months": [11, 12, 1, 2, 3], "weekdays": ["mon", "tue", "wed", "thu", "fri"],
+         "start": "07:00", "end": "19:00", "limit_kw": 5},
+        {"weekdays": ["sat"], "start": "10:00", "end": "14:00", "limit_kw": "unlimited"},
+        {"weekdays": ["sun"], "start": "22:00", "end": "06:00"},  # Vanliga gränsen, över midnatt
+    ], clock=lambda: now["ts"], local_now=lambda: now["local"])
+
+    def lookup(local):
+        now["local"] = local
+        now["ts"] += 86400.0  # Förbi cachen
+        return schedule.value_w()
+
+    assert lookup(datetime.datetime(2026, 1, 5, 8, 0)) == 5000.0   # Vardag i januari
+    assert lookup(datetime.datetime(2026, 1, 5, 19, 0)) == UNLIMITED_W  # Fönstret har slutat
+    assert lookup(datetime.datetime(2026, 1, 11, 23, 30)) is None  # Söndagskväll: vanliga gränsen
+    assert lookup(datetime.datetime(2026, 1, 12, 5, 59)) is None   # ...fortsätter till måndag 06:00
+    assert lookup(datetime.datetime(2026, 7, 6, 8, 0)) == UNLIMITED_W  # Juli: ingen gräns
+
+    # Resultatet cachas till intervallets slut (högst en timme), inga nya uppslag dessförinnan
+    lookups = schedule.lookups
+    now["ts"] += 3599.0
+    assert schedule.value_w() == UNLIMITED_W and schedule.lookups == lookups
+    now["ts"] += 1.0
+    schedule.value_w()
+    assert schedule.lookups == lookups + 1
+
+    with pytest.raises(ValueError):
+        LimitSchedule.from_config([{"start": "25:99", "limit_kw": 5}])
+
+    # PeakGuard med schemat: samma last ger en topp bara inom fönstret
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    guard._report_peak_clear = AsyncMock()
+    guard.limit.schedule = schedule
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="8.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="6500"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    lookup(datetime.datetime(2026, 1, 10, 11, 0))  # Lördag: ingen gräns
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert not guard.is_active
+    mock_hass_instance.services.async_call.assert_not_called()
+
+    lookup(datetime.datetime(2026, 1, 11, 23, 0))  # Söndagskväll: vanliga gränsen (8 kW)
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert not guard.is_active
+    event_filter = DeadbandFilter(
+        {"sensor.husets_netto_last_virtuell": 50}, guard.deadband_thresholds, guard.deadband_generation
+    )
+    assert event_filter.accept("sensor.husets_netto_last_virtuell", MagicMock(state="6500")) is True
+    assert event_filter.accept("sensor.husets_netto_last_virtuell", MagicMock(state="6500")) is False
+
+    lookup(datetime.datetime(2026, 1, 12, 9, 0))  # Måndag förmiddag: 5 kW
+    # Bytet släpps igenom trots oförändrad last
+    assert event_filter.accept("sensor.husets_netto_last_virtuell", MagicMock(state="6500")) is True
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.is_active
+    mock_hass_instance.services.async_call.assert_called_once_with(
+        "script", "sonnen_force_discharge", service_data={"power": 1500}
+    )
+
+    lookup(datetime.datetime(2026, 1, 12, 19, 30))  # Fönstret slut: toppen släpps
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert not guard.is_active
+    assert guard.limit.diagnostics()["value_w"] == "unlimited"
+
+@pytest.mark.asyncio
+async def test_modbus_actuator_pipelines_commands_over_one_connection(mock_hass_instance):
+    """Krav: Med Modbus skrivs läge och effekt direkt till växelriktaren, i ett svep och på en uppkoppling."""
+    from custom_components.battery_optimizer_light.actuator import ModbusActuator, ModbusError, ModbusTcpClient
+
+    async with FakeModbusInverter(latency=0.05) as inverter:
+        coordinator = MagicMock()
+        coordinator.data = SignalData.from_response({"action": "HOLD"})
+        guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+        guard._report_peak = AsyncMock()
+        guard._report_peak_clear = AsyncMock()
+        guard.actuator = ModbusActuator(ModbusTcpClient(inverter.host, inverter.port))
+        states = {
+            "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+            "sensor.husets_netto_last_virtuell": MagicMock(state="5500"),
+            "sensor.soc": MagicMock(state="50"),
+            "sensor.bat_power": MagicMock(state="0"),
+        }
+        mock_hass_instance.states.get.side_effect = states.get
+
+        started = time.perf_counter()
+        await guard.update("sensor.husets_netto_last_virtuell")
+        elapsed = time.perf_counter() - started
+
+        # Effekt, läge och återläsning gick iväg samtidigt: en fördröjning i stället för tre
+        assert guard.is_active
+        assert inverter.writes() == [(1, 500), (0, 2)]
+        assert [r.function for r in inverter.requests] == [0x06, 0x06, 0x03]
+        assert elapsed < 0.12
+        assert guard.actuator.last_readback_w == 500
+        mock_hass_instance.services.async_call.assert_not_called()
+
+        # Fel från växelriktaren syns i kommandohistoriken, och uppkopplingen återanvänds
+        inverter.fail_next(4)
+        with pytest.raises(ModbusError):
+            await guard._call_script("sonnen_force_discharge", {"power": 800})
+        assert "server device failure" in guard.command_history[-1]["error"]
+
+        # Tappad uppkoppling: nästa kommando kopplar upp igen
+        inverter.fail_next("disconnect")
+        with pytest.raises(ConnectionError):
+            await guard._call_script("sonnen_force_charge", {"power": 1200})
+        await guard._call_script("sonnen_force_charge", {"power": 1200})
+        assert inverter.battery_power_w == -1200 and guard.actuator.last_readback_w == -1200
+        await guard._call_script("sonnen_set_auto_mode", {})
+        assert inverter.registers[:3] == [0, 0, 0]
+
+        diagnostics = guard.diagnostics()["actuator"]
+        assert diagnostics["backend"] == "modbus" and diagnostics["stats"]["connects"] == 2
+        assert diagnostics["stats"]["max_in_flight"] == 3
+        await guard.actuator.async_close()
+        assert not guard.actuator.client.connected
+
+        # Uppkopplingen stängs mellan uppkoppling och skrivning: klientens eget fel, inget AttributeError
+        client = ModbusTcpClient(inverter.host, inverter.port)
+        client._ensure_connected = AsyncMock()
+        with pytest.raises(ConnectionError):
+            await client.write_register(0, 1)
+        assert client.stats["errors"] == 1 and not client._pending
+
+@pytest.mark.asyncio
+async def test_actuation_tracker_measures_response_and_escalates(mock_hass_instance):
+    """Krav: Efter ett kommando mäts tiden tills batteriet följer, och uteblivet svar skickas om och eskaleras."""
+    from custom_components.battery_optimizer_light.actuation import EVENT_ACTUATION_FAILED
+    from custom_components.battery_optimizer_light.sensor import BatteryLightResponseTimeSensor
+
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    now = [100.0]
+    guard.actuation._clock = lambda: now[0]
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": MagicMock(state="6000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0", attributes={"unit_of_measurement": "W"}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    # Urladdning 1000 W: batteriet är på väg efter 1 s och framme efter 2.5 s
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.actuation.pending.requested_w == 1000.0
+    now[0] += 1.0
+    guard.actuation.observe(400.0)
+    assert guard.actuation.pending is not None
+    now[0] += 1.5
+    guard.actuation.observe(950.0)
+    assert guard.actuation.pending is None
+    assert guard.actuation_latency_s == pytest.approx(2.5)
+    sensor = BatteryLightResponseTimeSensor(coordinator)
+    coordinator.peak_guard = guard
+    assert sensor._compute_value() == 2.5
+
+    # Laddning som batteriet inte följer: en omsändning, sedan eskalering
+    await guard._call_script("sonnen_force_charge", {"power": 1200})
+    calls = mock_hass_instance.services.async_call.call_count
+    now[0] += 20.0
+    await guard.actuation._async_deadline()
+    assert mock_hass_instance.services.async_call.call_count == calls + 1  # Samma kommando igen
+    assert guard.actuation.pending.attempts == 2
+    guard.actuation.observe(-100.0)
+    now[0] += 20.0
+    await guard.actuation._async_deadline()
+    assert guard.actuation.pending is None
+    mock_hass_instance.bus.async_fire.assert_called_once()
+    event_type, event_data = mock_hass_instance.bus.async_fire.call_args.args
+    assert event_type == EVENT_ACTUATION_FAILED
+    assert event_data["requested_w"] == -1200.0 and event_data["measured_w"] == -100.0 and event_data["attempts"] == 2
+
+    diagnostics = guard.diagnostics()["actuation"]
+    assert diagnostics["stats"]["acknowledged"] == 1 and diagnostics["stats"]["escalations"] == 1
+    assert diagnostics["stats"]["retries"] == 1
+    assert diagnostics["latency"]["buckets"]["le_5000ms"] == 1
+    assert diagnostics["achieved_ratio"]["count"] == 2  # 95 % och 8 %
+    assert [h["result"] for h in diagnostics["history"]] == ["acknowledged", "failed"]
+
+@pytest.mark.asyncio
+async def test_prometheus_metrics_render_from_memory(mock_hass_instance):
+    """Krav: Metrics-endpointen ger Prometheus-text från räknarna i minnet, utan att läsa state-maskinen."""
+    from custom_components.battery_optimizer_light.prometheus import (
+        CONTENT_TYPE, BatteryOptimizerMetricsView, render_metrics,
+    )
+
+    coordinator = BatteryOptimizerLightCoordinator(mock_hass_instance, MOCK_CONFIG)
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    coordinator.last_update_success = True
+    coordinator.signal_latency.observe(0.2)
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    coordinator.peak_guard = guard
+    guard._report_peak = AsyncMock()
+    guard.limit.fixed_w = 5000.0
+    states = {
+        "sensor.husets_netto_last_virtuell": MagicMock(state="6000"),
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0"),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+    await guard.update("sensor.husets_netto_last_virtuell")
+    mock_hass_instance.states.get.reset_mock()
+
+    text = render_metrics({"entry1": coordinator})
+    mock_hass_instance.states.get.assert_not_called()
+    lines = text.splitlines()
+    assert 'battery_optimizer_light_peak_active{entry="entry1"} 1' in lines
+    assert 'battery_optimizer_light_limit_watts{entry="entry1"} 5000.0' in lines
+    assert 'battery_optimizer_light_evaluations_total{entry="entry1"} 1' in lines
+    assert (
+        'battery_optimizer_light_commands_total{entry="entry1",command="sonnen_force_discharge",result="ok"} 1'
+        in lines
+    )
+    assert 'battery_optimizer_light_reports_pending{entry="entry1"} 0' in lines
+    # Histogram: kumulativa hinkar, +Inf, summa och antal
+    assert 'battery_optimizer_light_cloud_signal_duration_seconds_bucket{entry="entry1",le="0.1"} 0' in lines
+    assert 'battery_optimizer_light_cloud_signal_duration_seconds_bucket{entry="entry1",le="0.25"} 1' in lines
+    assert 'battery_optimizer_light_cloud_signal_duration_seconds_bucket{entry="entry1",le="+Inf"} 1' in lines
+    assert 'battery_optimizer_light_cloud_signal_duration_seconds_count{entry="entry1"} 1' in lines
+    # En HELP/TYPE per familj, även när familjen har flera serier
+    assert text.count("# TYPE battery_optimizer_light_stage_duration_seconds histogram") == 1
+    assert all(line.startswith("#") or " " in line for line in lines)
+
+    # Gränsen från en entitet och händelser från entiteter utan dödband: bara det som finns i minnet
+    from custom_components.battery_optimizer_light.filters import DeadbandFilter
+    guard.limit.fixed_w = None
+    guard.limit._refresh(MagicMock(state="4.5", attributes={"unit_of_measurement": "kW"}))
+    guard.event_filter = DeadbandFilter({"sensor.husets_netto_last_virtuell": 50}, lambda entity_id: None)
+    guard.event_filter.accept("sensor.status", MagicMock(state="OnGrid"))
+    mock_hass_instance.states.get.reset_mock()
+    other = render_metrics({"entry1": coordinator})
+    mock_hass_instance.states.get.assert_not_called()
+    other_lines = other.splitlines()
+    assert 'battery_optimizer_light_limit_watts{entry="entry1"} 4500.0' in other_lines
+    assert (
+        'battery_optimizer_light_events_total{entry="entry1",entity_id="sensor.status",result="passed"} 1'
+        in other_lines
+    )
+    assert (
+        'battery_optimizer_light_events_total{entry="entry1",entity_id="sensor.husets_netto_last_virtuell",'
+        'result="passed"} 0' in other_lines
+    )
+    guard.limit.fixed_w = 5000.0
+    guard.event_filter = None
+
+    hass = MagicMock()
+    hass.data = {"battery_optimizer_light": {"entry1": coordinator}}
+    view = BatteryOptimizerMetricsView(hass)
+    assert view.requires_auth and view.url == "/api/battery_optimizer_light/metrics"
+    response = await view.get(MagicMock())
+    assert response.headers["Content-Type"] == CONTENT_TYPE
+    assert response.body.decode() == text
+
+
+def test_services_yaml_describes_each_service():
+    """Varje tjänst har en egen post i services.yaml (ingen nyckel får klistras ihop med raden före)."""
+    import yaml
+
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "custom_components", "battery_optimizer_light", "services.yaml"
+    )
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    assert text.endswith("\n")
+    services = yaml.safe_load(text)
+    assert list(services["run_peak_guard"]["fields"]) == ["virtual_load_entity", "limit_entity"]
+    assert services["run_peak_guard"]["fields"]["limit_entity"]["selector"]["entity"]["domain"] == [
+        "sensor", "input_number",
+    ]
+    assert list(services["profile"]["fields"]) == ["duration", "top"]
+
+
+def test_dry_run_service_schema_matches_services_yaml():
+    import voluptuous as vol
+    import yaml
+    from custom_components.battery_optimizer_light.dryrun import DRY_RUN_SCHEMA, DryRunInputs
+
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "custom_components", "battery_optimizer_light", "services.yaml"
+    )
+    with open(path, encoding="utf-8") as f:
+        services = yaml.safe_load(f)
+    fields = services["dry_run"]["fields"]
+    assert set(fields) == {str(key) for key in DRY_RUN_SCHEMA.schema}
+
+    data = DRY_RUN_SCHEMA({"load_w": "7500", "soc": 40, "cloud_action": "discharge"})
+    assert data == {"load_w": 7500.0, "soc": 40.0, "cloud_action": "DISCHARGE"}
+    assert DryRunInputs.from_service_data(data).cloud_action == "DISCHARGE"
+    for invalid in ({"soc": 140}, {"limit_w": -1}, {"cloud_action": "BOOST"}, {"load": 7500}):
+        with pytest.raises(vol.Invalid):
+            DRY_RUN_SCHEMA(invalid)
+
+
+def test_profile_service_schema_bounds_duration_and_top():
+    import voluptuous as vol
+    from custom_components.battery_optimizer_light.profiler import PROFILE_SCHEMA
+
+    assert PROFILE_SCHEMA({}) == {"duration": 60, "top": 20}
+    assert PROFILE_SCHEMA({"duration": "30", "top": 5}) == {"duration": 30, "top": 5}
+    for invalid in ({"duration": 0}, {"duration": 601}, {"duration": -5}, {"top": 0}, {"top": 201}, {"top": "x"},
+                    {"seconds": 10}):
+        with pytest.raises(vol.Invalid):
+            PROFILE_SCHEMA(invalid)
+
+@pytest.mark.asyncio
+async def test_actuation_tracker_follows_power_updates_and_cancels_stale_commands(mock_hass_instance):
+    """Krav: Nya effekter för samma kommando behåller starttiden, och ett kommando som inte längre gäller skickas
+    inte om när toppen är över eller molnet byter läge."""
+    coordinator = MagicMock()
+    coordinator.data = SignalData.from_response({"action": "DISCHARGE"})
+    guard = PeakGuard(mock_hass_instance, MOCK_CONFIG, coordinator)
+    guard._report_peak = AsyncMock()
+    guard._report_peak_clear = AsyncMock()
+    now = [100.0]
+    guard.actuation._clock = lambda: now[0]
+    load = MagicMock(state="6000")
+    states = {
+        "sensor.optimizer_light_peak_limit": MagicMock(state="5.0", attributes={"unit_of_measurement": "kW"}),
+        "sensor.husets_netto_last_virtuell": load,
+        "sensor.soc": MagicMock(state="50"),
+        "sensor.bat_power": MagicMock(state="0", attributes={"unit_of_measurement": "W"}),
+    }
+    mock_hass_instance.states.get.side_effect = states.get
+
+    # Toppen växer: samma kommando med ny effekt flyttar inte starttiden eller tidsgränsen
+    with patch("custom_components.battery_optimizer_light.actuation.async_call_later") as call_later:
+        await guard.update("sensor.husets_netto_last_virtuell")
+        pending = guard.actuation.pending
+        assert pending.requested_w == 1000.0
+        now[0] += 5.0
+        load.state = "6500"
+        await guard.update("sensor.husets_netto_last_virtuell")
+        assert guard.actuation.pending is pending
+        assert pending.requested_w == 1500.0 and pending.sent_at == 100.0 and pending.attempts == 1
+        call_later.assert_called_once()
+    now[0] += 3.0
+    guard.actuation.observe(1480.0)
+    assert guard.actuation.latency_s == pytest.approx(8.0)  # Från första kommandot
+
+    # Toppen tar slut under molnets DISCHARGE: ingen omsändning av toppens urladdning
+    await guard._call_script("sonnen_force_discharge", {"power": 1200})
+    load.state = "3000"
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert not guard.is_active
+    assert guard.actuation.pending is None
+    calls = mock_hass_instance.services.async_call.call_count
+    now[0] += 20.0
+    await guard.actuation._async_deadline()
+    assert mock_hass_instance.services.async_call.call_count == calls
+    mock_hass_instance.bus.async_fire.assert_not_called()
+
+    # Stoppkommando vid HOLD avbryts när molnet byter läge
+    coordinator.data = SignalData.from_response({"action": "HOLD"})
+    states["sensor.bat_power"] = MagicMock(state="800", attributes={"unit_of_measurement": "W"})
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.actuation.pending.command == "sonnen_force_charge"
+    coordinator.data = SignalData.from_response({"action": "DISCHARGE"})
+    await guard.update("sensor.husets_netto_last_virtuell")
+    assert guard.actuation.pending is None
+    stats = guard.actuation.diagnostics()["stats"]
+    assert stats["cancelled"] == 2 and stats["escalations"] == 0 and stats["retries"] == 0